@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Compare throughput and latency of the PostgreSQL storage per connection pool.
+
+This runs a mix of item retrievals and publishes against a node of the
+PostgreSQL storage, keeping a given number of requests outstanding, once
+with the thread based L{idavoll.dbpool.ConnectionPool} and once with the
+reactor based L{idavoll.dbpool.AsyncConnectionPool}. For each, it reports
+the number of requests per second and latency percentiles.
+
+Usage: python benchmarks/dbpool.py [options]
+"""
+
+import sys
+import time
+
+from psycopg2.extras import NamedTupleConnection
+
+from twisted.internet import defer, reactor
+from twisted.python import usage
+from twisted.words.protocols.jabber import jid
+from twisted.words.xish import domish
+
+from idavoll import error
+from idavoll.dbpool import AsyncConnectionPool, ConnectionPool
+from idavoll.pgsql_storage import Storage
+
+NODE = 'idavoll-benchmark'
+OWNER = jid.JID('owner@example.org')
+PUBLISHER = jid.JID('publisher@example.org')
+
+CONFIG = {
+    'pubsub#node_type': 'leaf',
+    'pubsub#persist_items': True,
+    'pubsub#deliver_payloads': True,
+    'pubsub#send_last_published_item': 'on_sub',
+}
+
+
+
+class Options(usage.Options):
+    optParameters = [
+        ('dbname', None, 'pubsub_test', 'Database name'),
+        ('dbuser', None, None, 'Database user'),
+        ('dbhost', None, None, 'Database host'),
+        ('connections', None, '5', 'Number of database connections'),
+        ('concurrency', None, '50', 'Number of outstanding requests'),
+        ('requests', None, '5000', 'Number of requests'),
+        ('publish-ratio', None, '0.2', 'Fraction of requests that publish'),
+    ]
+
+
+
+def makeItem(n):
+    item = domish.Element((None, 'item'))
+    item['id'] = 'item%d' % (n % 1000)
+    item.addElement(('http://jabber.org/protocol/tune', 'tune'),
+                    content=u'Track %d' % n)
+    return item
+
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+
+@defer.inlineCallbacks
+def measure(storage, config):
+    requests = int(config['requests'])
+    concurrency = int(config['concurrency'])
+    publishEvery = int(round(1 / float(config['publish-ratio'])))
+
+    try:
+        yield storage.deleteNode(NODE)
+    except error.NodeNotFound:
+        pass
+    yield storage.createNode(NODE, OWNER, CONFIG)
+    node = yield storage.getNode(NODE)
+    yield node.storeItems([makeItem(n) for n in xrange(100)], PUBLISHER)
+
+    latencies = []
+    counter = iter(xrange(requests))
+
+    @defer.inlineCallbacks
+    def worker():
+        for n in counter:
+            start = time.time()
+            if n % publishEvery == 0:
+                yield node.storeItems([makeItem(n)], PUBLISHER)
+            else:
+                yield node.getItems(10)
+            latencies.append(time.time() - start)
+
+    start = time.time()
+    yield defer.gatherResults([worker() for i in xrange(concurrency)])
+    elapsed = time.time() - start
+
+    yield storage.deleteNode(NODE)
+
+    latencies.sort()
+    print '   throughput: %8.0f requests/s' % (requests / elapsed)
+    for fraction in (0.5, 0.9, 0.99, 0.999):
+        print '   p%-5s     %8.2f ms' % (fraction * 100,
+                                          percentile(latencies, fraction) *
+                                          1000)
+    print
+
+
+
+@defer.inlineCallbacks
+def run(config):
+    connections = int(config['connections'])
+    keywords = {'database': config['dbname'],
+                'user': config['dbuser'],
+                'host': config['dbhost'],
+                'client_encoding': 'utf-8',
+                'connection_factory': NamedTupleConnection}
+
+    for title, dbpool in [
+        ('adbapi (threads)',
+         ConnectionPool('psycopg2', cp_min=connections, cp_max=connections,
+                        **keywords)),
+        ('asynchronous',
+         AsyncConnectionPool(connections, **keywords)),
+        ]:
+        dbpool.start()
+        print '== %s, %d connections, %s outstanding requests' % (
+                title, connections, config['concurrency'])
+        print
+        try:
+            yield measure(Storage(dbpool), config)
+        finally:
+            dbpool.close()
+
+
+
+def main(argv):
+    config = Options()
+    try:
+        config.parseOptions(argv)
+    except usage.UsageError, e:
+        print '%s: %s' % (sys.argv[0], e)
+        print config
+        return 1
+
+    def done(result):
+        reactor.stop()
+        return result
+
+    reactor.callWhenRunning(lambda: run(config).addBoth(done))
+    reactor.run()
+    return 0
+
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Compare table size and read latency of compressed and uncompressed items.
+
+This creates the schema from C{db/pubsub.sql} in a scratch schema of the
+given database, and fills a node with generated Atom entries, once stored
+as is and once with the compression of L{idavoll.pgsql_storage} applied to
+all items of at least the given threshold. For each, it reports the size
+of the items table, including its TOAST table and indexes, the time taken
+to retrieve and decode the latest items of the node, and the time taken by
+a sequential scan of the table. The scratch schema is dropped afterwards.
+
+Usage: python benchmarks/item_compression.py [options]
+"""
+
+import os
+import random
+import sys
+import time
+import zlib
+
+import psycopg2
+
+from twisted.python import usage
+
+from idavoll.pgsql_storage import _toItem
+
+SCHEMA = 'idavoll_benchmark'
+DB_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      os.pardir, 'db')
+
+WORDS = """lorem ipsum dolor sit amet consectetur adipiscing elit sed do
+eiusmod tempor incididunt ut labore et dolore magna aliqua enim ad minim
+veniam quis nostrud exercitation ullamco laboris nisi aliquip ex ea commodo
+consequat duis aute irure in reprehenderit voluptate velit esse cillum
+fugiat nulla pariatur excepteur sint occaecat cupidatat non proident sunt
+culpa qui officia deserunt mollit anim id est laborum""".split()
+
+ENTRY = u"""<item id='%(id)s'><entry xmlns='http://www.w3.org/2005/Atom'>\
+<title>%(title)s</title>\
+<id>tag:example.org,2009:%(id)s</id>\
+<published>2009-09-07T12:00:00Z</published>\
+<updated>2009-09-07T12:00:00Z</updated>\
+<author><name>Some Author</name><uri>xmpp:author@example.org</uri></author>\
+<link rel='alternate' href='http://example.org/entries/%(id)s'/>\
+<content type='xhtml'><div xmlns='http://www.w3.org/1999/xhtml'>\
+%(paragraphs)s</div></content></entry></item>"""
+
+
+
+class Options(usage.Options):
+    optParameters = [
+        ('dbname', None, 'pubsub_test', 'Database name'),
+        ('dbuser', None, None, 'Database user'),
+        ('dbhost', None, None, 'Database host'),
+        ('items', None, '10000', 'Number of items'),
+        ('paragraphs', None, '5', 'Number of paragraphs per entry'),
+        ('threshold', None, '512', 'Compression threshold in bytes'),
+        ('page', None, '20', 'Number of items retrieved per request'),
+    ]
+
+
+
+def makeEntry(identifier, paragraphs):
+    def text(words):
+        return u' '.join(random.choice(WORDS) for i in xrange(words))
+
+    return ENTRY % {
+        'id': identifier,
+        'title': text(6),
+        'paragraphs': u''.join(u'<p>%s</p>' % text(random.randint(40, 80))
+                               for i in xrange(paragraphs)),
+        }
+
+
+
+def populate(cursor, items, paragraphs, threshold):
+    cursor.execute("""TRUNCATE items""")
+    cursor.execute("""SELECT node_id FROM nodes WHERE node='benchmark'""")
+    nodeId = cursor.fetchone()[0]
+
+    random.seed(0)
+    total = 0
+    for n in xrange(items):
+        data = makeEntry('item%d' % n, paragraphs).encode('utf-8')
+        total += len(data)
+        compressed = None
+        if threshold is not None and len(data) >= threshold:
+            compressed = psycopg2.Binary(zlib.compress(data))
+            data = None
+
+        cursor.execute("""INSERT INTO items
+                          (node_id, item, publisher, data, data_compressed,
+                           date)
+                          VALUES (%s, %s, 'publisher@example.org', %s, %s,
+                                  now() - %s * interval '1 second')""",
+                       (nodeId, 'item%d' % n, data, compressed, n))
+
+    cursor.execute("""VACUUM ANALYZE items""")
+    return nodeId, total
+
+
+
+def measure(cursor, nodeId, page):
+    cursor.execute("""SELECT pg_table_size('items'),
+                             pg_total_relation_size('items')""")
+    tableSize, totalSize = cursor.fetchone()
+    print '   table size (with TOAST): %10.1f kB' % (tableSize / 1024.0)
+    print '   total size:              %10.1f kB' % (totalSize / 1024.0)
+
+    iterations = 200
+    start = time.time()
+    for i in xrange(iterations):
+        cursor.execute("""SELECT data, data_compressed FROM items
+                          WHERE node_id=%s
+                          ORDER BY date DESC, item_id DESC LIMIT %s""",
+                       (nodeId, page))
+        [_toItem(*row) for row in cursor.fetchall()]
+    print '   latest %3d items:         %10.3f ms' % (
+            page, (time.time() - start) * 1000 / iterations)
+
+    iterations = 20
+    start = time.time()
+    for i in xrange(iterations):
+        cursor.execute("""SELECT count(*) FROM items
+                          WHERE octet_length(data) > 0 OR
+                                octet_length(data_compressed) > 0""")
+    print '   sequential scan:         %10.3f ms' % (
+            (time.time() - start) * 1000 / iterations)
+    print
+
+
+
+def main(argv):
+    config = Options()
+    try:
+        config.parseOptions(argv)
+    except usage.UsageError, e:
+        print '%s: %s' % (sys.argv[0], e)
+        print config
+        return 1
+
+    items = int(config['items'])
+    paragraphs = int(config['paragraphs'])
+    page = int(config['page'])
+
+    connection = psycopg2.connect(database=config['dbname'],
+                                  user=config['dbuser'],
+                                  host=config['dbhost'])
+    connection.autocommit = True
+    cursor = connection.cursor()
+
+    cursor.execute("""CREATE SCHEMA %s""" % SCHEMA)
+    try:
+        cursor.execute("""SET search_path TO %s""" % SCHEMA)
+        cursor.execute(open(os.path.join(DB_DIR, 'pubsub.sql')).read())
+        cursor.execute("""INSERT INTO nodes (node) VALUES ('benchmark')""")
+
+        for title, threshold in [
+            ('Uncompressed', None),
+            ('Compressed from %s bytes' % config['threshold'],
+             int(config['threshold'])),
+            ]:
+            print 'Populating...'
+            nodeId, total = populate(cursor, items, paragraphs, threshold)
+            print
+            print '== %s (%d items, %.1f kB of XML)' % (title, items,
+                                                         total / 1024.0)
+            print
+            measure(cursor, nodeId, page)
+    finally:
+        cursor.execute("""DROP SCHEMA IF EXISTS %s CASCADE""" % SCHEMA)
+        connection.close()
+
+    return 0
+
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Compare query plans of the PostgreSQL storage before and after indexing.
+
+This creates the schema from C{db/pubsub.sql} in a scratch schema of the
+given database, without the changes made by C{db/to_idavoll_0.10.sql}. It
+then fills it with generated nodes, items and subscriptions, and shows the
+plans and timings of the hot queries of L{idavoll.pgsql_storage}, before
+and after applying the migration. The scratch schema is dropped afterwards.
+
+Usage: python benchmarks/query_plans.py [options]
+"""
+
+import os
+import sys
+import time
+
+import psycopg2
+
+from twisted.python import usage
+
+SCHEMA = 'idavoll_benchmark'
+DB_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      os.pardir, 'db')
+
+INDEXES = ['items_node_id_date_idx',
+           'subscriptions_node_id_state_idx',
+           'affiliations_node_id_idx']
+
+QUERIES = [
+    ('getItems(1)',
+     """SELECT data FROM items
+        WHERE node_id=%(node_id)s
+        ORDER BY date DESC, item_id DESC LIMIT 1"""),
+    ('getItems(20)',
+     """SELECT data FROM items
+        WHERE node_id=%(node_id)s
+        ORDER BY date DESC, item_id DESC LIMIT 20"""),
+    ('getSubscriptions(subscribed)',
+     """SELECT jid, resource, state,
+               subscription_type, subscription_depth
+        FROM subscriptions
+        NATURAL JOIN entities
+        WHERE node_id=%(node_id)s AND state='subscribed'"""),
+    ('getAffiliations',
+     """SELECT jid, affiliation FROM affiliations
+        NATURAL JOIN entities
+        WHERE node_id=%(node_id)s"""),
+]
+
+
+
+class Options(usage.Options):
+    optParameters = [
+        ('dbname', None, 'pubsub_test', 'Database name'),
+        ('dbuser', None, None, 'Database user'),
+        ('dbhost', None, None, 'Database host'),
+        ('nodes', None, '100', 'Number of nodes'),
+        ('items', None, '10000', 'Number of items per node'),
+        ('subscribers', None, '100', 'Number of subscribers per node'),
+    ]
+
+
+
+def populate(cursor, nodes, items, subscribers):
+    cursor.execute("""INSERT INTO nodes (node)
+                      SELECT 'node ' || n FROM generate_series(1, %s) n""",
+                   (nodes,))
+    cursor.execute("""INSERT INTO entities (jid)
+                      SELECT 'user' || n || '@example.org'
+                      FROM generate_series(1, %s) n""",
+                   (subscribers,))
+    cursor.execute("""INSERT INTO items (node_id, item, publisher, data, date)
+                      SELECT node_id, 'item ' || n, 'publisher@example.org',
+                             '<item id="' || n || '"/>',
+                             now() - n * interval '1 second'
+                      FROM nodes CROSS JOIN generate_series(1, %s) n
+                      WHERE node <> ''""",
+                   (items,))
+    cursor.execute("""INSERT INTO subscriptions
+                      (entity_id, resource, node_id, state)
+                      SELECT entity_id, '', node_id,
+                             CASE WHEN entity_id % 10 = 0 THEN 'pending'
+                                  ELSE 'subscribed' END
+                      FROM nodes CROSS JOIN entities
+                      WHERE node <> ''""")
+    cursor.execute("""INSERT INTO affiliations
+                      (entity_id, node_id, affiliation)
+                      SELECT entity_id, node_id, 'publisher'
+                      FROM nodes CROSS JOIN entities
+                      WHERE node <> '' AND entity_id % 10 = 1""")
+    cursor.execute("""ANALYZE""")
+
+
+
+def explain(cursor, nodeId):
+    for name, query in QUERIES:
+        cursor.execute("EXPLAIN ANALYZE " + query, {'node_id': nodeId})
+        print '-- %s' % name
+        for row in cursor.fetchall():
+            print '   ' + row[0]
+
+        start = time.time()
+        for i in xrange(100):
+            cursor.execute(query, {'node_id': nodeId})
+            cursor.fetchall()
+        print '   average: %.3f ms' % ((time.time() - start) * 10)
+        print
+
+
+
+def main(argv):
+    config = Options()
+    try:
+        config.parseOptions(argv)
+    except usage.UsageError, e:
+        print '%s: %s' % (sys.argv[0], e)
+        print config
+        return 1
+
+    connection = psycopg2.connect(database=config['dbname'],
+                                  user=config['dbuser'],
+                                  host=config['dbhost'])
+    cursor = connection.cursor()
+
+    cursor.execute("""CREATE SCHEMA %s""" % SCHEMA)
+    try:
+        cursor.execute("""SET search_path TO %s""" % SCHEMA)
+        cursor.execute(open(os.path.join(DB_DIR, 'pubsub.sql')).read())
+        for index in INDEXES:
+            cursor.execute("""DROP INDEX %s""" % index)
+        cursor.execute("""ALTER TABLE items DROP COLUMN data_compressed""")
+        cursor.execute("""ALTER TABLE nodes DROP COLUMN max_items""")
+
+        print 'Populating...'
+        populate(cursor, int(config['nodes']), int(config['items']),
+                 int(config['subscribers']))
+        cursor.execute("""SELECT max(node_id) FROM nodes""")
+        nodeId = cursor.fetchone()[0]
+
+        print
+        print '== Before'
+        print
+        explain(cursor, nodeId)
+
+        cursor.execute(open(os.path.join(DB_DIR,
+                                         'to_idavoll_0.10.sql')).read())
+        cursor.execute("""ANALYZE""")
+
+        print '== After'
+        print
+        explain(cursor, nodeId)
+    finally:
+        connection.rollback()
+        cursor.execute("""DROP SCHEMA IF EXISTS %s CASCADE""" % SCHEMA)
+        connection.commit()
+        connection.close()
+
+    return 0
+
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Micro-benchmarks for parsing and serializing item payloads.
+
+For a number of representative items, this reports the throughput of each
+parser in L{idavoll.codec.parsers}, of serializing the parsed item with
+L{domish}, and of passing along a L{SerializedItem} as part of a stanza.
+
+Usage: python benchmarks/xml_codec.py [iterations]
+"""
+
+import sys
+import timeit
+
+from twisted.words.xish import domish
+
+from idavoll import codec
+from idavoll.codec import SerializedItem
+
+NS_ATOM = 'http://www.w3.org/2005/Atom'
+
+def makeEntry(paragraphs, categories):
+    item = domish.Element((None, 'item'))
+    item['id'] = 'ab1c1d0e-1fc2-4d47-aa5d-2e7e2a0a1c5b'
+    entry = item.addElement((NS_ATOM, 'entry'))
+    entry.addElement('title', content=u'An entry with some \u2083 text')
+    entry.addElement('id', content=u'tag:example.org,2009:entry-1')
+    entry.addElement('published', content=u'2009-09-07T12:00:00Z')
+    entry.addElement('updated', content=u'2009-09-07T12:00:00Z')
+    author = entry.addElement('author')
+    author.addElement('name', content=u'Some Author')
+    author.addElement('uri', content=u'xmpp:author@example.org')
+    link = entry.addElement('link')
+    link['rel'] = 'alternate'
+    link['href'] = 'http://example.org/entries/1'
+    for i in xrange(categories):
+        entry.addElement('category')['term'] = 'category%d' % i
+    content = entry.addElement('content')
+    content['type'] = 'xhtml'
+    div = content.addElement(('http://www.w3.org/1999/xhtml', 'div'))
+    for i in xrange(paragraphs):
+        p = div.addElement('p', content=u'Lorem ipsum dolor sit amet, ')
+        p.addElement('em', content=u'consectetur')
+        p.addContent(u' adipiscing elit & more. ' * 4)
+    return item
+
+
+
+def makeTune():
+    item = domish.Element((None, 'item'))
+    item['id'] = 'current'
+    tune = item.addElement(('http://jabber.org/protocol/tune', 'tune'))
+    tune.addElement('artist', content=u'Yes')
+    tune.addElement('title', content=u'Heart of the Sunrise')
+    tune.addElement('length', content=u'686')
+    return item
+
+
+
+PAYLOADS = [
+    ('tune (XEP-0118)', makeTune()),
+    ('atom entry', makeEntry(3, 2)),
+    ('large atom entry', makeEntry(100, 20)),
+]
+
+
+
+def measure(func, iterations):
+    timer = timeit.Timer(func)
+    seconds = min(timer.repeat(3, iterations))
+    return iterations / seconds
+
+
+
+def main(argv):
+    iterations = int(argv[0]) if argv else 1000
+
+    for name, element in PAYLOADS:
+        xml = element.toXml()
+        data = xml.encode('utf-8')
+        parsed = codec.parse(data)
+        serialized = SerializedItem(xml)
+
+        print '%s (%d bytes)' % (name, len(data))
+
+        for parserName in sorted(codec.parsers):
+            parser = codec.parsers[parserName]
+            rate = measure(lambda: parser(data), iterations)
+            print '  %-20s %9.0f items/s %8.1f MB/s' % (
+                    'parse (%s):' % parserName, rate, rate * len(data) / 1e6)
+
+        rate = measure(parsed.toXml, iterations)
+        print '  %-20s %9.0f items/s %8.1f MB/s' % (
+                'serialize (domish):', rate, rate * len(data) / 1e6)
+
+        def passThrough():
+            items = domish.Element((None, 'items'))
+            items.addChild(serialized)
+            items.toXml()
+
+        rate = measure(passThrough, iterations)
+        print '  %-20s %9.0f items/s %8.1f MB/s' % (
+                'serialized item:', rate, rate * len(data) / 1e6)
+        print
+
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,53 @@
+-- Partition the items table by hash of the node.
+--
+-- Every query on items is for a single node, so that only the partition
+-- holding that node is used, and vacuuming and index maintenance work on
+-- partitions a fraction of the size of the whole table. The partition key
+-- is part of the primary key and of the unique constraint on items.
+--
+-- This moves existing items into the new table, and must be run in a
+-- single transaction:
+--
+--   psql --single-transaction pubsub <db/partition_items.sql
+--
+-- Change the modulus of 16 below for a different number of partitions.
+
+ALTER TABLE items RENAME TO items_unpartitioned;
+ALTER INDEX items_pkey RENAME TO items_unpartitioned_pkey;
+ALTER INDEX items_node_id_item_key RENAME TO items_unpartitioned_node_id_item_key;
+ALTER INDEX items_node_id_date_idx RENAME TO items_unpartitioned_node_id_date_idx;
+
+CREATE TABLE items (
+    item_id integer NOT NULL DEFAULT nextval('items_item_id_seq'),
+    node_id integer NOT NULL
+        CONSTRAINT items_node_id_fkey REFERENCES nodes ON DELETE CASCADE,
+    item text NOT NULL,
+    publisher text NOT NULL,
+    data text,
+    data_compressed bytea,
+    date timestamp with time zone NOT NULL DEFAULT now(),
+    PRIMARY KEY (node_id, item_id),
+    UNIQUE (node_id, item),
+    CONSTRAINT items_check CHECK (data IS NULL OR data_compressed IS NULL)
+) PARTITION BY HASH (node_id);
+
+ALTER SEQUENCE items_item_id_seq OWNED BY items.item_id;
+
+DO $$
+BEGIN
+    FOR remainder IN 0..15 LOOP
+        EXECUTE format('CREATE TABLE items_%s PARTITION OF items
+                        FOR VALUES WITH (MODULUS 16, REMAINDER %s)',
+                       remainder, remainder);
+    END LOOP;
+END
+$$;
+
+CREATE INDEX items_node_id_date_idx ON items (node_id, date, item_id);
+
+INSERT INTO items
+       (item_id, node_id, item, publisher, data, data_compressed, date)
+       SELECT item_id, node_id, item, publisher, data, data_compressed, date
+       FROM items_unpartitioned;
+
+DROP TABLE items_unpartitioned;
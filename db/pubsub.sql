@@ -11,7 +11,8 @@ CREATE TABLE nodes (
     persist_items boolean,
     deliver_payloads boolean NOT NULL DEFAULT TRUE,
     send_last_published_item text NOT NULL DEFAULT 'on_sub'
-        CHECK (send_last_published_item IN ('never', 'on_sub'))
+        CHECK (send_last_published_item IN ('never', 'on_sub')),
+    max_items integer CHECK (max_items > 0)
 );
 
 INSERT INTO nodes (node, node_type) values ('', 'collection');
@@ -44,6 +45,14 @@ CREATE TABLE items (
     item text NOT NULL,
     publisher text NOT NULL,
     data text,
+    data_compressed bytea,
     date timestamp with time zone NOT NULL DEFAULT now(),
-    UNIQUE (node_id, item)
+    UNIQUE (node_id, item),
+    CHECK (data IS NULL OR data_compressed IS NULL)
 );
+
+CREATE INDEX items_node_id_date_idx ON items (node_id, date, item_id);
+
+CREATE INDEX subscriptions_node_id_state_idx ON subscriptions (node_id, state);
+
+CREATE INDEX affiliations_node_id_idx ON affiliations (node_id);
@@ -0,0 +1,15 @@
+-- Retrieving the latest items of a node, ordered by date.
+CREATE INDEX items_node_id_date_idx ON items (node_id, date, item_id);
+
+-- Retrieving the (subscribed) subscriptions to a node for notifications.
+CREATE INDEX subscriptions_node_id_state_idx ON subscriptions (node_id, state);
+
+-- Retrieving the affiliations with a node, and deleting nodes.
+CREATE INDEX affiliations_node_id_idx ON affiliations (node_id);
+
+-- Optionally storing large item payloads compressed.
+ALTER TABLE items ADD COLUMN data_compressed bytea,
+                  ADD CHECK (data IS NULL OR data_compressed IS NULL);
+
+-- Optionally limiting the number of items kept per node.
+ALTER TABLE nodes ADD COLUMN max_items integer CHECK (max_items > 0);
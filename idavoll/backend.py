@@ -13,27 +13,65 @@ a given storage facility. It also provides an adapter from the XMPP
 publish-subscribe protocol.
 """
 
+import time
 import uuid
 
 from zope.interface import implements
 
 from twisted.application import service
 from twisted.python import components, log
-from twisted.internet import defer, reactor
+from twisted.internet import defer, reactor, task
 from twisted.words.protocols.jabber.error import StanzaError
-from twisted.words.xish import utility
+from twisted.words.xish import domish, utility
 
-from wokkel import disco
+from wokkel import disco, shim
 from wokkel.iwokkel import IPubSubResource
-from wokkel.pubsub import PubSubResource, PubSubError
+from wokkel.pubsub import NS_PUBSUB_EVENT, PubSubResource, PubSubError
 
 from idavoll import error, iidavoll
+from idavoll.cache import LRUCache
+from idavoll.codec import SerializedItem
 from idavoll.iidavoll import IBackendService, ILeafNode
+from idavoll.rsm import RSMRequest, RSMResponse, Page
 
-def _getAffiliation(node, entity):
-    d = node.getAffiliation(entity)
-    d.addCallback(lambda affiliation: (node, affiliation))
-    return d
+_RECIPIENT = 'recipient-%s' % uuid.uuid4().hex
+
+
+
+def _parseMaxItems(value):
+    """
+    Parse the value of the C{pubsub#max_items} node option.
+
+    @param value: A positive number, or C{u''} or C{u'max'} for no limit.
+    @type value: C{unicode}
+    @return: The maximum number of items, or C{None} for no limit.
+    @rtype: C{int}
+    @raise error.InvalidConfigurationValue: If the value is invalid.
+    """
+    if value is None or value in ('', 'max'):
+        return None
+
+    try:
+        maxItems = int(value)
+    except ValueError:
+        raise error.InvalidConfigurationValue()
+
+    if maxItems < 1:
+        raise error.InvalidConfigurationValue()
+
+    return maxItems
+
+
+
+def _formatConfiguration(config):
+    """
+    Render a node configuration with values fit for a data form.
+    """
+    maxItems = config.get('pubsub#max_items')
+    if maxItems is not None:
+        config = dict(config)
+        config['pubsub#max_items'] = unicode(maxItems)
+    return config
 
 
 
@@ -46,6 +84,16 @@ class BackendService(service.Service, utility.EventDispatcher):
                        and possible options to choose from.
     @type nodeOptions: C{dict}.
     @cvar defaultConfig: The default node configuration.
+    @ivar affiliationCache: Cache of affiliations by node identifier,
+                            each a dictionary of affiliations by bare JID.
+                            Entries expire after C{affiliationCacheTTL}
+                            seconds, if given, to bound how long changes
+                            made by other processes go unnoticed.
+    @type affiliationCache: L{LRUCache<idavoll.cache.LRUCache>}
+    @ivar partition: The subscribers this service sends publish
+                     notifications to, when several services share the
+                     work, or C{None} to notify all subscribers.
+    @type partition: L{Partition<idavoll.cluster.Partition>}
     """
 
     implements(iidavoll.IBackendService)
@@ -64,6 +112,9 @@ class BackendService(service.Service, utility.EventDispatcher):
                      "never": "Never",
                      "on_sub": "When a new subscription is processed"}
                 },
+            "pubsub#max_items":
+                {"type": "text-single",
+                 "label": "Max # of items to persist"},
             }
 
     subscriptionOptions = {
@@ -81,10 +132,15 @@ class BackendService(service.Service, utility.EventDispatcher):
                 },
             }
 
-    def __init__(self, storage):
+    def __init__(self, storage, affiliationCacheSize=10000, partition=None,
+                       affiliationCacheTTL=None, subscriberIndexSize=1000):
         utility.EventDispatcher.__init__(self)
         self.storage = storage
+        self.affiliationCache = LRUCache(affiliationCacheSize,
+                                         affiliationCacheTTL)
+        self.partition = partition
         self._callbackList = []
+        self._subscriberIndex = LRUCache(subscriberIndexSize)
 
 
     def supportsPublisherAffiliation(self):
@@ -116,9 +172,59 @@ class BackendService(service.Service, utility.EventDispatcher):
         return d
 
 
+    def _getNodeAndAffiliation(self, nodeIdentifier, entity):
+        """
+        Get a node and the affiliation of an entity with it.
+
+        Affiliations are kept in L{affiliationCache}. On a cache hit, only
+        the node is retrieved from storage. Affiliations retrieved for a
+        node already in the cache are added to its entry, which keeps the
+        expiry time of that entry.
+        """
+        def cacheAffiliation(result, affiliations, generation):
+            node, affiliation = result
+            if affiliations is None:
+                self.affiliationCache.set(nodeIdentifier,
+                                          {bareJID: affiliation},
+                                          generation)
+            elif self.affiliationCache.current(nodeIdentifier, generation):
+                affiliations[bareJID] = affiliation
+            return result
+
+        bareJID = entity.userhost()
+        affiliations = self.affiliationCache.get(nodeIdentifier)
+
+        if affiliations is not None and bareJID in affiliations:
+            affiliation = affiliations[bareJID]
+            d = self.storage.getNode(nodeIdentifier)
+            d.addCallback(lambda node: (node, affiliation))
+        else:
+            generation = self.affiliationCache.generation
+            d = self.storage.getNodeAndAffiliation(nodeIdentifier, entity)
+            d.addCallback(cacheAffiliation, affiliations, generation)
+
+        return d
+
+
+    def invalidateAffiliations(self, nodeIdentifier):
+        """
+        Invalidate the cached affiliations with a node.
+
+        This must be called whenever affiliations with a node change.
+
+        @param nodeIdentifier: The identifier of the node, or C{None} to
+                               invalidate the affiliations with all nodes.
+        @type nodeIdentifier: C{unicode}
+        """
+        if nodeIdentifier is None:
+            self.affiliationCache.clear()
+        else:
+            self.affiliationCache.discard(nodeIdentifier)
+
+
     def _makeMetaData(self, metaData):
         options = []
-        for key, value in metaData.iteritems():
+        for key, value in _formatConfiguration(metaData).iteritems():
             if key in self.nodeOptions:
                 option = {"var": key}
                 option.update(self.nodeOptions[key])
@@ -128,20 +234,18 @@ class BackendService(service.Service, utility.EventDispatcher):
         return options
 
 
-    def _checkAuth(self, node, requestor):
-        def check(affiliation, node):
-            if affiliation not in ['owner', 'publisher']:
-                raise error.Forbidden()
-            return node
+    def _checkAuth(self, result):
+        node, affiliation = result
 
-        d = node.getAffiliation(requestor)
-        d.addCallback(check, node)
-        return d
+        if affiliation not in ['owner', 'publisher']:
+            raise error.Forbidden()
+
+        return node
 
 
     def publish(self, nodeIdentifier, items, requestor):
-        d = self.storage.getNode(nodeIdentifier)
-        d.addCallback(self._checkAuth, requestor)
+        d = self._getNodeAndAffiliation(nodeIdentifier, requestor)
+        d.addCallback(self._checkAuth)
         d.addCallback(self._doPublish, items, requestor)
         return d
 
@@ -166,6 +270,9 @@ class BackendService(service.Service, utility.EventDispatcher):
                 if not item.getAttribute("id"):
                     item["id"] = str(uuid.uuid4())
 
+            # Serialize once, for both storage and notifications.
+            items = [SerializedItem.fromElement(item) for item in items]
+
         if persistItems:
             d = node.storeItems(items, requestor)
         else:
@@ -178,34 +285,71 @@ class BackendService(service.Service, utility.EventDispatcher):
 
     def _doNotify(self, result, nodeIdentifier, items, deliverPayloads):
         if items and not deliverPayloads:
-            for item in items:
-                item.children = []
+            items = [domish.Element((None, 'item'),
+                                    attribs={'id': item.getAttribute('id')})
+                     for item in items]
 
         self.dispatch({'items': items, 'nodeIdentifier': nodeIdentifier},
                       '//event/pubsub/notify')
 
 
     def getNotifications(self, nodeIdentifier, items):
+        def toNotifications(index, items):
+            return [(subscriber, subscriptions, items)
+                    for subscriber, subscriptions in index]
+
+        try:
+            index = self._subscriberIndex[nodeIdentifier]
+        except KeyError:
+            d = self._buildSubscriberIndex(nodeIdentifier)
+        else:
+            d = defer.succeed(index)
+
+        d.addCallback(toNotifications, items)
+        return d
+
+
+    def _buildSubscriberIndex(self, nodeIdentifier):
+        """
+        Build and cache the subscriber index for a node.
+
+        The index is a list of tuples (subscriber, subscriptions), holding
+        the subscriptions of each subscriber to either the node itself or the
+        root collection node that should result in notifications for items
+        published to this node. With a L{partition}, only subscribers in
+        that partition are included.
+
+        If the index is invalidated while it is being built, the result is
+        not cached, as it might not reflect the invalidating change.
+
+        At most C{subscriberIndexSize} indexes are cached, evicting those
+        of the least recently published to nodes.
+        """
 
-        def toNotifications(subscriptions, nodeIdentifier, items):
+        def toIndex(subscriptions):
             subsBySubscriber = {}
             for subscription in subscriptions:
+                if (self.partition is not None and
+                    subscription.subscriber not in self.partition):
+                    continue
+
                 if subscription.options.get('pubsub#subscription_type',
                                             'items') == 'items':
                     subs = subsBySubscriber.setdefault(subscription.subscriber,
                                                        set())
                     subs.add(subscription)
 
-            notifications = [(subscriber, subscriptions, items)
-                             for subscriber, subscriptions
-                             in subsBySubscriber.iteritems()]
+            index = subsBySubscriber.items()
 
-            return notifications
+            self._subscriberIndex.set(nodeIdentifier, index, generation)
+            return index
 
         def rootNotFound(failure):
             failure.trap(error.NodeNotFound)
             return []
 
+        generation = self._subscriberIndex.generation
+
         d1 = self.storage.getNode(nodeIdentifier)
         d1.addCallback(lambda node: node.getSubscriptions('subscribed'))
         d2 = self.storage.getNode('')
@@ -213,10 +357,29 @@ class BackendService(service.Service, utility.EventDispatcher):
         d2.addErrback(rootNotFound)
         d = defer.gatherResults([d1, d2])
         d.addCallback(lambda result: result[0] + result[1])
-        d.addCallback(toNotifications, nodeIdentifier, items)
+        d.addCallback(toIndex)
         return d
 
 
+    def invalidateSubscribers(self, nodeIdentifier):
+        """
+        Invalidate the cached subscriber index for a node.
+
+        This must be called whenever the subscriptions to a node change. As
+        subscribers to the root collection node receive notifications for
+        all leaf nodes, changes to its subscriptions invalidate the index
+        of all nodes.
+
+        @param nodeIdentifier: The identifier of the node, or C{None} to
+                               invalidate the index of all nodes.
+        @type nodeIdentifier: C{unicode}
+        """
+        if nodeIdentifier:
+            self._subscriberIndex.discard(nodeIdentifier)
+        else:
+            self._subscriberIndex.clear()
+
+
     def registerNotifier(self, observerfn, *args, **kwargs):
         self.addObserver('//event/pubsub/notify', observerfn, *args, **kwargs)
 
@@ -226,8 +389,7 @@ class BackendService(service.Service, utility.EventDispatcher):
         if subscriberEntity != requestor.userhostJID():
             return defer.fail(error.Forbidden())
 
-        d = self.storage.getNode(nodeIdentifier)
-        d.addCallback(_getAffiliation, subscriberEntity)
+        d = self._getNodeAndAffiliation(nodeIdentifier, subscriberEntity)
         d.addCallback(self._doSubscribe, subscriber)
         return d
 
@@ -248,8 +410,12 @@ class BackendService(service.Service, utility.EventDispatcher):
                 d.addCallback(self._sendLastPublished, node)
             return d
 
+        def added(result):
+            self.invalidateSubscribers(node.nodeIdentifier)
+            return True
+
         d = node.addSubscription(subscriber, 'subscribed', {})
-        d.addCallbacks(lambda _: True, trapExists)
+        d.addCallbacks(added, trapExists)
         d.addCallback(cb)
         return d
 
@@ -282,6 +448,7 @@ class BackendService(service.Service, utility.EventDispatcher):
 
         d = self.storage.getNode(nodeIdentifier)
         d.addCallback(lambda node: node.removeSubscription(subscriber))
+        d.addCallback(lambda _: self.invalidateSubscribers(nodeIdentifier))
         return d
 
 
@@ -302,12 +469,14 @@ class BackendService(service.Service, utility.EventDispatcher):
         config['pubsub#node_type'] = nodeType
 
         d = self.storage.createNode(nodeIdentifier, requestor, config)
+        d.addCallback(lambda _: self.invalidateAffiliations(nodeIdentifier))
         d.addCallback(lambda _: nodeIdentifier)
         return d
 
 
     def getDefaultConfiguration(self, nodeType):
         d = defer.succeed(self.storage.getDefaultConfiguration(nodeType))
+        d.addCallback(_formatConfiguration)
         return d
 
 
@@ -317,6 +486,7 @@ class BackendService(service.Service, utility.EventDispatcher):
 
         d = self.storage.getNode(nodeIdentifier)
         d.addCallback(lambda node: node.getConfiguration())
+        d.addCallback(_formatConfiguration)
 
         return d
 
@@ -325,8 +495,7 @@ class BackendService(service.Service, utility.EventDispatcher):
         if not nodeIdentifier:
             return defer.fail(error.NoRootNode())
 
-        d = self.storage.getNode(nodeIdentifier)
-        d.addCallback(_getAffiliation, requestor)
+        d = self._getNodeAndAffiliation(nodeIdentifier, requestor)
         d.addCallback(self._doSetNodeConfiguration, options)
         return d
 
@@ -337,6 +506,11 @@ class BackendService(service.Service, utility.EventDispatcher):
         if affiliation != 'owner':
             raise error.Forbidden()
 
+        if 'pubsub#max_items' in options:
+            options = dict(options)
+            options['pubsub#max_items'] = _parseMaxItems(
+                    options['pubsub#max_items'])
+
         return node.setConfiguration(options)
 
 
@@ -345,14 +519,14 @@ class BackendService(service.Service, utility.EventDispatcher):
 
 
     def getItems(self, nodeIdentifier, requestor, maxItems=None,
-                       itemIdentifiers=None):
-        d = self.storage.getNode(nodeIdentifier)
-        d.addCallback(_getAffiliation, requestor)
-        d.addCallback(self._doGetItems, maxItems, itemIdentifiers)
+                       itemIdentifiers=None, after=None, before=None):
+        d = self._getNodeAndAffiliation(nodeIdentifier, requestor)
+        d.addCallback(self._doGetItems, maxItems, itemIdentifiers,
+                                        after, before)
         return d
 
 
-    def _doGetItems(self, result, maxItems, itemIdentifiers):
+    def _doGetItems(self, result, maxItems, itemIdentifiers, after, before):
         node, affiliation = result
 
         if not ILeafNode.providedBy(node):
@@ -361,15 +535,36 @@ class BackendService(service.Service, utility.EventDispatcher):
         if affiliation == 'outcast':
             raise error.Forbidden()
 
-        if itemIdentifiers:
+        if maxItems == 0:
+            return []
+        elif itemIdentifiers:
             return node.getItemsById(itemIdentifiers)
+        elif after is not None or before is not None:
+            return node.getItems(maxItems, after, before)
         else:
             return node.getItems(maxItems)
 
 
+    def iterItems(self, nodeIdentifier, requestor, callback, batchSize=100):
+        d = self._getNodeAndAffiliation(nodeIdentifier, requestor)
+        d.addCallback(self._doIterItems, callback, batchSize)
+        return d
+
+
+    def _doIterItems(self, result, callback, batchSize):
+        node, affiliation = result
+
+        if not ILeafNode.providedBy(node):
+            return None
+
+        if affiliation == 'outcast':
+            raise error.Forbidden()
+
+        return node.iterItems(callback, batchSize)
+
+
     def retractItem(self, nodeIdentifier, itemIdentifiers, requestor):
-        d = self.storage.getNode(nodeIdentifier)
-        d.addCallback(_getAffiliation, requestor)
+        d = self._getNodeAndAffiliation(nodeIdentifier, requestor)
         d.addCallback(self._doRetract, itemIdentifiers)
         return d
 
@@ -396,8 +591,7 @@ class BackendService(service.Service, utility.EventDispatcher):
 
 
     def purgeNode(self, nodeIdentifier, requestor):
-        d = self.storage.getNode(nodeIdentifier)
-        d.addCallback(_getAffiliation, requestor)
+        d = self._getNodeAndAffiliation(nodeIdentifier, requestor)
         d.addCallback(self._doPurge)
         return d
 
@@ -436,8 +630,7 @@ class BackendService(service.Service, utility.EventDispatcher):
 
 
     def deleteNode(self, nodeIdentifier, requestor, redirectURI=None):
-        d = self.storage.getNode(nodeIdentifier)
-        d.addCallback(_getAffiliation, requestor)
+        d = self._getNodeAndAffiliation(nodeIdentifier, requestor)
         d.addCallback(self._doPreDelete, redirectURI)
         return d
 
@@ -464,20 +657,93 @@ class BackendService(service.Service, utility.EventDispatcher):
                 dl.extend(r)
 
         d = self.storage.deleteNode(nodeIdentifier)
-        d.addCallback(self._doNotifyDelete, dl)
+        d.addCallback(self._doNotifyDelete, nodeIdentifier, dl)
 
         return d
 
 
-    def _doNotifyDelete(self, result, dl):
+    def _doNotifyDelete(self, result, nodeIdentifier, dl):
+        self.invalidateSubscribers(nodeIdentifier)
+        self.invalidateAffiliations(nodeIdentifier)
         for d in dl:
             d.callback(None)
 
 
 
+class NotificationTemplate(object):
+    """
+    Pre-serialized publish notification.
+
+    The notification for a set of items, as sent to all subscribers that
+    share the same collection headers, only differs in the recipient. This
+    serializes the notification once, and renders it for a particular
+    subscriber by splicing in the escaped recipient address.
+
+    @ivar prefix: The UTF-8 encoded notification up to the recipient.
+    @type prefix: C{str}
+    @ivar suffix: The UTF-8 encoded notification after the recipient.
+    @type suffix: C{str}
+    """
+
+    def __init__(self, service, nodeIdentifier, items, headers=()):
+        message = domish.Element((None, 'message'))
+        message['from'] = service.full()
+        message['to'] = _RECIPIENT
+        event = message.addElement((NS_PUBSUB_EVENT, 'event'))
+        element = event.addElement('items')
+        element['node'] = nodeIdentifier
+        element.children = items
+
+        if headers:
+            message.addChild(shim.Headers(headers))
+
+        xml = message.toXml().encode('utf-8')
+        self.prefix, self.suffix = xml.split(_RECIPIENT, 1)
+
+
+    def render(self, subscriber):
+        """
+        Render the notification for a subscriber.
+
+        @param subscriber: The recipient of the notification.
+        @type subscriber: L{JID<twisted.words.protocols.jabber.jid.JID>}
+        @return: The serialized notification.
+        @rtype: C{str}
+        """
+        recipient = domish.escapeToXml(subscriber.full(), 1).encode('utf-8')
+        return self.prefix + recipient + self.suffix
+
+
+
 class PubSubResourceFromBackend(PubSubResource):
     """
     Adapts a backend to an xmpp publish-subscribe service.
+
+    Publish notifications are sent out cooperatively: the notifications for
+    each publish are sent in chunks of C{fanOutChunkSize}, and no more than
+    C{fanOutTimeBudget} seconds are spent on them per reactor iteration. This
+    keeps large broadcasts from stalling the handling of other requests.
+
+    Item retrieval supports Result Set Management (XEP-0059), with item
+    identifiers as cursors. Results of such requests are returned as
+    L{Page<idavoll.rsm.Page>}s, to be rendered by
+    L{PubSubService<idavoll.rsm.PubSubService>}.
+
+    @ivar fanOutChunkSize: Number of notifications sent between checks of
+                           the time budget.
+    @type fanOutChunkSize: C{int}
+    @ivar fanOutTimeBudget: Maximum time, in seconds, spent on sending out
+                            notifications per reactor iteration.
+    @type fanOutTimeBudget: C{float}
+    @ivar fanOutBacklog: Number of notifications waiting to be sent.
+    @type fanOutBacklog: C{int}
+    @ivar fanOutSent: Number of notifications sent.
+    @type fanOutSent: C{int}
+    @ivar cooperator: The scheduler for sending out notifications.
+    @type cooperator: L{Cooperator<twisted.internet.task.Cooperator>}
+    @ivar defaultPageSize: Maximum number of items returned for result set
+                           requests that do not specify a maximum.
+    @type defaultPageSize: C{int}
     """
 
     features = [
@@ -503,12 +769,17 @@ class PubSubResourceFromBackend(PubSubResource):
 
     pubsubService = None
 
+    fanOutChunkSize = 100
+    fanOutTimeBudget = 0.01
+    defaultPageSize = 100
+
     _errorMap = {
         error.NodeNotFound: ('item-not-found', None, None),
         error.NodeExists: ('conflict', None, None),
         error.Forbidden: ('forbidden', None, None),
         error.ItemForbidden: ('bad-request', 'item-forbidden', None),
         error.ItemRequired: ('bad-request', 'item-required', None),
+        error.ItemNotFound: ('item-not-found', None, None),
         error.NoInstantNodes: ('not-acceptable',
                                'unsupported',
                                'instant-nodes'),
@@ -532,6 +803,10 @@ class PubSubResourceFromBackend(PubSubResource):
 
         self.backend = backend
         self.hideNodes = False
+        self.fanOutBacklog = 0
+        self.fanOutSent = 0
+        self.cooperator = task.Cooperator(
+                terminationPredicateFactory=self._fanOutDeadline)
 
         self.backend.registerNotifier(self._notify)
         self.backend.registerPreDelete(self._preDelete)
@@ -558,10 +833,70 @@ class PubSubResourceFromBackend(PubSubResource):
             subscription = data['subscription']
             d = defer.succeed([(subscription.subscriber, [subscription],
                                 items)])
-        d.addCallback(lambda notifications: self.pubsubService.notifyPublish(
-                                                self.serviceJID,
-                                                nodeIdentifier,
-                                                notifications))
+        d.addCallback(self._notifyPublish, nodeIdentifier)
+
+
+    def _fanOutDeadline(self):
+        """
+        Return a predicate that is true when the fan-out time budget for
+        the current reactor iteration is used up.
+        """
+        deadline = time.time() + self.fanOutTimeBudget
+        return lambda: time.time() >= deadline
+
+
+    def _notifyPublish(self, notifications, nodeIdentifier):
+        """
+        Send out publish notifications.
+
+        The notifications are sent out by L{cooperator}. Subscribers that get
+        the same items with the same collection headers share a
+        L{NotificationTemplate}, so that the payload is serialized only once
+        per publish instead of once per subscriber.
+
+        @return: Deferred that fires when all notifications have been sent.
+        """
+        self.fanOutBacklog += len(notifications)
+        work = self._sendNotifications(notifications, nodeIdentifier)
+        d = self.cooperator.coiterate(work)
+        d.addErrback(log.err)
+        return d
+
+
+    def _sendNotifications(self, notifications, nodeIdentifier):
+        """
+        Send notifications, yielding after every chunk.
+        """
+        templates = {}
+        sent = 0
+
+        try:
+            for subscriber, subscriptions, items in notifications:
+                headers = set()
+                for subscription in subscriptions:
+                    if subscription.nodeIdentifier != nodeIdentifier:
+                        headers.add(('Collection',
+                                     subscription.nodeIdentifier))
+                headers = tuple(sorted(headers))
+
+                key = id(items), headers
+                try:
+                    template = templates[key]
+                except KeyError:
+                    template = NotificationTemplate(self.serviceJID,
+                                                    nodeIdentifier,
+                                                    items, headers)
+                    templates[key] = template
+
+                self.pubsubService.send(template.render(subscriber))
+                self.fanOutBacklog -= 1
+                self.fanOutSent += 1
+                sent += 1
+
+                if sent % self.fanOutChunkSize == 0:
+                    yield None
+        finally:
+            self.fanOutBacklog -= len(notifications) - sent
 
 
     def _preDelete(self, data):
@@ -681,10 +1016,32 @@ class PubSubResourceFromBackend(PubSubResource):
 
 
     def items(self, request):
-        d = self.backend.getItems(request.nodeIdentifier,
-                                  request.sender,
-                                  request.maxItems,
-                                  request.itemIdentifiers)
+        element = getattr(request, 'element', None)
+        if element is not None and element.pubsub is not None:
+            rsm = RSMRequest.fromParent(element.pubsub)
+        else:
+            rsm = None
+
+        if rsm is None or request.itemIdentifiers:
+            d = self.backend.getItems(request.nodeIdentifier,
+                                      request.sender,
+                                      request.maxItems or None,
+                                      request.itemIdentifiers)
+        elif rsm.max == 0:
+            # Only the node and access to it are checked.
+            d = self.backend.getItems(request.nodeIdentifier,
+                                      request.sender,
+                                      0)
+            d.addCallback(lambda items: Page(items, RSMResponse()))
+        else:
+            d = self.backend.getItems(request.nodeIdentifier,
+                                      request.sender,
+                                      rsm.max or self.defaultPageSize,
+                                      None,
+                                      rsm.after,
+                                      rsm.before)
+            d.addCallback(lambda items: Page(items,
+                                             RSMResponse.fromItems(items)))
         return d.addErrback(self._mapErrors)
 
 
@@ -709,3 +1066,27 @@ class PubSubResourceFromBackend(PubSubResource):
 components.registerAdapter(PubSubResourceFromBackend,
                            IBackendService,
                            IPubSubResource)
+
+
+
+class FanOutLogger(object):
+    """
+    Logs the notification backlog of a resource and the number of
+    notifications sent since the previous report.
+
+    @ivar resource: The resource sending out notifications.
+    @type resource: L{PubSubResourceFromBackend}
+    """
+
+    def __init__(self, resource):
+        self.resource = resource
+        self._previous = resource.fanOutSent
+
+
+    def report(self):
+        current = self.resource.fanOutSent
+        previous, self._previous = self._previous, current
+
+        log.msg(format="Notifications: %(backlog)d waiting, %(sent)d sent",
+                backlog=self.resource.fanOutBacklog,
+                sent=current - previous)
@@ -0,0 +1,215 @@
+# -*- test-case-name: idavoll.test.test_cache -*-
+#
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+In-process caches.
+"""
+
+import collections
+
+from twisted.internet import reactor
+
+class LRUCache(object):
+    """
+    Bounded cache that evicts the least recently used entries.
+
+    Entries can optionally expire a given number of seconds after they were
+    stored.
+
+    To prevent caching results that were retrieved before, but arrive after,
+    an invalidation, users can record L{generation} before starting a
+    retrieval, and pass it to L{set} when storing the result. The
+    generation is increased with every invalidation, but only invalidating
+    the same key, or all entries, keeps a result from being stored. The
+    last C{size} invalidations of single keys are remembered for this, and
+    results retrieved before older ones are not stored at all.
+
+    @ivar size: Maximum number of entries. If not positive, nothing is
+                cached.
+    @type size: C{int}
+    @ivar ttl: Number of seconds after which entries expire, or C{None} if
+               entries do not expire.
+    @type ttl: C{float}
+    @ivar hits: Number of successful lookups.
+    @type hits: C{int}
+    @ivar misses: Number of failed lookups.
+    @type misses: C{int}
+    @ivar generation: Invalidation counter.
+    @type generation: C{int}
+    """
+
+    PREV, NEXT, KEY, VALUE, EXPIRES = range(5)
+
+    def __init__(self, size, ttl=None, clock=None):
+        self.size = size
+        self.ttl = ttl
+        self.clock = clock or reactor
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+
+        # Generation after each recent invalidation of a single key, oldest
+        # first, and the generation results must have been retrieved at to
+        # be stored.
+        self._invalidations = collections.OrderedDict()
+        self._oldestGeneration = 0
+
+        # Links of a circular doubly linked list, ordered from least to most
+        # recently used, with the root as sentinel.
+        self._links = {}
+        self._root = []
+        self._root[:] = [self._root, self._root, None, None, None]
+
+
+    def __len__(self):
+        return len(self._links)
+
+
+    def __contains__(self, key):
+        link = self._links.get(key)
+        return link is not None and not self._expired(link)
+
+
+    def __getitem__(self, key):
+        """
+        Look up an entry, marking it as most recently used.
+
+        @raise KeyError: If there is no (unexpired) entry for C{key}.
+        """
+        link = self._links.get(key)
+
+        if link is None or self._expired(link):
+            if link is not None:
+                self._unlink(link)
+            self.misses += 1
+            raise KeyError(key)
+
+        self.hits += 1
+        self._unlink(link)
+        self._append(link)
+        return link[self.VALUE]
+
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+
+    def keys(self):
+        """
+        Return the keys of all entries, including expired ones.
+        """
+        return self._links.keys()
+
+
+    def get(self, key, default=None):
+        """
+        Look up an entry, returning C{default} if there is none.
+        """
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+    def set(self, key, value, generation=None):
+        """
+        Store an entry, possibly evicting the least recently used one.
+
+        @param generation: If given, the entry is only stored if no
+                           invalidation happened since L{generation} had
+                           this value.
+        @type generation: C{int}
+        """
+        if self.size <= 0:
+            return
+
+        if generation is not None and not self.current(key, generation):
+            return
+
+        link = self._links.get(key)
+        if link is not None:
+            self._unlink(link)
+
+        if self.ttl is None:
+            expires = None
+        else:
+            expires = self.clock.seconds() + self.ttl
+
+        link = [None, None, key, value, expires]
+        self._append(link)
+
+        while len(self._links) > self.size:
+            self._unlink(self._root[self.NEXT])
+
+
+    def current(self, key, generation):
+        """
+        Return whether C{key} was not invalidated since L{generation} had
+        the given value.
+
+        @type generation: C{int}
+        @rtype: C{bool}
+        """
+        return (generation >= self._oldestGeneration and
+                generation >= self._invalidations.get(key, 0))
+
+
+    def discard(self, key):
+        """
+        Invalidate the entry for C{key}, if any.
+        """
+        self.generation += 1
+        self._invalidations.pop(key, None)
+        self._invalidations[key] = self.generation
+        if len(self._invalidations) > max(self.size, 1):
+            _, self._oldestGeneration = self._invalidations.popitem(last=False)
+
+        link = self._links.get(key)
+        if link is not None:
+            self._unlink(link)
+
+
+    def clear(self):
+        """
+        Invalidate all entries.
+        """
+        self.generation += 1
+        self._invalidations.clear()
+        self._oldestGeneration = self.generation
+        self._links.clear()
+        self._root[:] = [self._root, self._root, None, None, None]
+
+
+    def hitRate(self):
+        """
+        Return the fraction of lookups that were successful.
+
+        @rtype: C{float}
+        """
+        lookups = self.hits + self.misses
+        if lookups:
+            return float(self.hits) / lookups
+        else:
+            return 0.0
+
+
+    def _expired(self, link):
+        expires = link[self.EXPIRES]
+        return expires is not None and self.clock.seconds() >= expires
+
+
+    def _append(self, link):
+        last = self._root[self.PREV]
+        link[self.PREV] = last
+        link[self.NEXT] = self._root
+        last[self.NEXT] = link
+        self._root[self.PREV] = link
+        self._links[link[self.KEY]] = link
+
+
+    def _unlink(self, link):
+        link[self.PREV][self.NEXT] = link[self.NEXT]
+        link[self.NEXT][self.PREV] = link[self.PREV]
+        del self._links[link[self.KEY]]
@@ -0,0 +1,202 @@
+# -*- test-case-name: idavoll.test.test_cluster -*-
+#
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Sharing the work of a publish-subscribe service between processes.
+
+Several Idavoll processes can serve the same nodes from one PostgreSQL
+database. Events for publishes, retractions and purges happen in the
+process that handled the request. L{EventBus} broadcasts them to the other
+processes, where they are dispatched like local events. Each process sends
+publish notifications only to the subscribers in its own L{Partition}, so
+that notifying the subscribers of a node is spread over all processes.
+"""
+
+import json
+import uuid
+import zlib
+
+from twisted.application import service
+from twisted.python import log
+
+from idavoll.codec import SerializedItem
+
+# Channel for events broadcast between processes.
+EVENT_CHANNEL = 'idavoll_events'
+
+# Maximum length of the chunks events are split into, keeping notification
+# payloads, including a header, below their limit of 8000 bytes.
+CHUNK_SIZE = 7900
+
+NOTIFY = '//event/pubsub/notify'
+RETRACT = '//event/pubsub/retract'
+PURGE = '//event/pubsub/purge'
+
+class Partition(object):
+    """
+    Part of all entities, by a hash of their bare JID.
+
+    @ivar index: The index of this partition, from 0 up to L{size}.
+    @type index: C{int}
+    @ivar size: The number of partitions.
+    @type size: C{int}
+    """
+
+    def __init__(self, index, size):
+        if not 0 <= index < size:
+            raise ValueError("Partition index %d out of range" % index)
+
+        self.index = index
+        self.size = size
+
+
+    def __contains__(self, entity):
+        digest = zlib.crc32(entity.userhost().encode('utf-8')) & 0xffffffff
+        return digest % self.size == self.index
+
+
+
+def _encode(event, data):
+    if event == NOTIFY:
+        return {'event': 'notify',
+                'node': data['nodeIdentifier'],
+                'items': [item.toXml() for item in data['items']]}
+    elif event == RETRACT:
+        return {'event': 'retract',
+                'node': data['nodeIdentifier'],
+                'items': list(data['itemIdentifiers'])}
+    elif event == PURGE:
+        return {'event': 'purge',
+                'node': data}
+
+
+
+def _decode(message):
+    if message['event'] == 'notify':
+        return NOTIFY, {'nodeIdentifier': message['node'],
+                        'items': [SerializedItem(xml)
+                                  for xml in message['items']]}
+    elif message['event'] == 'retract':
+        return RETRACT, {'nodeIdentifier': message['node'],
+                         'itemIdentifiers': message['items']}
+    elif message['event'] == 'purge':
+        return PURGE, message['node']
+
+
+
+class EventBus(service.Service):
+    """
+    Broadcasts the events of a backend to other processes, through
+    PostgreSQL's C{NOTIFY}.
+
+    Publish notifications, retractions and purges dispatched by the backend
+    are sent on L{channel}, and those received from other processes are
+    dispatched by the backend. Notifications of the last published item to
+    a new subscriber are not broadcast.
+
+    Events are encoded as JSON. Those larger than a notification payload
+    are split into chunks, sent in one transaction. The notifications of a
+    transaction are delivered together and in order, so that receivers can
+    join the chunks as they arrive.
+
+    @ivar backend: The backend service.
+    @type backend: L{BackendService<idavoll.backend.BackendService>}
+    @ivar dbpool: Pool of database connections to send events with.
+    @ivar channel: Channel events are sent on.
+    @type channel: C{str}
+    @ivar origin: Identifier of this process in events, to ignore its own.
+    @type origin: C{str}
+    @ivar listener: Listener for events of other processes.
+    @type listener: L{NotificationListener
+                    <idavoll.dbpool.NotificationListener>}
+    """
+
+    def __init__(self, backend, dbpool, channel=EVENT_CHANNEL,
+                 **connectionKeywords):
+        from idavoll.dbpool import NotificationListener
+
+        self.backend = backend
+        self.dbpool = dbpool
+        self.channel = channel
+        self.origin = uuid.uuid4().hex
+        self.listener = NotificationListener(channel,
+                                             self.notificationReceived,
+                                             **connectionKeywords)
+        self._serial = 0
+        self._chunks = {}
+        self._receiving = False
+
+
+    def startService(self):
+        service.Service.startService(self)
+        for event in (NOTIFY, RETRACT, PURGE):
+            self.backend.addObserver(event, self._localEvent, name=event)
+        return self.listener.startService()
+
+
+    def stopService(self):
+        service.Service.stopService(self)
+        for event in (NOTIFY, RETRACT, PURGE):
+            self.backend.removeObserver(event, self._localEvent)
+        self.listener.stopService()
+
+
+    def _localEvent(self, data, name):
+        if self._receiving:
+            return
+
+        if name == NOTIFY and 'subscription' in data:
+            return
+
+        payload = json.dumps(_encode(name, data))
+        self._serial += 1
+        messageId = '%s:%d' % (self.origin, self._serial)
+        chunks = [payload[offset:offset + CHUNK_SIZE]
+                  for offset in xrange(0, len(payload), CHUNK_SIZE)]
+        payloads = ['%s %d %s' % (messageId, len(chunks), chunk)
+                    for chunk in chunks]
+
+        d = self.dbpool.runInteraction(self._send, payloads)
+        d.addErrback(log.err, "Broadcasting event failed")
+
+
+    def _send(self, cursor, payloads):
+        for payload in payloads:
+            yield cursor.execute("""SELECT pg_notify(%s, %s)""",
+                                 (self.channel, payload))
+
+
+    def notificationReceived(self, payload):
+        """
+        Dispatch an event received from another process.
+
+        @param payload: The payload of the notification, or C{None} if
+                        notifications might have been missed.
+        @type payload: C{str}
+        """
+        if payload is None:
+            self._chunks.clear()
+            return
+
+        messageId, count, chunk = payload.split(' ', 2)
+        if messageId.startswith(self.origin + ':'):
+            return
+
+        count = int(count)
+        if count > 1:
+            chunks = self._chunks.setdefault(messageId, [])
+            chunks.append(chunk)
+            if len(chunks) < count:
+                return
+            del self._chunks[messageId]
+            chunk = ''.join(chunks)
+
+        event, data = _decode(json.loads(chunk))
+
+        self._receiving = True
+        try:
+            self.backend.dispatch(data, event)
+        finally:
+            self._receiving = False
@@ -0,0 +1,189 @@
+# -*- test-case-name: idavoll.test.test_codec -*-
+#
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Serialized representation of publish-subscribe items.
+
+Parsing of serialized items goes through L{parse}, which uses one of the
+parsers in L{parsers}, selected with L{setParser}:
+
+ - C{'domish'}, the default, uses L{wokkel.generic.parseXml}, going
+   through the stream oriented parser of L{domish}.
+ - C{'expat'} builds the L{domish.Element} tree directly from
+   L{pyexpat<xml.parsers.expat>} callbacks, which is considerably faster.
+   The resulting trees are equivalent, except that character data directly
+   inside the root element is kept, where the domish parser drops it.
+"""
+
+from xml.parsers import expat
+
+from twisted.words.xish import domish
+
+from wokkel.generic import parseXml, stripNamespace
+
+def parseExpat(data):
+    """
+    Parse serialized XML into a DOM structure, using expat directly.
+
+    @param data: The serialized XML to be parsed, UTF-8 encoded.
+    @type data: C{str}
+    @return: The DOM structure.
+    @rtype: L{domish.Element}
+    @raise domish.ParserError: If C{data} is not well-formed.
+    """
+    roots = []
+    stack = []
+    defaultNsStack = ['']
+    localPrefixes = {}
+
+    def onStartElement(name, attrs):
+        qname = name.rsplit(' ', 1)
+        if len(qname) == 1:
+            qname = ('', name)
+
+        for key in attrs.keys():
+            if ' ' in key:
+                attrs[tuple(key.rsplit(' ', 1))] = attrs.pop(key)
+
+        element = domish.Element(qname, defaultNsStack[-1], attrs,
+                                 localPrefixes.copy())
+        localPrefixes.clear()
+
+        if stack:
+            parent = stack[-1]
+            parent.children.append(element)
+            element.parent = parent
+        else:
+            roots.append(element)
+
+        stack.append(element)
+
+    def onEndElement(name):
+        stack.pop()
+
+    def onCdata(data):
+        if stack:
+            stack[-1].addContent(data)
+
+    def onStartNamespace(prefix, uri):
+        if prefix is None:
+            defaultNsStack.append(uri)
+        else:
+            localPrefixes[prefix] = uri
+
+    def onEndNamespace(prefix):
+        if prefix is None:
+            defaultNsStack.pop()
+
+    parser = expat.ParserCreate('UTF-8', ' ')
+    parser.buffer_text = True
+    parser.StartElementHandler = onStartElement
+    parser.EndElementHandler = onEndElement
+    parser.CharacterDataHandler = onCdata
+    parser.StartNamespaceDeclHandler = onStartNamespace
+    parser.EndNamespaceDeclHandler = onEndNamespace
+
+    try:
+        parser.Parse(data, True)
+    except expat.ExpatError, e:
+        raise domish.ParserError(str(e))
+
+    return roots[0]
+
+
+
+parsers = {
+    'domish': parseXml,
+    'expat': parseExpat,
+}
+
+_parser = parseXml
+
+def setParser(name):
+    """
+    Select the parser used by L{parse}.
+
+    @param name: The name of the parser, one of the keys of L{parsers}.
+    @type name: C{str}
+    @raise ValueError: If there is no parser by this name.
+    """
+    global _parser
+
+    try:
+        _parser = parsers[name]
+    except KeyError:
+        raise ValueError("Unknown XML parser: %r" % (name,))
+
+
+
+def parse(data):
+    """
+    Parse serialized XML into a DOM structure, using the selected parser.
+
+    @param data: The serialized XML to be parsed, UTF-8 encoded.
+    @type data: C{str}
+    @rtype: L{domish.Element}
+    """
+    return _parser(data)
+
+
+
+class SerializedItem(domish.SerializedXML):
+    """
+    Publish-subscribe item kept in its serialized form.
+
+    Items are serialized once when published, and retrieved from storage in
+    serialized form. As a L{domish.SerializedXML}, an item is written out
+    as is when it is part of a L{domish.Element} tree being serialized, so
+    that items can be stored, retrieved and sent without parsing or
+    serializing them again.
+
+    The parsed item is only built when it is accessed through L{element},
+    for example to inspect its attributes. Like with L{domish.Element},
+    attributes can also be accessed by indexing with their name. Items are
+    immutable: changes to L{element} are not reflected in the serialized
+    form.
+    """
+
+    _element = None
+
+    @classmethod
+    def fromElement(Class, element):
+        """
+        Create a serialized item from a parsed item.
+
+        @param element: The item, without namespace.
+        @type element: L{domish.Element}
+        """
+        item = Class(element.toXml())
+        item._element = element
+        return item
+
+
+    @property
+    def element(self):
+        """
+        The parsed item.
+
+        @rtype: L{domish.Element}
+        """
+        if self._element is None:
+            self._element = stripNamespace(parse(self.encode('utf-8')))
+        return self._element
+
+
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            return self.element[key]
+        else:
+            return domish.SerializedXML.__getitem__(self, key)
+
+
+    def toXml(self):
+        return unicode(self)
+
+
+    def getAttribute(self, attribname, default=None):
+        return self.element.getAttribute(attribname, default)
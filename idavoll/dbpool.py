@@ -0,0 +1,965 @@
+# -*- test-case-name: idavoll.test.test_dbpool -*-
+#
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Database connection pools for the PostgreSQL storage.
+
+Interactions with the database are written as generators that yield the
+result of every C{cursor.execute}, like this::
+
+    def _getItems(self, cursor, nodeDbId):
+        yield cursor.execute(\"\"\"SELECT data FROM items
+                                WHERE node_id=%s\"\"\", (nodeDbId,))
+        returnValue(cursor.fetchall())
+
+This allows the same interaction to be run by both pools in this module:
+
+ - L{ConnectionPool} runs interactions in a thread, using blocking
+   connections from L{twisted.enterprise.adbapi}. There, C{cursor.execute}
+   returns when the query has completed.
+ - L{AsyncConnectionPool} runs interactions in the reactor thread, using
+   the asynchronous mode of C{psycopg2}. There, C{cursor.execute} returns
+   a L{Deferred<defer.Deferred>} that fires when the query has completed.
+
+Interactions can also yield other interactions, to run them as part of the
+same transaction, and L{Call}s, to call a function in the reactor thread.
+Like with L{defer.inlineCallbacks}, the result of an interaction is passed
+with L{returnValue}, the counterpart of L{defer.returnValue}. Plain
+functions can be used as interactions,
+too, but only with L{ConnectionPool}.
+
+Both pools keep L{PoolMetrics} on how long interactions wait for a
+connection and how long they take. These can be logged periodically with
+L{MetricsLogger}, and L{PoolSizer} uses them to grow and shrink a
+L{ConnectionPool} with demand.
+
+Read-only interactions can be spread over pools of read replicas with
+L{ReplicaRouter}. L{NotificationListener} receives notifications sent with
+C{NOTIFY}, e.g. by other processes using the same database.
+"""
+
+import collections
+import math
+import threading
+import time
+import types
+
+import psycopg2
+from psycopg2 import extensions
+
+from zope.interface import implements
+
+from twisted.application import service
+from twisted.enterprise import adbapi
+from twisted.internet import defer, interfaces, reactor, threads
+from twisted.python import failure, log
+
+from idavoll.cache import LRUCache
+
+class Call(object):
+    """
+    Request, yielded from an interaction, to call a function in the reactor
+    thread.
+
+    The result of the function, after waiting for it if it is a Deferred,
+    is sent back into the interaction.
+    """
+
+    def __init__(self, f, *args, **kwargs):
+        self.f = f
+        self.args = args
+        self.kwargs = kwargs
+
+
+
+class _Return(BaseException):
+    """
+    Raised by L{returnValue} to end an interaction with a result.
+
+    Like the exception used by L{defer.returnValue}, this does not derive
+    from C{Exception}, so that interactions catching errors do not catch
+    it.
+    """
+
+    def __init__(self, value):
+        BaseException.__init__(self, value)
+        self.value = value
+
+
+
+def returnValue(value):
+    """
+    End the running interaction, passing C{value} as its result.
+    """
+    raise _Return(value)
+
+
+
+@defer.inlineCallbacks
+def _drive(interaction, call):
+    """
+    Run a generator based interaction.
+
+    @param interaction: The running interaction.
+    @type interaction: generator
+    @param call: Function that performs a L{Call} and returns a Deferred.
+    @rtype: L{defer.Deferred}
+    """
+    result = None
+    reason = None
+
+    while True:
+        try:
+            if reason is None:
+                value = interaction.send(result)
+            else:
+                value = reason.throwExceptionIntoGenerator(interaction)
+        except StopIteration:
+            return
+        except _Return, e:
+            defer.returnValue(e.value)
+
+        if isinstance(value, types.GeneratorType):
+            value = _drive(value, call)
+        elif isinstance(value, Call):
+            value = call(value)
+
+        try:
+            result = yield value
+        except Exception:
+            reason = failure.Failure()
+        else:
+            reason = None
+
+
+
+def _callFromThread(call):
+    return defer.maybeDeferred(threads.blockingCallFromThread, reactor,
+                               call.f, *call.args, **call.kwargs)
+
+
+
+def _callInReactor(call):
+    return defer.maybeDeferred(call.f, *call.args, **call.kwargs)
+
+
+
+def _runInThread(cursor, interaction, *args, **kwargs):
+    result = interaction(cursor, *args, **kwargs)
+    if not isinstance(result, types.GeneratorType):
+        return result
+
+    # All queries are blocking here, so the interaction has ended when
+    # _drive returns.
+    outcome = []
+    _drive(result, _callFromThread).addBoth(outcome.append)
+    if isinstance(outcome[0], failure.Failure):
+        outcome[0].raiseException()
+    return outcome[0]
+
+
+
+Snapshot = collections.namedtuple('Snapshot', ['queued', 'active',
+                                                'started', 'interactions',
+                                                'waitTime',
+                                                'interactionTime'])
+
+
+
+class PoolMetrics(object):
+    """
+    Load statistics of a connection pool.
+
+    The counters are updated from the threads interactions run in, and read
+    from the reactor thread through L{snapshot}.
+
+    @ivar queued: Number of interactions waiting for a connection.
+    @type queued: C{int}
+    @ivar active: Number of interactions holding a connection.
+    @type active: C{int}
+    @ivar started: Number of interactions that got a connection.
+    @type started: C{int}
+    @ivar interactions: Number of interactions that have ended.
+    @type interactions: C{int}
+    @ivar waitTime: Total time interactions waited for a connection, in
+                    seconds.
+    @type waitTime: C{float}
+    @ivar interactionTime: Total time spent in interactions, in seconds.
+    @type interactionTime: C{float}
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.active = 0
+        self.started = 0
+        self.interactions = 0
+        self.waitTime = 0.0
+        self.interactionTime = 0.0
+
+
+    def queue(self):
+        """
+        Record that an interaction waits for a connection.
+        """
+        with self._lock:
+            self.queued += 1
+
+
+    def abandon(self):
+        """
+        Record that a waiting interaction failed to get a connection.
+        """
+        with self._lock:
+            self.queued -= 1
+
+
+    def start(self, waitTime):
+        """
+        Record that a waiting interaction got a connection.
+
+        @param waitTime: Time waited for the connection, in seconds.
+        @type waitTime: C{float}
+        """
+        with self._lock:
+            self.queued -= 1
+            self.active += 1
+            self.started += 1
+            self.waitTime += waitTime
+
+
+    def finish(self, interactionTime):
+        """
+        Record that an interaction has ended.
+
+        @param interactionTime: Time spent in the interaction, in seconds.
+        @type interactionTime: C{float}
+        """
+        with self._lock:
+            self.active -= 1
+            self.interactions += 1
+            self.interactionTime += interactionTime
+
+
+    def snapshot(self):
+        """
+        Return the current values of all counters.
+
+        @rtype: L{Snapshot}
+        """
+        with self._lock:
+            return Snapshot(self.queued, self.active, self.started,
+                            self.interactions, self.waitTime,
+                            self.interactionTime)
+
+
+
+class ConnectionPool(adbapi.ConnectionPool):
+    """
+    Pool of blocking database connections, used from a thread pool.
+
+    This is a L{adbapi.ConnectionPool} that also runs generator based
+    interactions. Each thread of the pool has a connection of its own, so
+    the number of threads, between C{min} and C{max}, is the number of
+    connections.
+
+    @ivar metrics: Load statistics of this pool.
+    @type metrics: L{PoolMetrics}
+    """
+
+    def __init__(self, *args, **kwargs):
+        adbapi.ConnectionPool.__init__(self, *args, **kwargs)
+        self.metrics = PoolMetrics()
+
+
+    @property
+    def size(self):
+        """
+        The current maximum number of connections.
+        """
+        return self.threadpool.max
+
+
+    def resize(self, size):
+        """
+        Change the maximum number of connections.
+
+        The size is kept between C{min} and C{max}. When shrinking, threads
+        stop after finishing the interactions queued before them.
+        Their connections are closed by L{reapConnections}.
+        """
+        size = max(self.min, min(self.max, size))
+        self.threadpool.adjustPoolsize(self.min, size)
+        self.reapConnections()
+
+
+    def reapConnections(self):
+        """
+        Close the connections of threads that have stopped.
+        """
+        alive = set(thread.ident for thread in threading.enumerate())
+        for tid, connection in self.connections.items():
+            if tid not in alive:
+                del self.connections[tid]
+                self._close(connection)
+
+
+    def runInteraction(self, interaction, *args, **kwargs):
+        self.metrics.queue()
+        return threads.deferToThreadPool(self._reactor, self.threadpool,
+                                         self._runMeasured, time.time(),
+                                         interaction, args, kwargs)
+
+
+    def _runMeasured(self, queuedAt, interaction, args, kwargs):
+        started = time.time()
+        self.metrics.start(started - queuedAt)
+        try:
+            return self._runInteraction(_runInThread, interaction,
+                                        *args, **kwargs)
+        finally:
+            self.metrics.finish(time.time() - started)
+
+
+
+def _runQuery(cursor, *args, **kwargs):
+    yield cursor.execute(*args, **kwargs)
+    returnValue(cursor.fetchall())
+
+
+
+def _runOperation(cursor, *args, **kwargs):
+    yield cursor.execute(*args, **kwargs)
+
+
+
+class _Connection(object):
+    """
+    Asynchronous database connection, watched by the reactor.
+
+    @ivar connection: The underlying C{psycopg2} connection.
+    @ivar deferred: Deferred that fires when the pending operation has
+                    completed, or C{None} if there is none.
+    """
+
+    implements(interfaces.IReadDescriptor, interfaces.IWriteDescriptor)
+
+    deferred = None
+
+    def __init__(self, reactor, connection):
+        self.reactor = reactor
+        self.connection = connection
+
+
+    def fileno(self):
+        # The descriptor is watched while the connection is still open.
+        return self._fileno
+
+
+    def logPrefix(self):
+        return 'AsyncConnectionPool'
+
+
+    def wait(self):
+        """
+        Wait for the pending operation on the connection to complete.
+
+        @rtype: L{defer.Deferred}
+        """
+        self._fileno = self.connection.fileno()
+        d = self.deferred = defer.Deferred()
+        self.poll()
+        return d
+
+
+    def poll(self):
+        try:
+            state = self.connection.poll()
+        except Exception:
+            self._done(failure.Failure())
+            return
+
+        if state == extensions.POLL_OK:
+            self._done(None)
+        elif state == extensions.POLL_READ:
+            self.reactor.removeWriter(self)
+            self.reactor.addReader(self)
+        elif state == extensions.POLL_WRITE:
+            self.reactor.removeReader(self)
+            self.reactor.addWriter(self)
+
+
+    def _done(self, result):
+        self.reactor.removeReader(self)
+        self.reactor.removeWriter(self)
+        d, self.deferred = self.deferred, None
+        d.callback(result)
+
+
+    doRead = poll
+    doWrite = poll
+
+
+    def connectionLost(self, reason):
+        if self.deferred is not None:
+            self._done(reason)
+
+
+    def close(self):
+        if not self.connection.closed:
+            self.connection.close()
+
+
+
+class _Cursor(object):
+    """
+    Cursor on an asynchronous connection.
+
+    This wraps a C{psycopg2} cursor, such that L{execute} returns a
+    Deferred that fires when the query has completed.
+
+    Asynchronous connections are always in autocommit mode, so the cursor
+    starts a transaction itself. To save a round trip, this is done along
+    with the first query.
+
+    @ivar inTransaction: Whether a transaction has been started.
+    @type inTransaction: C{bool}
+    """
+
+    inTransaction = False
+
+    def __init__(self, pool, connection):
+        self._pool = pool
+        self._connection = connection
+        self._cursor = connection.connection.cursor()
+
+
+    def execute(self, query, args=None):
+        if not self.inTransaction:
+            self.inTransaction = True
+            query = "BEGIN; " + query
+        self._cursor.execute(query, args)
+        return self._connection.wait()
+
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+
+class AsyncConnectionPool(object):
+    """
+    Pool of asynchronous database connections, used from the reactor.
+
+    Connections are made when needed, up to L{size} connections. Each
+    interaction runs on a connection of its own, in a transaction that is
+    committed when the interaction returns and rolled back when it fails.
+    When all connections are in use, interactions wait for one to become
+    available. Connections that break are discarded.
+
+    @ivar size: Maximum number of connections.
+    @type size: C{int}
+    @ivar connectionKeywords: Keyword arguments passed to
+                              C{psycopg2.connect}.
+    @type connectionKeywords: C{dict}
+    @ivar metrics: Load statistics of this pool.
+    @type metrics: L{PoolMetrics}
+    """
+
+    dbapi = psycopg2
+
+    def __init__(self, size=10, reactor=reactor, **connectionKeywords):
+        self.size = size
+        self.reactor = reactor
+        self.connectionKeywords = connectionKeywords
+        self.running = False
+        self.metrics = PoolMetrics()
+
+        self._connections = set()
+        self._connecting = 0
+        self._idle = []
+        self._waiting = collections.deque()
+
+        # Like adbapi.ConnectionPool, start and stop along with the reactor.
+        self.reactor.callWhenRunning(self.start)
+        self.reactor.addSystemEventTrigger('during', 'shutdown', self.close)
+
+
+    def start(self):
+        self.running = True
+
+
+    def close(self):
+        """
+        Close all idle connections, and others as they become idle.
+        """
+        self.running = False
+        while self._idle:
+            self._discard(self._idle.pop())
+
+
+    def connect(self):
+        """
+        Make a new connection.
+
+        @return: Deferred that fires with the L{_Connection} once
+                 connected.
+        """
+        kwargs = dict(self.connectionKeywords, async_=1)
+        try:
+            connection = _Connection(self.reactor,
+                                     psycopg2.connect(**kwargs))
+        except Exception:
+            return defer.fail()
+
+        d = connection.wait()
+        d.addCallback(lambda _: connection)
+        return d
+
+
+    def _acquire(self):
+        if self._idle:
+            return defer.succeed(self._idle.pop())
+        elif len(self._connections) + self._connecting < self.size:
+            self._connecting += 1
+            d = self.connect()
+            d.addCallbacks(self._connected, self._connectFailed)
+            return d
+        else:
+            d = defer.Deferred()
+            self._waiting.append(d)
+            return d
+
+
+    def _connected(self, connection):
+        self._connecting -= 1
+        self._connections.add(connection)
+        return connection
+
+
+    def _connectFailed(self, reason):
+        self._connecting -= 1
+        self._serveWaiting()
+        return reason
+
+
+    def _serveWaiting(self):
+        """
+        Let the first waiting interaction try to get a new connection.
+        """
+        if self._waiting and self.running:
+            self._acquire().chainDeferred(self._waiting.popleft())
+
+
+    def _release(self, connection):
+        if connection.connection.closed or not self.running:
+            self._discard(connection)
+            self._serveWaiting()
+        elif self._waiting:
+            self._waiting.popleft().callback(connection)
+        else:
+            self._idle.append(connection)
+
+
+    def _discard(self, connection):
+        self._connections.discard(connection)
+        connection.close()
+
+
+    def runInteraction(self, interaction, *args, **kwargs):
+        """
+        Run a generator based interaction in a transaction.
+
+        @return: Deferred that fires with the result of the interaction.
+        """
+        self.metrics.queue()
+        d = self._acquire()
+        d.addCallbacks(self._runInteraction, self._acquireFailed,
+                       callbackArgs=(time.time(), interaction, args, kwargs))
+        return d
+
+
+    def _acquireFailed(self, reason):
+        self.metrics.abandon()
+        return reason
+
+
+    @defer.inlineCallbacks
+    def _runInteraction(self, connection, queuedAt, interaction, args,
+                        kwargs):
+        started = time.time()
+        self.metrics.start(started - queuedAt)
+        try:
+            cursor = _Cursor(self, connection)
+            try:
+                result = yield _drive(interaction(cursor, *args, **kwargs),
+                                      _callInReactor)
+                if cursor.inTransaction:
+                    yield cursor.execute("COMMIT")
+            except Exception:
+                reason = failure.Failure()
+                if cursor.inTransaction and not connection.connection.closed:
+                    try:
+                        yield cursor.execute("ROLLBACK")
+                    except Exception:
+                        log.err(None, "Rollback failed")
+                        connection.close()
+                reason.raiseException()
+        finally:
+            self.metrics.finish(time.time() - started)
+            self._release(connection)
+
+        defer.returnValue(result)
+
+
+    def runQuery(self, *args, **kwargs):
+        return self.runInteraction(_runQuery, *args, **kwargs)
+
+
+    def runOperation(self, *args, **kwargs):
+        return self.runInteraction(_runOperation, *args, **kwargs)
+
+
+
+class MetricsLogger(object):
+    """
+    Logs the load of a connection pool since the previous report.
+
+    @ivar pool: The connection pool.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self._previous = pool.metrics.snapshot()
+
+
+    def report(self):
+        current = self.pool.metrics.snapshot()
+        previous, self._previous = self._previous, current
+
+        started = current.started - previous.started
+        interactions = current.interactions - previous.interactions
+        waitTime = current.waitTime - previous.waitTime
+        interactionTime = current.interactionTime - previous.interactionTime
+
+        log.msg(format="Database pool: %(size)d connections, "
+                       "%(active)d active, %(queued)d queued, "
+                       "%(interactions)d interactions, "
+                       "average wait %(wait).1f ms, "
+                       "average interaction %(interaction).1f ms",
+                size=self.pool.size,
+                active=current.active,
+                queued=current.queued,
+                interactions=interactions,
+                wait=started and waitTime / started * 1000,
+                interaction=(interactions and
+                             interactionTime / interactions * 1000))
+
+
+
+class PoolSizer(object):
+    """
+    Grows and shrinks a L{ConnectionPool} with demand.
+
+    L{adjust} is to be called periodically. The pool grows by the number of
+    waiting interactions when interactions had to wait for a connection,
+    up to the C{max} of the pool. When fewer connections than available
+    were busy for C{idleChecks} checks in a row, the pool shrinks by one,
+    down to the C{min} of the pool.
+
+    The pool starts at its minimum size.
+
+    @ivar pool: The connection pool.
+    @type pool: L{ConnectionPool}
+    @ivar waitThreshold: Average time, in seconds, interactions may wait
+                         for a connection before the pool grows.
+    @type waitThreshold: C{float}
+    @ivar idleChecks: Number of checks with unused connections after which
+                      the pool shrinks.
+    @type idleChecks: C{int}
+    """
+
+    def __init__(self, pool, waitThreshold=0.005, idleChecks=10,
+                 clock=reactor):
+        self.pool = pool
+        self.waitThreshold = waitThreshold
+        self.idleChecks = idleChecks
+        self.clock = clock
+
+        self._idle = 0
+        self._previous = pool.metrics.snapshot()
+        self._checked = clock.seconds()
+        pool.resize(pool.min)
+
+
+    def adjust(self):
+        current = self.pool.metrics.snapshot()
+        now = self.clock.seconds()
+        previous, self._previous = self._previous, current
+        elapsed, self._checked = now - self._checked, now
+
+        started = current.started - previous.started
+        waitTime = current.waitTime - previous.waitTime
+        interactionTime = current.interactionTime - previous.interactionTime
+
+        size = self.pool.size
+        if current.queued or (started and
+                              waitTime / started > self.waitThreshold):
+            self._idle = 0
+            newSize = size + max(1, current.queued)
+        else:
+            # The average number of connections in use, in the past period.
+            busy = current.active
+            if elapsed > 0:
+                busy = max(busy, int(math.ceil(interactionTime / elapsed)))
+
+            if busy < size:
+                self._idle += 1
+            else:
+                self._idle = 0
+
+            if self._idle >= self.idleChecks:
+                self._idle = 0
+                newSize = size - 1
+            else:
+                newSize = size
+
+        self.pool.resize(newSize)
+        if self.pool.size != size:
+            log.msg(format="Resized database pool from %(old)d to "
+                           "%(new)d connections",
+                    old=size, new=self.pool.size)
+
+
+
+# Key recorded by ReplicaRouter.wroteAll.
+_ALL_KEY = ('all',)
+
+class ReplicaRouter(object):
+    """
+    Routes read-only interactions to pools of read replicas.
+
+    Replicas lag behind the primary, so reads that should see a recent write
+    are sent to the primary. For this, writes are recorded with L{wrote},
+    by keys that describe what was written, e.g. a node or an entity.
+    Reads are run with the keys of what they depend on, and go to the
+    primary when any of those was written to in the past C{stickiness}
+    seconds.
+
+    Other reads go to one of the replicas, picked in turn (C{round-robin})
+    or by the lowest number of queued and active interactions, with ties
+    broken in turn (C{least-loaded}). When a replica fails with an
+    C{OperationalError}, the interaction is retried on the primary.
+
+    @ivar primary: Pool of connections to the primary.
+    @ivar replicas: Pools of connections to the replicas.
+    @type replicas: C{list}
+    @ivar policy: Policy to pick a replica, one of L{policies}.
+    @type policy: C{str}
+    @ivar pinned: Keys written to recently.
+    @type pinned: L{LRUCache}
+    """
+
+    policies = ('round-robin', 'least-loaded')
+
+    def __init__(self, primary, replicas, policy='round-robin', stickiness=5,
+                 pinnedSize=10000, clock=None):
+        if policy not in self.policies:
+            raise ValueError("Unknown replica policy %r" % (policy,))
+
+        self.primary = primary
+        self.replicas = list(replicas)
+        self.policy = policy
+        self.pinned = LRUCache(pinnedSize, stickiness, clock)
+        self._next = 0
+
+
+    def wrote(self, *keys):
+        """
+        Record a write, sending reads depending on it to the primary.
+        """
+        if self.replicas:
+            for key in keys:
+                self.pinned[key] = True
+
+
+    def wroteAll(self):
+        """
+        Record a write to anything, sending all reads to the primary.
+        """
+        self.wrote(_ALL_KEY)
+
+
+    def choose(self, keys):
+        """
+        Pick the pool to run a read depending on the given keys on.
+        """
+        if not self.replicas:
+            return self.primary
+
+        if _ALL_KEY in self.pinned:
+            return self.primary
+
+        for key in keys:
+            if key in self.pinned:
+                return self.primary
+
+        start = self._next
+        self._next = (start + 1) % len(self.replicas)
+        if self.policy == 'round-robin':
+            return self.replicas[start]
+        else:
+            candidates = self.replicas[start:] + self.replicas[:start]
+            return min(candidates, key=self._load)
+
+
+    def _load(self, pool):
+        metrics = pool.metrics
+        return metrics.queued + metrics.active
+
+
+    def runInteraction(self, keys, interaction, *args, **kwargs):
+        """
+        Run a read-only interaction.
+
+        @param keys: Keys of what the interaction reads.
+        @return: Deferred that fires with the result of the interaction.
+        """
+        pool = self.choose(keys)
+        d = pool.runInteraction(interaction, *args, **kwargs)
+        if pool is not self.primary:
+            d.addErrback(self._replicaFailed, pool, interaction, args,
+                         kwargs)
+        return d
+
+
+    def _replicaFailed(self, reason, pool, interaction, args, kwargs):
+        reason.trap(pool.dbapi.OperationalError)
+        log.err(reason, "Read from replica failed, retrying on primary")
+        return self.primary.runInteraction(interaction, *args, **kwargs)
+
+
+    def runQuery(self, keys, *args, **kwargs):
+        return self.runInteraction(keys, _runQuery, *args, **kwargs)
+
+
+
+class NotificationListener(service.Service):
+    """
+    Listens for notifications on a channel, on an asynchronous connection
+    of its own.
+
+    The payload of every notification is passed to C{callback}. When the
+    connection is lost, a new one is made after C{retryDelay} seconds. As
+    notifications might have been missed, C{callback} is then called with
+    C{None}, like it is when listening starts.
+
+    @ivar channel: The name of the channel.
+    @type channel: C{str}
+    @ivar callback: Called with the payload of every notification.
+    @ivar retryDelay: Seconds to wait before reconnecting.
+    @type retryDelay: C{float}
+    @ivar connectionKeywords: Keyword arguments passed to
+                              C{psycopg2.connect}.
+    @type connectionKeywords: C{dict}
+    """
+
+    implements(interfaces.IReadDescriptor)
+
+    _connection = None
+    _fileno = -1
+    _retry = None
+
+    def __init__(self, channel, callback, retryDelay=1, reactor=reactor,
+                 **connectionKeywords):
+        self.channel = channel
+        self.callback = callback
+        self.retryDelay = retryDelay
+        self.reactor = reactor
+        self.connectionKeywords = connectionKeywords
+
+
+    def startService(self):
+        service.Service.startService(self)
+        return self._listen()
+
+
+    def stopService(self):
+        service.Service.stopService(self)
+        if self._retry is not None and self._retry.active():
+            self._retry.cancel()
+        self._disconnect()
+
+
+    def fileno(self):
+        return self._fileno
+
+
+    def logPrefix(self):
+        return 'NotificationListener'
+
+
+    @defer.inlineCallbacks
+    def _listen(self):
+        self._retry = None
+        kwargs = dict(self.connectionKeywords, async_=1)
+        try:
+            connection = _Connection(self.reactor, psycopg2.connect(**kwargs))
+            self._connection = connection
+            yield connection.wait()
+            cursor = connection.connection.cursor()
+            cursor.execute("LISTEN %s" % extensions.quote_ident(self.channel,
+                                                               cursor))
+            yield connection.wait()
+        except Exception:
+            log.err(None, "Listening for notifications failed")
+            self._reconnect()
+            return
+
+        if not self.running or self._connection is not connection:
+            return
+
+        self._fileno = connection.connection.fileno()
+        self.reactor.addReader(self)
+        self.callback(None)
+
+
+    def doRead(self):
+        connection = self._connection.connection
+        try:
+            connection.poll()
+        except Exception:
+            log.err(None, "Connection for notifications failed")
+            self._reconnect()
+            return
+
+        while connection.notifies:
+            notify = connection.notifies.pop(0)
+            try:
+                self.callback(notify.payload)
+            except Exception:
+                log.err(None, "Handling notification failed")
+
+
+    def connectionLost(self, reason):
+        self._reconnect()
+
+
+    def _disconnect(self):
+        if self._connection is not None:
+            # Stop watching the connection, whether or not still connecting.
+            self.reactor.removeReader(self)
+            self.reactor.removeReader(self._connection)
+            self.reactor.removeWriter(self._connection)
+            self._connection.close()
+            self._connection = None
+            self._fileno = -1
+
+
+    def _reconnect(self):
+        self._disconnect()
+        if self.running:
+            self._retry = self.reactor.callLater(self.retryDelay,
+                                                 self._listen)
@@ -52,6 +52,13 @@ class ItemRequired(Error):
 
 
 
+class ItemNotFound(Error):
+    """
+    The item does not exist.
+    """
+
+
+
 class NoInstantNodes(Error):
     pass
 
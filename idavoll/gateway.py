@@ -28,7 +28,7 @@ from wokkel.generic import parseXml
 from wokkel.pubsub import Item
 from wokkel.pubsub import PubSubClient
 
-from idavoll import error
+from idavoll import codec, error
 
 NS_ATOM = 'http://www.w3.org/2005/Atom'
 MIME_ATOM_ENTRY = b'application/atom+xml;type=entry'
@@ -279,7 +279,7 @@ class PublishResource(resource.Resource):
                         "Malformed XMPP URI: %s" % failure.value)
 
         self.checkMediaType(request)
-        payload = parseXml(request.content.read())
+        payload = codec.parse(request.content.read())
         d = getNode()
         d.addCallback(gotNode, payload)
         d.addCallback(toResponse)
@@ -199,17 +199,31 @@ class IBackendService(Interface):
         """
 
 
-    def getItems(nodeIdentifier, requestor, maxItems=None, itemIdentifiers=[]):
+    def getItems(nodeIdentifier, requestor, maxItems=None, itemIdentifiers=[],
+                 after=None, before=None):
         """ Retrieve items from persistent storage
 
-        If C{maxItems} is given, return the C{maxItems} last published
-        items, else if C{itemIdentifiers} is not empty, return the items
-        requested.  If neither is given, return all items.
+        If C{itemIdentifiers} is not empty, return the items requested.
+        Otherwise, if C{maxItems} is given, return the C{maxItems} last
+        published items, else return all items. A C{maxItems} of C{0} only
+        checks that the items may be retrieved. C{after} and C{before}
+        select a page of items, see L{ILeafNode.getItems}.
 
         @return: a deferred that returns the requested items
         """
 
 
+    def iterItems(nodeIdentifier, requestor, callback, batchSize=100):
+        """
+        Retrieve all items of a node in batches.
+
+        See L{ILeafNode.iterItems}.
+
+        @return: a deferred that fires when all items have been passed to
+                 C{callback}.
+        """
+
+
     def retractItem(nodeIdentifier, itemIdentifier, requestor):
         """ Removes item in node from persistent storage """
 
@@ -231,6 +245,24 @@ class IStorage(Interface):
         """
 
 
+    def getNodeAndAffiliation(nodeIdentifier, entity):
+        """
+        Get Node and the affiliation of an entity with it.
+
+        This combines L{getNode} and L{INode.getAffiliation}, allowing
+        implementations to retrieve both at once. The passed entity is
+        stripped of the resource by the implementation.
+
+        @param nodeIdentifier: NodeID of the desired node.
+        @type nodeIdentifier: C{unicode}
+        @param entity: JID of the entity.
+        @type entity: L{JID<twisted.words.protocols.jabber.jid.JID>}
+        @return: deferred that returns a tuple of a L{INode} providing object
+                 and the entity's affiliation: C{'owner'}, C{'publisher'},
+                 C{'outcast'} or C{None}.
+        """
+
+
     def getNodeIds():
         """
         Return all NodeIDs.
@@ -465,10 +497,15 @@ class ILeafNode(Interface):
         """
         Store items in persistent storage for later retrieval.
 
+        If the node's C{pubsub#max_items} option is set, the oldest items
+        beyond that number are removed.
+
         @param items: The list of items to be stored. Each item is the
                       L{domish} representation of the XML fragment as defined
                       for C{<item/>} in the
-                      C{http://jabber.org/protocol/pubsub} namespace.
+                      C{http://jabber.org/protocol/pubsub} namespace, or its
+                      serialization as a
+                      L{SerializedItem<idavoll.codec.SerializedItem>}.
         @type items: C{list} of {domish.Element}
         @param publisher: JID of the publishing entity.
         @type publisher: L{JID<twisted.words.protocols.jabber.jid.JID>}
@@ -486,18 +523,50 @@ class ILeafNode(Interface):
         """
 
 
-    def getItems(maxItems=None):
+    def getItems(maxItems=None, after=None, before=None):
         """
         Get items.
 
-        If C{maxItems} is not given, all items in the node are returned,
-        just like C{getItemsById}. Otherwise, C{maxItems} limits
-        the returned items to a maximum of that number of most recently
-        published items.
+        Items are returned from the most recently to the least recently
+        published item. If C{maxItems} is not given, all items in the node
+        are returned, just like C{getItemsById}. Otherwise, C{maxItems}
+        limits the returned items to a maximum of that number of most
+        recently published items.
+
+        The items can be paged through using item identifiers as cursors.
+        If C{after} is given, only items published before that item are
+        considered. If C{before} is given, only items published after that
+        item are considered, and C{maxItems} limits the returned items to
+        the least recently published ones. If C{before} is the empty
+        string, this yields the least recently published items in the node.
 
         @param maxItems: if given, a natural number (>0) that limits the
                           returned number of items.
-        @return: deferred that fires with a C{list} of found items.
+        @param after: Identifier of the item the returned items precede.
+        @type after: C{unicode}
+        @param before: Identifier of the item the returned items follow, or
+                       the empty string.
+        @type before: C{unicode}
+        @return: deferred that fires with a C{list} of found items. Fails
+                 with L{ItemNotFound<idavoll.error.ItemNotFound>} if
+                 C{after} or C{before} refer to an item that does not exist.
+        """
+
+
+    def iterItems(callback, batchSize=100):
+        """
+        Get all items, in batches.
+
+        Instead of collecting all items in the node at once, C{callback} is
+        called with a C{list} of at most C{batchSize} items at a time, from
+        the most recently to the least recently published item. If
+        C{callback} returns a deferred, the next batch is not retrieved
+        until it has fired.
+
+        @param callback: Callable taking a C{list} of items.
+        @param batchSize: The maximum number of items per batch.
+        @type batchSize: C{int}
+        @return: deferred that fires when all batches have been handled.
         """
 
 
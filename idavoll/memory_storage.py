@@ -2,6 +2,8 @@
 # See LICENSE for details.
 
 import copy
+from collections import deque
+
 from zope.interface import implements
 from twisted.internet import defer
 from twisted.words.protocols.jabber import jid
@@ -19,6 +21,7 @@ class Storage:
                 "pubsub#persist_items": True,
                 "pubsub#deliver_payloads": True,
                 "pubsub#send_last_published_item": 'on_sub',
+                "pubsub#max_items": None,
             },
             'collection': {
                 "pubsub#deliver_payloads": True,
@@ -41,6 +44,16 @@ class Storage:
         return defer.succeed(node)
 
 
+    def getNodeAndAffiliation(self, nodeIdentifier, entity):
+        try:
+            node = self._nodes[nodeIdentifier]
+        except KeyError:
+            return defer.fail(error.NodeNotFound())
+
+        affiliation = node._affiliations.get(entity.userhost())
+        return defer.succeed((node, affiliation))
+
+
     def getNodeIds(self):
         return defer.succeed(self._nodes.keys())
 
@@ -209,7 +222,7 @@ class LeafNode(Node):
     def __init__(self, nodeIdentifier, owner, config):
         Node.__init__(self, nodeIdentifier, owner, config)
         self._items = {}
-        self._itemlist = []
+        self._itemlist = deque()
 
 
     def storeItems(self, items, publisher):
@@ -221,6 +234,13 @@ class LeafNode(Node):
             self._items[itemIdentifier] = item
             self._itemlist.append(item)
 
+        # Items are kept as a ring buffer, dropping the oldest.
+        maxItems = self._config.get("pubsub#max_items")
+        if maxItems is not None:
+            while len(self._itemlist) > maxItems:
+                item = self._itemlist.popleft()
+                del self._items[item.element["id"]]
+
         return defer.succeed(None)
 
 
@@ -240,14 +260,39 @@ class LeafNode(Node):
         return defer.succeed(deleted)
 
 
-    def getItems(self, maxItems=None):
+    def getItems(self, maxItems=None, after=None, before=None):
+        itemList = list(reversed(self._itemlist))
+
+        try:
+            if after is not None:
+                index = itemList.index(self._items[after])
+                itemList = itemList[index + 1:]
+            elif before:
+                index = itemList.index(self._items[before])
+                itemList = itemList[:index]
+        except KeyError:
+            return defer.fail(error.ItemNotFound())
+
         if maxItems:
-            itemList = self._itemlist[-maxItems:]
-        else:
-            itemList = self._itemlist
+            if before is not None:
+                itemList = itemList[-maxItems:]
+            else:
+                itemList = itemList[:maxItems]
+
         return defer.succeed([item.element for item in itemList])
 
 
+    def iterItems(self, callback, batchSize=100):
+        itemList = [item.element for item in reversed(self._itemlist)]
+
+        d = defer.succeed(None)
+        for start in xrange(0, len(itemList), batchSize):
+            batch = itemList[start:start + batchSize]
+            d.addCallback(lambda _, batch=batch: callback(batch))
+        d.addCallback(lambda _: None)
+        return d
+
+
     def getItemsById(self, itemIdentifiers):
         items = []
         for itemIdentifier in itemIdentifiers:
@@ -262,7 +307,7 @@ class LeafNode(Node):
 
     def purge(self):
         self._items = {}
-        self._itemlist = []
+        self._itemlist = deque()
 
         return defer.succeed(None)
 
@@ -2,17 +2,129 @@
 # See LICENSE for details.
 
 import copy
+import json
+import uuid
+import zlib
 
 from zope.interface import implements
 
+from twisted.application import service
+from twisted.internet import defer, reactor
+from twisted.python import failure
 from twisted.words.protocols.jabber import jid
 
-from wokkel.generic import parseXml, stripNamespace
 from wokkel.pubsub import Subscription
 
 from idavoll import error, iidavoll
+from idavoll.cache import LRUCache
+from idavoll.codec import SerializedItem
+from idavoll.dbpool import Call, ReplicaRouter, returnValue
+
+# SQLSTATE of foreign key constraint violations.
+FOREIGN_KEY_VIOLATION = '23503'
+
+# Channel for notifications of changes that invalidate cached state.
+INVALIDATION_CHANNEL = 'idavoll_invalidate'
+
+def _toItem(data, compressed=None):
+    """
+    Create an item from the serialized item as stored in the database.
+
+    @param data: The serialized item, or C{None} if it was compressed.
+    @param compressed: The zlib compressed, UTF-8 encoded serialized item,
+                       or C{None} if it was not compressed.
+    """
+    if compressed is not None:
+        data = zlib.decompress(str(compressed))
+    if isinstance(data, str):
+        data = data.decode('utf-8')
+    return SerializedItem(data)
+
+
+
+def _nodeKey(nodeIdentifier):
+    """
+    Replica routing key for reads of a node.
+    """
+    return ('node', nodeIdentifier)
+
+
+
+def _entityKey(entity):
+    """
+    Replica routing key for reads of the nodes and subscriptions of an
+    entity.
+    """
+    return ('entity', entity.userhost())
+
+
+
+# Replica routing key for reads of the list of nodes.
+_NODES_KEY = ('nodes',)
+
+
 
 class Storage:
+    """
+    PostgreSQL based storage facility.
+
+    Node objects are kept in a bounded cache, so that most requests do not
+    have to retrieve the node from the database. Cached nodes are
+    invalidated when they are reconfigured, created or deleted through
+    this storage.
+
+    Retrieving nodes, node identifiers, items, and the subscriptions and
+    affiliations of nodes and entities, can be spread over read replicas,
+    see L{ReplicaRouter}. After a node or entity was written to, reads
+    depending on it go to the primary for a while, so that requestors see
+    the result of their own requests.
+
+    When several processes use the same database, changes made by one
+    invalidate cached state in the others. With C{notifyInvalidations}
+    set, changes to nodes, affiliations and subscriptions are announced
+    with C{NOTIFY} on L{INVALIDATION_CHANNEL}, when their transaction
+    commits. Notifications received on that channel, e.g. with
+    L{NotificationListener<idavoll.dbpool.NotificationListener>}, are to
+    be passed to L{invalidationReceived}. Besides invalidating the caches
+    of the storage, this calls the L{affiliationObservers} and
+    L{subscriptionObservers}, to invalidate caches kept elsewhere.
+
+    Likewise, identifiers of nodes that were found not to exist are kept
+    for a short while, so that repeated requests for them are rejected
+    without querying the database. These entries are invalidated when a
+    node by that identifier is created through this storage.
+
+    @ivar nodeCache: Cache of node objects by node identifier.
+    @type nodeCache: L{LRUCache}
+    @ivar missingNodeCache: Cache of identifiers of non-existing nodes.
+    @type missingNodeCache: L{LRUCache}
+    @ivar itemCompressionThreshold: Size in bytes of the serialized form of
+                                    items from which they are stored
+                                    compressed, or C{None} to store all
+                                    items uncompressed.
+    @type itemCompressionThreshold: C{int}
+    @ivar writeBatcher: Batcher through which items are stored, or C{None}
+                        to store items in a transaction per request.
+    @type writeBatcher: L{WriteBatcher}
+    @ivar router: Router of read-only interactions to replicas.
+    @type router: L{ReplicaRouter}
+    @ivar notifyInvalidations: Whether to notify other processes of changes
+                               that invalidate cached state.
+    @type notifyInvalidations: C{bool}
+    @ivar origin: Identifier of this storage in notifications, to ignore
+                  its own.
+    @type origin: C{str}
+    @ivar affiliationObservers: Called with the node identifier when
+                                affiliations with a node were changed by
+                                another process, or with C{None} when any
+                                might have changed.
+    @type affiliationObservers: C{list}
+    @ivar subscriptionObservers: Called with the node identifier when
+                                 subscriptions to a node were changed by
+                                 another process, or with C{None} when any
+                                 might have changed.
+    @type subscriptionObservers: C{list}
+    """
 
     implements(iidavoll.IStorage)
 
@@ -21,6 +133,7 @@ class Storage:
                 "pubsub#persist_items": True,
                 "pubsub#deliver_payloads": True,
                 "pubsub#send_last_published_item": 'on_sub',
+                "pubsub#max_items": None,
             },
             'collection': {
                 "pubsub#deliver_payloads": True,
@@ -28,57 +141,228 @@ class Storage:
             }
     }
 
-    def __init__(self, dbpool):
+    def __init__(self, dbpool, nodeCacheSize=1000, nodeCacheTTL=None,
+                       missingNodeCacheSize=1000, missingNodeCacheTTL=10,
+                       itemCompressionThreshold=None,
+                       writeBatchDelay=None, writeBatchSize=100,
+                       replicas=None, replicaPolicy='round-robin',
+                       replicaStickiness=5, notifyInvalidations=False):
         self.dbpool = dbpool
+        self.router = ReplicaRouter(dbpool, replicas or [], replicaPolicy,
+                                    replicaStickiness)
+        self.itemCompressionThreshold = itemCompressionThreshold
+        if writeBatchDelay is None:
+            self.writeBatcher = None
+        else:
+            self.writeBatcher = WriteBatcher(dbpool, writeBatchDelay,
+                                             writeBatchSize)
+        self.nodeCache = LRUCache(nodeCacheSize, nodeCacheTTL)
+        self.missingNodeCache = LRUCache(missingNodeCacheSize,
+                                         missingNodeCacheTTL)
+        self.notifyInvalidations = notifyInvalidations
+        self.origin = uuid.uuid4().hex
+        self.affiliationObservers = []
+        self.subscriptionObservers = []
 
 
     def getNode(self, nodeIdentifier):
-        return self.dbpool.runInteraction(self._getNode, nodeIdentifier)
+        try:
+            node = self.nodeCache[nodeIdentifier]
+        except KeyError:
+            pass
+        else:
+            return defer.succeed(node)
+
+        try:
+            self.missingNodeCache[nodeIdentifier]
+        except KeyError:
+            pass
+        else:
+            return defer.fail(error.NodeNotFound())
+
+        generation = self.nodeCache.generation
+        missingGeneration = self.missingNodeCache.generation
+        d = self.router.runInteraction([_nodeKey(nodeIdentifier)],
+                                       self._getNode, nodeIdentifier)
+        d.addCallbacks(self._cacheNode, self._cacheMissingNode,
+                       callbackArgs=(generation,),
+                       errbackArgs=(nodeIdentifier, missingGeneration))
+        return d
+
+
+    def _cacheNode(self, node, generation):
+        self.nodeCache.set(node.nodeIdentifier, node, generation)
+        return node
+
+
+    def _cacheMissingNode(self, failure, nodeIdentifier, generation):
+        failure.trap(error.NodeNotFound)
+        self.missingNodeCache.set(nodeIdentifier, True, generation)
+        return failure
 
 
     def _getNode(self, cursor, nodeIdentifier):
-        configuration = {}
-        cursor.execute("""SELECT node_type,
-                                 persist_items,
-                                 deliver_payloads,
-                                 send_last_published_item
-                          FROM nodes
-                          WHERE node=%s""",
-                       (nodeIdentifier,))
+        yield cursor.execute("""SELECT node_id,
+                                       node_type,
+                                       persist_items,
+                                       deliver_payloads,
+                                       send_last_published_item,
+                                       max_items
+                                FROM nodes
+                                WHERE node=%s""",
+                             (nodeIdentifier,))
         row = cursor.fetchone()
 
         if not row:
             raise error.NodeNotFound()
 
+        returnValue(self._makeNode(nodeIdentifier, row))
+
+
+    def _makeNode(self, nodeIdentifier, row):
         if row.node_type == 'leaf':
             configuration = {
                     'pubsub#persist_items': row.persist_items,
                     'pubsub#deliver_payloads': row.deliver_payloads,
                     'pubsub#send_last_published_item':
-                        row.send_last_published_item}
-            node = LeafNode(nodeIdentifier, configuration)
-            node.dbpool = self.dbpool
-            return node
+                        row.send_last_published_item,
+                    'pubsub#max_items': row.max_items}
+            node = LeafNode(row.node_id, nodeIdentifier, configuration)
         elif row.node_type == 'collection':
             configuration = {
                     'pubsub#deliver_payloads': row.deliver_payloads,
                     'pubsub#send_last_published_item':
                         row.send_last_published_item}
-            node = CollectionNode(nodeIdentifier, configuration)
-            node.dbpool = self.dbpool
-            return node
+            node = CollectionNode(row.node_id, nodeIdentifier,
+                                  configuration)
 
+        node.dbpool = self.dbpool
+        node.storage = self
+        return node
+
+
+    def getNodeAndAffiliation(self, nodeIdentifier, entity):
+        try:
+            self.missingNodeCache[nodeIdentifier]
+        except KeyError:
+            pass
+        else:
+            return defer.fail(error.NodeNotFound())
+
+        def cacheNode(result, generation):
+            self._cacheNode(result[0], generation)
+            return result
+
+        generation = self.nodeCache.generation
+        missingGeneration = self.missingNodeCache.generation
+        d = self.dbpool.runInteraction(self._getNodeAndAffiliation,
+                                       nodeIdentifier, entity)
+        d.addCallbacks(cacheNode, self._cacheMissingNode,
+                       callbackArgs=(generation,),
+                       errbackArgs=(nodeIdentifier, missingGeneration))
+        return d
+
+
+    def _getNodeAndAffiliation(self, cursor, nodeIdentifier, entity):
+        yield cursor.execute("""SELECT node_id,
+                                       node_type,
+                                       persist_items,
+                                       deliver_payloads,
+                                       send_last_published_item,
+                                       max_items,
+                                       (SELECT affiliation FROM affiliations
+                                        NATURAL JOIN entities
+                                        WHERE affiliations.node_id=
+                                                  nodes.node_id AND
+                                              jid=%s) AS affiliation
+                                FROM nodes
+                                WHERE node=%s""",
+                             (entity.userhost(),
+                              nodeIdentifier))
+        row = cursor.fetchone()
+
+        if not row:
+            raise error.NodeNotFound()
+
+        returnValue((self._makeNode(nodeIdentifier, row),
+                           row.affiliation))
 
 
     def getNodeIds(self):
-        d = self.dbpool.runQuery("""SELECT node from nodes""")
+        d = self.router.runQuery([_NODES_KEY], """SELECT node from nodes""")
         d.addCallback(lambda results: [r[0] for r in results])
         return d
 
 
     def createNode(self, nodeIdentifier, owner, config):
-        return self.dbpool.runInteraction(self._createNode, nodeIdentifier,
-                                           owner, config)
+        d = self.dbpool.runInteraction(self._createNode, nodeIdentifier,
+                                       owner, config)
+        d.addBoth(self._invalidateNode, nodeIdentifier)
+        d.addBoth(self._wrote, _entityKey(owner))
+        return d
+
+
+    def _invalidateNode(self, result, nodeIdentifier):
+        self.nodeCache.discard(nodeIdentifier)
+        self.missingNodeCache.discard(nodeIdentifier)
+        self.router.wrote(_nodeKey(nodeIdentifier), _NODES_KEY)
+        return result
+
+
+    def _wrote(self, result, *keys):
+        self.router.wrote(*keys)
+        return result
+
+
+    def _notifyInvalidation(self, cursor, kind, nodeIdentifier):
+        """
+        Notify other processes of a change that invalidates cached state.
+
+        @param kind: C{'node'} for changes to the node itself, and thereby
+                     its affiliations, or C{'subscriptions'}.
+        """
+        if not self.notifyInvalidations:
+            return
+
+        payload = json.dumps({'origin': self.origin,
+                              'kind': kind,
+                              'node': nodeIdentifier})
+        yield cursor.execute("""SELECT pg_notify(%s, %s)""",
+                             (INVALIDATION_CHANNEL, payload))
+
+
+    def invalidationReceived(self, payload):
+        """
+        Invalidate cached state upon a notification from another process.
+
+        @param payload: The payload of the notification, or C{None} if
+                        notifications might have been missed.
+        @type payload: C{str}
+        """
+        if payload is None:
+            self.nodeCache.clear()
+            self.missingNodeCache.clear()
+            self.router.wroteAll()
+            kind, nodeIdentifier = 'node', None
+        else:
+            notification = json.loads(payload)
+            if notification['origin'] == self.origin:
+                return
+
+            kind = notification['kind']
+            nodeIdentifier = notification['node']
+            if kind == 'node':
+                self._invalidateNode(None, nodeIdentifier)
+            else:
+                # The observers read the changed state again, and replicas
+                # might not have it yet.
+                self.router.wrote(_nodeKey(nodeIdentifier))
+
+        if kind == 'node':
+            for observer in self.affiliationObservers:
+                observer(nodeIdentifier)
+        for observer in self.subscriptionObservers:
+            observer(nodeIdentifier)
 
 
     def _createNode(self, cursor, nodeIdentifier, owner, config):
@@ -87,53 +371,63 @@ class Storage:
 
         owner = owner.userhost()
         try:
-            cursor.execute("""INSERT INTO nodes
-                              (node, node_type, persist_items,
-                               deliver_payloads, send_last_published_item)
-                              VALUES
-                              (%s, 'leaf', %s, %s, %s)""",
-                           (nodeIdentifier,
-                            config['pubsub#persist_items'],
-                            config['pubsub#deliver_payloads'],
-                            config['pubsub#send_last_published_item']))
+            yield cursor.execute("""INSERT INTO nodes
+                                    (node, node_type, persist_items,
+                                     deliver_payloads,
+                                     send_last_published_item,
+                                     max_items)
+                                    VALUES
+                                    (%s, 'leaf', %s, %s, %s, %s)
+                                    RETURNING node_id""",
+                                 (nodeIdentifier,
+                                  config['pubsub#persist_items'],
+                                  config['pubsub#deliver_payloads'],
+                                  config['pubsub#send_last_published_item'],
+                                  config.get('pubsub#max_items')))
         except cursor._pool.dbapi.IntegrityError:
             raise error.NodeExists()
 
-        cursor.execute("""SELECT 1 as bool from entities where jid=%s""",
-                       (owner,))
+        nodeDbId = cursor.fetchone()[0]
+
+        yield cursor.execute("""SELECT 1 as bool from entities where jid=%s""",
+                             (owner,))
 
         if not cursor.fetchone():
-            cursor.execute("""INSERT INTO entities (jid) VALUES (%s)""",
-                           (owner,))
+            yield cursor.execute("""INSERT INTO entities (jid) VALUES (%s)""",
+                                 (owner,))
 
-        cursor.execute("""INSERT INTO affiliations
-                          (node_id, entity_id, affiliation)
-                          SELECT node_id, entity_id, 'owner' FROM
-                          (SELECT node_id FROM nodes WHERE node=%s) as n
-                          CROSS JOIN
-                          (SELECT entity_id FROM entities
-                                            WHERE jid=%s) as e""",
-                       (nodeIdentifier, owner))
+        yield cursor.execute("""INSERT INTO affiliations
+                                (node_id, entity_id, affiliation)
+                                SELECT %s, entity_id, 'owner' FROM entities
+                                                              WHERE jid=%s""",
+                             (nodeDbId, owner))
+
+        yield self._notifyInvalidation(cursor, 'node', nodeIdentifier)
 
 
     def deleteNode(self, nodeIdentifier):
-        return self.dbpool.runInteraction(self._deleteNode, nodeIdentifier)
+        d = self.dbpool.runInteraction(self._deleteNode, nodeIdentifier)
+        d.addBoth(self._invalidateNode, nodeIdentifier)
+        return d
 
 
     def _deleteNode(self, cursor, nodeIdentifier):
-        cursor.execute("""DELETE FROM nodes WHERE node=%s""",
-                       (nodeIdentifier,))
+        yield cursor.execute("""DELETE FROM nodes WHERE node=%s""",
+                             (nodeIdentifier,))
 
         if cursor.rowcount != 1:
             raise error.NodeNotFound()
 
+        yield self._notifyInvalidation(cursor, 'node', nodeIdentifier)
+
 
     def getAffiliations(self, entity):
-        d = self.dbpool.runQuery("""SELECT node, affiliation FROM entities
-                                        NATURAL JOIN affiliations
-                                        NATURAL JOIN nodes
-                                        WHERE jid=%s""",
-                                     (entity.userhost(),))
+        d = self.router.runQuery([_entityKey(entity)],
+                                 """SELECT node, affiliation FROM entities
+                                    NATURAL JOIN affiliations
+                                    NATURAL JOIN nodes
+                                    WHERE jid=%s""",
+                                 (entity.userhost(),))
         d.addCallback(lambda results: [tuple(r) for r in results])
         return d
 
@@ -148,12 +442,13 @@ class Storage:
                 subscriptions.append(subscription)
             return subscriptions
 
-        d = self.dbpool.runQuery("""SELECT node, jid, resource, state
-                                     FROM entities
-                                     NATURAL JOIN subscriptions
-                                     NATURAL JOIN nodes
-                                     WHERE jid=%s""",
-                                  (entity.userhost(),))
+        d = self.router.runQuery([_entityKey(entity)],
+                                 """SELECT node, jid, resource, state
+                                    FROM entities
+                                    NATURAL JOIN subscriptions
+                                    NATURAL JOIN nodes
+                                    WHERE jid=%s""",
+                                 (entity.userhost(),))
         d.addCallback(toSubscriptions)
         return d
 
@@ -164,17 +459,68 @@ class Storage:
 
 
 class Node:
+    """
+    PostgreSQL based node.
+
+    The database identifier of the node is retrieved along with the node
+    and used in all subsequent queries. When a node turns out to have
+    been deleted, L{error.NodeNotFound} is raised and the node is removed
+    from the node cache.
+
+    @ivar nodeDbId: The database identifier of the node.
+    @type nodeDbId: C{int}
+    """
 
     implements(iidavoll.INode)
 
-    def __init__(self, nodeIdentifier, config):
+    def __init__(self, nodeDbId, nodeIdentifier, config):
+        self.nodeDbId = nodeDbId
         self.nodeIdentifier = nodeIdentifier
         self._config = config
 
 
+    def _runInteraction(self, interaction, *args, **kwargs):
+        d = self.dbpool.runInteraction(interaction, *args, **kwargs)
+        d.addErrback(self._nodeNotFound)
+        return d
+
+
+    def _runRead(self, interaction, *args, **kwargs):
+        """
+        Run a read-only interaction, possibly on a replica.
+        """
+        d = self.storage.router.runInteraction(
+                [_nodeKey(self.nodeIdentifier)],
+                interaction, *args, **kwargs)
+        d.addErrback(self._nodeNotFound)
+        return d
+
+
+    def _wrote(self, result, *entities):
+        """
+        Record a write to this node, and the entities involved.
+        """
+        self.storage.router.wrote(_nodeKey(self.nodeIdentifier),
+                                  *[_entityKey(entity)
+                                    for entity in entities])
+        return result
+
+
+    def _nodeNotFound(self, failure):
+        failure.trap(error.NodeNotFound)
+        self.storage.nodeCache.discard(self.nodeIdentifier)
+        return failure
+
+
     def _checkNodeExists(self, cursor):
-        cursor.execute("""SELECT node_id FROM nodes WHERE node=%s""",
-                       (self.nodeIdentifier,))
+        """
+        Raise L{error.NodeNotFound} if this node has been deleted.
+
+        This is only needed when an empty result would otherwise be
+        ambiguous.
+        """
+        yield cursor.execute("""SELECT 1 FROM nodes WHERE node_id=%s""",
+                             (self.nodeDbId,))
         if not cursor.fetchone():
             raise error.NodeNotFound()
 
@@ -194,25 +540,33 @@ class Node:
             if option in config:
                 config[option] = options[option]
 
-        d = self.dbpool.runInteraction(self._setConfiguration, config)
+        d = self._runInteraction(self._setConfiguration, config)
+        d.addBoth(self._wrote)
         d.addCallback(self._setCachedConfiguration, config)
         return d
 
 
     def _setConfiguration(self, cursor, config):
-        self._checkNodeExists(cursor)
-        cursor.execute("""UPDATE nodes SET persist_items=%s,
-                                           deliver_payloads=%s,
-                                           send_last_published_item=%s
-                          WHERE node=%s""",
-                       (config["pubsub#persist_items"],
-                        config["pubsub#deliver_payloads"],
-                        config["pubsub#send_last_published_item"],
-                        self.nodeIdentifier))
+        yield cursor.execute("""UPDATE nodes SET persist_items=%s,
+                                                 deliver_payloads=%s,
+                                                 send_last_published_item=%s,
+                                                 max_items=%s
+                                WHERE node_id=%s""",
+                             (config["pubsub#persist_items"],
+                              config["pubsub#deliver_payloads"],
+                              config["pubsub#send_last_published_item"],
+                              config.get("pubsub#max_items"),
+                              self.nodeDbId))
+        if cursor.rowcount != 1:
+            raise error.NodeNotFound()
+
+        yield self.storage._notifyInvalidation(cursor, 'node',
+                                               self.nodeIdentifier)
 
 
     def _setCachedConfiguration(self, void, config):
         self._config = config
+        self.storage.nodeCache.discard(self.nodeIdentifier)
 
 
     def getMetaData(self):
@@ -222,71 +576,78 @@ class Node:
 
 
     def getAffiliation(self, entity):
-        return self.dbpool.runInteraction(self._getAffiliation, entity)
+        return self._runInteraction(self._getAffiliation, entity)
 
 
     def _getAffiliation(self, cursor, entity):
-        self._checkNodeExists(cursor)
-        cursor.execute("""SELECT affiliation FROM affiliations
-                          NATURAL JOIN nodes
-                          NATURAL JOIN entities
-                          WHERE node=%s AND jid=%s""",
-                       (self.nodeIdentifier,
-                        entity.userhost()))
+        yield cursor.execute("""SELECT (SELECT affiliation FROM affiliations
+                                        NATURAL JOIN entities
+                                        WHERE affiliations.node_id=
+                                                  nodes.node_id AND
+                                              jid=%s)
+                                FROM nodes
+                                WHERE node_id=%s""",
+                             (entity.userhost(),
+                              self.nodeDbId))
 
-        try:
-            return cursor.fetchone()[0]
-        except TypeError:
-            return None
+        row = cursor.fetchone()
+        if not row:
+            raise error.NodeNotFound()
+
+        returnValue(row[0])
 
 
     def getSubscription(self, subscriber):
-        return self.dbpool.runInteraction(self._getSubscription, subscriber)
+        return self._runInteraction(self._getSubscription, subscriber)
 
 
     def _getSubscription(self, cursor, subscriber):
-        self._checkNodeExists(cursor)
-
         userhost = subscriber.userhost()
         resource = subscriber.resource or ''
 
-        cursor.execute("""SELECT state FROM subscriptions
-                          NATURAL JOIN nodes
-                          NATURAL JOIN entities
-                          WHERE node=%s AND jid=%s AND resource=%s""",
-                       (self.nodeIdentifier,
-                        userhost,
-                        resource))
+        yield cursor.execute("""SELECT (SELECT state FROM subscriptions
+                                        NATURAL JOIN entities
+                                        WHERE subscriptions.node_id=
+                                                  nodes.node_id AND
+                                              jid=%s AND resource=%s) AS state
+                                FROM nodes
+                                WHERE node_id=%s""",
+                             (userhost,
+                              resource,
+                              self.nodeDbId))
 
         row = cursor.fetchone()
         if not row:
-            return None
+            raise error.NodeNotFound()
+        elif row.state is None:
+            returnValue(None)
         else:
-            return Subscription(self.nodeIdentifier, subscriber, row.state)
+            returnValue(Subscription(self.nodeIdentifier, subscriber,
+                                           row.state))
 
 
     def getSubscriptions(self, state=None):
-        return self.dbpool.runInteraction(self._getSubscriptions, state)
+        return self._runRead(self._getSubscriptions, state)
 
 
     def _getSubscriptions(self, cursor, state):
-        self._checkNodeExists(cursor)
-
         query = """SELECT jid, resource, state,
                           subscription_type, subscription_depth
                    FROM subscriptions
-                   NATURAL JOIN nodes
                    NATURAL JOIN entities
-                   WHERE node=%s"""
-        values = [self.nodeIdentifier]
+                   WHERE node_id=%s"""
+        values = [self.nodeDbId]
 
         if state:
             query += " AND state=%s"
             values.append(state)
 
-        cursor.execute(query, values)
+        yield cursor.execute(query, values)
         rows = cursor.fetchall()
 
+        if not rows:
+            yield self._checkNodeExists(cursor)
+
         subscriptions = []
         for row in rows:
             subscriber = jid.JID('%s/%s' % (row.jid, row.resource))
@@ -300,108 +661,114 @@ class Node:
             subscriptions.append(Subscription(self.nodeIdentifier, subscriber,
                                               row.state, options))
 
-        return subscriptions
+        returnValue(subscriptions)
 
 
     def addSubscription(self, subscriber, state, config):
-        return self.dbpool.runInteraction(self._addSubscription, subscriber,
-                                          state, config)
+        d = self._runInteraction(self._addSubscription, subscriber, state,
+                                 config)
+        d.addBoth(self._wrote, subscriber)
+        return d
 
 
     def _addSubscription(self, cursor, subscriber, state, config):
-        self._checkNodeExists(cursor)
-
         userhost = subscriber.userhost()
         resource = subscriber.resource or ''
 
         subscription_type = config.get('pubsub#subscription_type')
         subscription_depth = config.get('pubsub#subscription_depth')
 
-        try:
-            cursor.execute("""INSERT INTO entities (jid) VALUES (%s)""",
-                           (userhost,))
-        except cursor._pool.dbapi.IntegrityError:
-            cursor.connection.rollback()
+        yield cursor.execute("""INSERT INTO entities (jid) VALUES (%s)
+                                ON CONFLICT (jid) DO NOTHING""",
+                             (userhost,))
 
         try:
-            cursor.execute("""INSERT INTO subscriptions
-                              (node_id, entity_id, resource, state,
-                               subscription_type, subscription_depth)
-                              SELECT node_id, entity_id, %s, %s, %s, %s FROM
-                              (SELECT node_id FROM nodes
-                                              WHERE node=%s) as n
-                              CROSS JOIN
-                              (SELECT entity_id FROM entities
-                                                WHERE jid=%s) as e""",
-                           (resource,
-                            state,
-                            subscription_type,
-                            subscription_depth,
-                            self.nodeIdentifier,
-                            userhost))
-        except cursor._pool.dbapi.IntegrityError:
-            raise error.SubscriptionExists()
+            yield cursor.execute("""INSERT INTO subscriptions
+                                    (node_id, entity_id, resource, state,
+                                     subscription_type, subscription_depth)
+                                    SELECT %s, entity_id, %s, %s, %s, %s
+                                    FROM entities
+                                    WHERE jid=%s""",
+                                 (self.nodeDbId,
+                                  resource,
+                                  state,
+                                  subscription_type,
+                                  subscription_depth,
+                                  userhost))
+        except cursor._pool.dbapi.IntegrityError, e:
+            if e.pgcode == FOREIGN_KEY_VIOLATION:
+                raise error.NodeNotFound()
+            else:
+                raise error.SubscriptionExists()
+
+        yield self.storage._notifyInvalidation(cursor, 'subscriptions',
+                                               self.nodeIdentifier)
 
 
     def removeSubscription(self, subscriber):
-        return self.dbpool.runInteraction(self._removeSubscription,
-                                           subscriber)
+        d = self._runInteraction(self._removeSubscription, subscriber)
+        d.addBoth(self._wrote, subscriber)
+        return d
 
 
     def _removeSubscription(self, cursor, subscriber):
-        self._checkNodeExists(cursor)
-
         userhost = subscriber.userhost()
         resource = subscriber.resource or ''
 
-        cursor.execute("""DELETE FROM subscriptions WHERE
-                          node_id=(SELECT node_id FROM nodes
-                                                  WHERE node=%s) AND
-                          entity_id=(SELECT entity_id FROM entities
-                                                      WHERE jid=%s) AND
-                          resource=%s""",
-                       (self.nodeIdentifier,
-                        userhost,
-                        resource))
+        yield cursor.execute("""DELETE FROM subscriptions WHERE
+                                node_id=%s AND
+                                entity_id=(SELECT entity_id FROM entities
+                                                            WHERE jid=%s) AND
+                                resource=%s""",
+                             (self.nodeDbId,
+                              userhost,
+                              resource))
         if cursor.rowcount != 1:
+            yield self._checkNodeExists(cursor)
             raise error.NotSubscribed()
 
-        return None
+        yield self.storage._notifyInvalidation(cursor, 'subscriptions',
+                                               self.nodeIdentifier)
 
 
     def isSubscribed(self, entity):
-        return self.dbpool.runInteraction(self._isSubscribed, entity)
+        return self._runInteraction(self._isSubscribed, entity)
 
 
     def _isSubscribed(self, cursor, entity):
-        self._checkNodeExists(cursor)
+        yield cursor.execute("""SELECT EXISTS (SELECT 1 FROM subscriptions
+                                               NATURAL JOIN entities
+                                               WHERE subscriptions.node_id=
+                                                         nodes.node_id AND
+                                                     jid=%s AND
+                                                     state='subscribed')
+                                FROM nodes
+                                WHERE node_id=%s""",
+                             (entity.userhost(),
+                             self.nodeDbId))
 
-        cursor.execute("""SELECT 1 as bool FROM entities
-                          NATURAL JOIN subscriptions
-                          NATURAL JOIN nodes
-                          WHERE entities.jid=%s
-                          AND node=%s AND state='subscribed'""",
-                       (entity.userhost(),
-                       self.nodeIdentifier))
+        row = cursor.fetchone()
+        if not row:
+            raise error.NodeNotFound()
 
-        return cursor.fetchone() is not None
+        returnValue(row[0])
 
 
     def getAffiliations(self):
-        return self.dbpool.runInteraction(self._getAffiliations)
+        return self._runRead(self._getAffiliations)
 
 
     def _getAffiliations(self, cursor):
-        self._checkNodeExists(cursor)
-
-        cursor.execute("""SELECT jid, affiliation FROM nodes
-                          NATURAL JOIN affiliations
-                          NATURAL JOIN entities
-                          WHERE node=%s""",
-                       (self.nodeIdentifier,))
+        yield cursor.execute("""SELECT jid, affiliation FROM affiliations
+                                NATURAL JOIN entities
+                                WHERE node_id=%s""",
+                             (self.nodeDbId,))
         result = cursor.fetchall()
 
-        return [(jid.internJID(r[0]), r[1]) for r in result]
+        if not result:
+            yield self._checkNodeExists(cursor)
+
+        returnValue([(jid.internJID(r[0]), r[1]) for r in result])
 
 
 
@@ -412,110 +779,351 @@ class LeafNode(Node):
     nodeType = 'leaf'
 
     def storeItems(self, items, publisher):
-        return self.dbpool.runInteraction(self._storeItems, items, publisher)
+        batcher = self.storage.writeBatcher
+        if batcher is None:
+            d = self._runInteraction(self._storeItems, items, publisher)
+        else:
+            d = batcher.storeItems(self, items, publisher)
+            d.addErrback(self._nodeNotFound)
+        d.addBoth(self._wrote, publisher)
+        return d
 
 
     def _storeItems(self, cursor, items, publisher):
-        self._checkNodeExists(cursor)
+        # A single statement cannot update the same row twice, so only the
+        # last item with a given identifier is stored.
+        latest = {}
         for item in items:
-            self._storeItem(cursor, item, publisher)
-
-
-    def _storeItem(self, cursor, item, publisher):
-        data = item.toXml()
-        cursor.execute("""UPDATE items SET date=now(), publisher=%s, data=%s
-                          FROM nodes
-                          WHERE nodes.node_id = items.node_id AND
-                                nodes.node = %s and items.item=%s""",
-                       (publisher.full(),
-                        data,
-                        self.nodeIdentifier,
-                        item["id"]))
-        if cursor.rowcount == 1:
+            latest[item["id"]] = item
+        items = [item for item in items if latest[item["id"]] is item]
+
+        if not items:
+            yield self._checkNodeExists(cursor)
             return
 
-        cursor.execute("""INSERT INTO items (node_id, item, publisher, data)
-                          SELECT node_id, %s, %s, %s FROM nodes
-                                                     WHERE node=%s""",
-                       (item["id"],
-                        publisher.full(),
-                        data,
-                        self.nodeIdentifier))
+        threshold = self.storage.itemCompressionThreshold
+
+        values = []
+        params = []
+        for item in items:
+            data = item.toXml()
+            compressed = None
+            if threshold is not None:
+                encoded = data.encode('utf-8')
+                if len(encoded) >= threshold:
+                    data = None
+                    compressed = cursor._pool.dbapi.Binary(
+                            zlib.compress(encoded))
+
+            values.append("(%s, %s, %s, %s, %s)")
+            params.extend((self.nodeDbId, item["id"], publisher.full(),
+                           data, compressed))
+
+        # Republished items get a new item_id, so that they are ordered
+        # after items stored earlier in the same transaction, which have
+        # the same date.
+        query = """INSERT INTO items
+                   (node_id, item, publisher, data, data_compressed)
+                   VALUES %s
+                   ON CONFLICT (node_id, item) DO UPDATE
+                   SET item_id=DEFAULT, date=now(),
+                       publisher=EXCLUDED.publisher,
+                       data=EXCLUDED.data,
+                       data_compressed=EXCLUDED.data_compressed"""
+
+        try:
+            yield cursor.execute(query % ', '.join(values), params)
+        except cursor._pool.dbapi.IntegrityError, e:
+            if e.pgcode == FOREIGN_KEY_VIOLATION:
+                raise error.NodeNotFound()
+            else:
+                raise
+
+        # Drop all items older than the newest maxItems, in the order in
+        # which they are retrieved.
+        maxItems = self._config.get("pubsub#max_items")
+        if maxItems is not None:
+            yield cursor.execute("""DELETE FROM items
+                                    WHERE node_id=%s AND
+                                          (date, item_id) <=
+                                          (SELECT date, item_id FROM items
+                                           WHERE node_id=%s
+                                           ORDER BY date DESC, item_id DESC
+                                           OFFSET %s LIMIT 1)""",
+                                 (self.nodeDbId, self.nodeDbId, maxItems))
 
 
     def removeItems(self, itemIdentifiers):
-        return self.dbpool.runInteraction(self._removeItems, itemIdentifiers)
+        d = self._runInteraction(self._removeItems, itemIdentifiers)
+        d.addBoth(self._wrote)
+        return d
 
 
     def _removeItems(self, cursor, itemIdentifiers):
-        self._checkNodeExists(cursor)
+        yield cursor.execute("""DELETE FROM items
+                                USING unnest(%s::text[]) WITH ORDINALITY
+                                      AS requested (item, position)
+                                WHERE node_id=%s AND
+                                      items.item=requested.item
+                                RETURNING requested.position""",
+                             (list(itemIdentifiers),
+                              self.nodeDbId))
+
+        positions = sorted(row[0] for row in cursor.fetchall())
+
+        if not positions:
+            yield self._checkNodeExists(cursor)
+
+        returnValue([itemIdentifiers[position - 1]
+                           for position in positions])
+
+
+    def getItems(self, maxItems=None, after=None, before=None):
+        return self._runRead(self._getItems, maxItems, after, before)
+
+
+    def _getItems(self, cursor, maxItems, after, before):
+        query = """SELECT data, data_compressed FROM items
+                   WHERE node_id=%s"""
+        values = [self.nodeDbId]
+
+        # Pages are selected by comparing with the position of the cursor
+        # item, so that the items index is used to find them.
+        if after is not None or before:
+            if after is not None:
+                query += " AND (date, item_id) < "
+                cursorItem = after
+            else:
+                query += " AND (date, item_id) > "
+                cursorItem = before
+            query += """(SELECT date, item_id FROM items
+                         WHERE node_id=%s AND item=%s)"""
+            values.extend((self.nodeDbId, cursorItem))
+        else:
+            cursorItem = None
 
-        deleted = []
+        if before is not None:
+            query += " ORDER BY date, item_id"
+        else:
+            query += " ORDER BY date DESC, item_id DESC"
 
-        for itemIdentifier in itemIdentifiers:
-            cursor.execute("""DELETE FROM items WHERE
-                              node_id=(SELECT node_id FROM nodes
-                                                      WHERE node=%s) AND
-                              item=%s""",
-                           (self.nodeIdentifier,
-                            itemIdentifier))
+        if maxItems:
+            query += " LIMIT %s"
+            values.append(maxItems)
 
-            if cursor.rowcount:
-                deleted.append(itemIdentifier)
+        yield cursor.execute(query, values)
+        result = cursor.fetchall()
 
-        return deleted
+        if not result:
+            yield self._checkNodeExists(cursor)
+            if cursorItem is not None:
+                yield self._checkItemExists(cursor, cursorItem)
 
+        if before is not None:
+            result.reverse()
 
-    def getItems(self, maxItems=None):
-        return self.dbpool.runInteraction(self._getItems, maxItems)
+        items = [_toItem(*r) for r in result]
+        returnValue(items)
 
 
-    def _getItems(self, cursor, maxItems):
-        self._checkNodeExists(cursor)
-        query = """SELECT data FROM nodes
-                   NATURAL JOIN items
-                   WHERE node=%s ORDER BY date DESC"""
-        if maxItems:
-            cursor.execute(query + " LIMIT %s",
-                           (self.nodeIdentifier,
-                            maxItems))
-        else:
-            cursor.execute(query, (self.nodeIdentifier,))
+    def _checkItemExists(self, cursor, itemIdentifier):
+        yield cursor.execute("""SELECT 1 FROM items
+                                WHERE node_id=%s AND item=%s""",
+                             (self.nodeDbId, itemIdentifier))
+        if not cursor.fetchone():
+            raise error.ItemNotFound()
 
-        result = cursor.fetchall()
-        items = [stripNamespace(parseXml(r[0])) for r in result]
-        return items
+
+    def iterItems(self, callback, batchSize=100):
+        return self._runInteraction(self._iterItems, callback, batchSize)
+
+
+    def _iterItems(self, cursor, callback, batchSize):
+        # A server-side cursor keeps the result set in the database, so that
+        # only one batch is held in memory at a time.
+        yield cursor.execute("""DECLARE iter_items NO SCROLL CURSOR FOR
+                                SELECT data, data_compressed FROM items
+                                WHERE node_id=%s
+                                ORDER BY date DESC, item_id DESC""",
+                             (self.nodeDbId,))
+
+        found = False
+        while True:
+            yield cursor.execute("""FETCH FORWARD %s FROM iter_items""",
+                                 (batchSize,))
+            result = cursor.fetchall()
+            if not result:
+                break
+
+            found = True
+            items = [_toItem(*r) for r in result]
+            yield Call(callback, items)
+
+        yield cursor.execute("""CLOSE iter_items""")
+
+        if not found:
+            yield self._checkNodeExists(cursor)
 
 
     def getItemsById(self, itemIdentifiers):
-        return self.dbpool.runInteraction(self._getItemsById, itemIdentifiers)
+        return self._runRead(self._getItemsById, itemIdentifiers)
 
 
     def _getItemsById(self, cursor, itemIdentifiers):
-        self._checkNodeExists(cursor)
-        items = []
-        for itemIdentifier in itemIdentifiers:
-            cursor.execute("""SELECT data FROM nodes
-                              NATURAL JOIN items
-                              WHERE node=%s AND item=%s""",
-                           (self.nodeIdentifier,
-                            itemIdentifier))
-            result = cursor.fetchone()
-            if result:
-                items.append(parseXml(result[0]))
-        return items
+        yield cursor.execute("""SELECT data, data_compressed FROM items
+                                JOIN unnest(%s::text[]) WITH ORDINALITY
+                                     AS requested (item, position)
+                                     USING (item)
+                                WHERE node_id=%s
+                                ORDER BY requested.position""",
+                             (list(itemIdentifiers),
+                              self.nodeDbId))
+        result = cursor.fetchall()
+
+        if not result:
+            yield self._checkNodeExists(cursor)
+
+        returnValue([_toItem(*r) for r in result])
 
 
     def purge(self):
-        return self.dbpool.runInteraction(self._purge)
+        d = self._runInteraction(self._purge)
+        d.addBoth(self._wrote)
+        return d
 
 
     def _purge(self, cursor):
-        self._checkNodeExists(cursor)
+        yield cursor.execute("""DELETE FROM items WHERE node_id=%s""",
+                             (self.nodeDbId,))
+
+        if not cursor.rowcount:
+            yield self._checkNodeExists(cursor)
+
+
+class WriteBatcher(service.Service):
+    """
+    Coalesces concurrent storage of items into a single transaction.
+
+    Requests to store items are collected for up to L{delay} seconds, or
+    until L{maxItems} items are pending, and then stored in one
+    transaction, so that concurrent publishes share a single commit. Each
+    request is stored within its own savepoint, so that a failing request
+    does not affect the others in the batch, and the Deferred of each
+    request fires with its own result.
+
+    When stopped as a service, pending requests are stored right away, and
+    stopping waits until all batches have been committed.
+
+    @ivar delay: Maximum number of seconds a request is held back.
+    @type delay: C{float}
+    @ivar maxItems: Number of pending items that causes the batch to be
+                    stored right away.
+    @type maxItems: C{int}
+    """
+
+    def __init__(self, dbpool, delay=0.002, maxItems=100, clock=None):
+        self.dbpool = dbpool
+        self.delay = delay
+        self.maxItems = maxItems
+        self.clock = clock or reactor
+
+        self._pending = []
+        self._pendingItems = 0
+        self._delayedCall = None
+        self._storing = []
+
+
+    def stopService(self):
+        service.Service.stopService(self)
+        self.flush()
+        return defer.DeferredList(list(self._storing))
+
+
+    def storeItems(self, node, items, publisher):
+        """
+        Store items in a node, as part of the next batch.
+
+        @param node: The node to store the items in.
+        @type node: L{LeafNode}
+        @return: Deferred that fires when the batch has been committed, or
+                 fails if storing these items failed.
+        """
+        d = defer.Deferred()
+        self._pending.append((node, items, publisher, d))
+        self._pendingItems += len(items)
+
+        if self._pendingItems >= self.maxItems:
+            self.flush()
+        elif self._delayedCall is None:
+            self._delayedCall = self.clock.callLater(self.delay, self.flush)
+
+        return d
+
+
+    def flush(self):
+        """
+        Store all pending requests now.
+
+        @return: Deferred that fires when the batch has been committed.
+        """
+        if self._delayedCall is not None:
+            if self._delayedCall.active():
+                self._delayedCall.cancel()
+            self._delayedCall = None
+
+        batch = self._pending
+        self._pending = []
+        self._pendingItems = 0
+
+        if not batch:
+            return defer.succeed(None)
+
+        d = self.dbpool.runInteraction(self._storeBatch, batch)
+        d.addCallbacks(self._batchStored, self._batchFailed,
+                       callbackArgs=(batch,), errbackArgs=(batch,))
+        self._storing.append(d)
+        d.addBoth(self._batchDone, d)
+        return d
+
+
+    def _storeBatch(self, cursor, batch):
+        if len(batch) == 1:
+            node, items, publisher, _ = batch[0]
+            yield node._storeItems(cursor, items, publisher)
+            returnValue([None])
+
+        results = []
+        for node, items, publisher, _ in batch:
+            yield cursor.execute("""SAVEPOINT store_items""")
+            try:
+                yield node._storeItems(cursor, items, publisher)
+            except Exception:
+                results.append(failure.Failure())
+                yield cursor.execute("""ROLLBACK TO SAVEPOINT store_items""")
+            else:
+                results.append(None)
+                yield cursor.execute("""RELEASE SAVEPOINT store_items""")
+
+        returnValue(results)
+
+
+    def _batchStored(self, results, batch):
+        for (_, _, _, d), result in zip(batch, results):
+            if isinstance(result, failure.Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+
+    def _batchFailed(self, reason, batch):
+        for _, _, _, d in batch:
+            d.errback(reason)
+
+
+    def _batchDone(self, result, d):
+        self._storing.remove(d)
+        return result
 
-        cursor.execute("""DELETE FROM items WHERE
-                          node_id=(SELECT node_id FROM nodes WHERE node=%s)""",
-                       (self.nodeIdentifier,))
 
 
 class CollectionNode(Node):
@@ -537,68 +1145,71 @@ class GatewayStorage(object):
         """
         Count number of callbacks registered for a node.
         """
-        cursor.execute("""SELECT count(*) FROM callbacks
-                          WHERE service=%s and node=%s""",
-                       (service.full(),
-                        nodeIdentifier))
+        yield cursor.execute("""SELECT count(*) FROM callbacks
+                                WHERE service=%s and node=%s""",
+                             (service.full(),
+                              nodeIdentifier))
         results = cursor.fetchall()
-        return results[0][0]
+        returnValue(results[0][0])
 
 
     def addCallback(self, service, nodeIdentifier, callback):
         def interaction(cursor):
-            cursor.execute("""SELECT 1 as bool FROM callbacks
-                              WHERE service=%s and node=%s and uri=%s""",
-                           (service.full(),
-                           nodeIdentifier,
-                           callback))
+            yield cursor.execute("""SELECT 1 as bool FROM callbacks
+                                    WHERE service=%s and node=%s and uri=%s""",
+                                 (service.full(),
+                                 nodeIdentifier,
+                                 callback))
             if cursor.fetchall():
                 return
 
-            cursor.execute("""INSERT INTO callbacks
-                              (service, node, uri) VALUES
-                              (%s, %s, %s)""",
-                           (service.full(),
-                           nodeIdentifier,
-                           callback))
+            yield cursor.execute("""INSERT INTO callbacks
+                                    (service, node, uri) VALUES
+                                    (%s, %s, %s)""",
+                                 (service.full(),
+                                 nodeIdentifier,
+                                 callback))
 
         return self.dbpool.runInteraction(interaction)
 
 
     def removeCallback(self, service, nodeIdentifier, callback):
         def interaction(cursor):
-            cursor.execute("""DELETE FROM callbacks
-                              WHERE service=%s and node=%s and uri=%s""",
-                           (service.full(),
-                            nodeIdentifier,
-                            callback))
+            yield cursor.execute("""DELETE FROM callbacks
+                                    WHERE service=%s and node=%s and uri=%s""",
+                                 (service.full(),
+                                  nodeIdentifier,
+                                  callback))
 
             if cursor.rowcount != 1:
                 raise error.NotSubscribed()
 
-            last = not self._countCallbacks(cursor, service, nodeIdentifier)
-            return last
+            count = yield self._countCallbacks(cursor, service,
+                                               nodeIdentifier)
+            returnValue(not count)
 
         return self.dbpool.runInteraction(interaction)
 
     def getCallbacks(self, service, nodeIdentifier):
         def interaction(cursor):
-            cursor.execute("""SELECT uri FROM callbacks
-                              WHERE service=%s and node=%s""",
-                           (service.full(),
-                            nodeIdentifier))
+            yield cursor.execute("""SELECT uri FROM callbacks
+                                    WHERE service=%s and node=%s""",
+                                 (service.full(),
+                                  nodeIdentifier))
             results = cursor.fetchall()
 
             if not results:
                 raise error.NoCallbacks()
 
-            return [result[0] for result in results]
+            returnValue([result[0] for result in results])
 
         return self.dbpool.runInteraction(interaction)
 
 
     def hasCallbacks(self, service, nodeIdentifier):
         def interaction(cursor):
-            return bool(self._countCallbacks(cursor, service, nodeIdentifier))
+            count = yield self._countCallbacks(cursor, service,
+                                               nodeIdentifier)
+            returnValue(bool(count))
 
         return self.dbpool.runInteraction(interaction)
@@ -0,0 +1,162 @@
+# -*- test-case-name: idavoll.test.test_rsm -*-
+#
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Result Set Management (XEP-0059) for item retrieval.
+
+Item identifiers are used as the opaque cursors of result sets. Pages are
+ordered from the most recently to the least recently published item, so
+that requesting the page C{after} the last item of a page moves towards
+older items.
+"""
+
+from twisted.words.protocols.jabber.error import StanzaError
+from twisted.words.xish import domish
+
+from wokkel import disco, pubsub
+
+NS_RSM = 'http://jabber.org/protocol/rsm'
+
+class RSMRequest(object):
+    """
+    A result set request.
+
+    @ivar max: The maximum number of items in the page, or C{None} if not
+               specified.
+    @type max: C{int}
+    @ivar after: Identifier of the item after which the page starts.
+    @type after: C{unicode}
+    @ivar before: Identifier of the item before which the page ends. The
+                  empty string requests the last page.
+    @type before: C{unicode}
+    """
+
+    def __init__(self, max=None, after=None, before=None):
+        self.max = max
+        self.after = after
+        self.before = before
+
+
+    @classmethod
+    def fromElement(Class, element):
+        """
+        Parse a result set request from a C{set} element.
+
+        @raise StanzaError: C{bad-request} if C{max} is not a non-negative
+                            integer.
+        """
+        request = Class()
+
+        for child in element.elements():
+            if child.uri != NS_RSM:
+                continue
+
+            if child.name == 'max':
+                try:
+                    request.max = int(unicode(child))
+                except ValueError:
+                    raise StanzaError('bad-request',
+                                      text="Invalid result set maximum")
+                if request.max < 0:
+                    raise StanzaError('bad-request',
+                                      text="Invalid result set maximum")
+            elif child.name == 'after':
+                request.after = unicode(child)
+            elif child.name == 'before':
+                request.before = unicode(child)
+
+        return request
+
+
+    @classmethod
+    def fromParent(Class, parent):
+        """
+        Find and parse a result set request in a parent element.
+
+        @return: The result set request, or C{None} if there is none.
+        @rtype: L{RSMRequest}
+        """
+        for child in parent.elements():
+            if (child.uri, child.name) == (NS_RSM, 'set'):
+                return Class.fromElement(child)
+
+        return None
+
+
+
+class RSMResponse(object):
+    """
+    A result set response.
+
+    @ivar first: Identifier of the first item in the page.
+    @type first: C{unicode}
+    @ivar last: Identifier of the last item in the page.
+    @type last: C{unicode}
+    """
+
+    def __init__(self, first=None, last=None):
+        self.first = first
+        self.last = last
+
+
+    @classmethod
+    def fromItems(Class, items):
+        """
+        Create a result set response for a page of items.
+        """
+        if items:
+            return Class(items[0].getAttribute('id'),
+                         items[-1].getAttribute('id'))
+        else:
+            return Class()
+
+
+    def toElement(self):
+        element = domish.Element((NS_RSM, 'set'))
+        if self.first is not None:
+            element.addElement('first', content=self.first)
+        if self.last is not None:
+            element.addElement('last', content=self.last)
+        return element
+
+
+
+class Page(list):
+    """
+    A page of items, along with its result set response.
+
+    @ivar rsm: The result set response for this page.
+    @type rsm: L{RSMResponse}
+    """
+
+    def __init__(self, items, rsm):
+        list.__init__(self, items)
+        self.rsm = rsm
+
+
+
+class PubSubService(pubsub.PubSubService):
+    """
+    Publish-subscribe service that includes result set responses.
+
+    If the resource handling an items request returns a L{Page}, its
+    result set response is added to the response.
+    """
+
+    def getDiscoInfo(self, requestor, target, nodeIdentifier):
+        d = pubsub.PubSubService.getDiscoInfo(self, requestor, target,
+                                              nodeIdentifier)
+        if not nodeIdentifier:
+            d.addCallback(lambda info: info + [disco.DiscoFeature(NS_RSM)])
+        return d
+
+
+    def _toResponse_items(self, result, resource, request):
+        response = pubsub.PubSubService._toResponse_items(self, result,
+                                                          resource, request)
+        rsm = getattr(result, 'rsm', None)
+        if rsm is not None:
+            response.addChild(rsm.toElement())
+        return response
@@ -0,0 +1,485 @@
+# -*- test-case-name: idavoll.test.test_sharding -*-
+#
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Spreading the nodes of a publish-subscribe service over worker processes.
+
+A L{ShardRouter} is the only part connected to the XMPP server, as the
+publish-subscribe component. Requests for a node are forwarded to the
+worker owning that node, picked by consistent hashing of the node
+identifier on a L{HashRing}. Each worker runs its own backend and
+L{ShardWorker}, that handles forwarded requests as the component would and
+passes notifications back to the router to be sent out.
+
+All workers use the same database. Requests that are not about a single
+node, like the subscriptions or affiliations of an entity and the list of
+all nodes, are answered by any one of the workers.
+
+Workers and the router talk AMP, usually over UNIX sockets.
+"""
+
+import bisect
+import hashlib
+import json
+import uuid
+
+from zope.interface import implements
+
+from twisted.internet import defer, protocol
+from twisted.protocols import amp
+from twisted.python import log
+from twisted.words.protocols.jabber import error, jid
+from twisted.words.xish import domish
+
+from wokkel import disco, iwokkel
+from wokkel.generic import parseXml
+from wokkel.pubsub import NS_PUBSUB, PUBSUB_REQUEST, PubSubRequest
+from wokkel.subprotocols import IQHandlerMixin, XMPPHandler
+
+# Maximum length of the chunks of a L{LargeString}, keeping each below the
+# AMP limit of 65535 bytes per value.
+CHUNK_SIZE = 60000
+
+class HashRing(object):
+    """
+    Consistent hashing of node identifiers onto shards.
+
+    Each shard is placed on the ring at a number of points. A node belongs
+    to the shard of the first point at or after the hash of its identifier.
+    Adding or removing a shard only moves the nodes between it and its
+    neighbouring points.
+
+    @ivar shards: The names of the shards.
+    @type shards: C{list} of C{str}
+    """
+
+    def __init__(self, shards, replicas=100):
+        if not shards:
+            raise ValueError("A hash ring needs at least one shard")
+
+        self.shards = list(shards)
+        points = sorted((self._hash('%s:%d' % (shard, index)), shard)
+                        for shard in self.shards
+                        for index in xrange(replicas))
+        self._keys = [key for key, _ in points]
+        self._points = [shard for _, shard in points]
+
+
+    @staticmethod
+    def _hash(key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return int(hashlib.md5(key).hexdigest()[:8], 16)
+
+
+    def shardFor(self, nodeIdentifier):
+        """
+        Return the name of the shard owning a node.
+
+        @param nodeIdentifier: The identifier of the node, or C{''} for the
+                               root node.
+        @type nodeIdentifier: C{unicode}
+        @rtype: C{str}
+        """
+        index = bisect.bisect_left(self._keys, self._hash(nodeIdentifier))
+        return self._points[index % len(self._points)]
+
+
+
+class LargeString(amp.Argument):
+    """
+    String argument that may exceed the size limit of AMP values.
+
+    The string is split into chunks, sent as separate values with the index
+    of the chunk appended to the argument name.
+    """
+
+    def toBox(self, name, strings, objects, proto):
+        value = objects[name]
+        chunks = [value[offset:offset + CHUNK_SIZE]
+                  for offset in xrange(0, len(value), CHUNK_SIZE)] or ['']
+        for index, chunk in enumerate(chunks):
+            strings['%s.%d' % (name, index)] = chunk
+
+
+    def fromBox(self, name, strings, objects, proto):
+        chunks = []
+        while '%s.%d' % (name, len(chunks)) in strings:
+            chunks.append(strings['%s.%d' % (name, len(chunks))])
+        objects[name] = ''.join(chunks)
+
+
+
+class Request(amp.Command):
+    """
+    Handle a publish-subscribe request, returning the response stanza.
+    """
+    arguments = [('stanza', LargeString())]
+    response = [('response', LargeString())]
+
+
+
+class DiscoInfo(amp.Command):
+    """
+    Return the service discovery information for a node, as a C{query}
+    element.
+    """
+    arguments = [('requestor', amp.Unicode()),
+                 ('target', amp.Unicode()),
+                 ('nodeIdentifier', amp.Unicode())]
+    response = [('info', LargeString())]
+
+
+
+class DiscoItems(amp.Command):
+    """
+    Return the identifiers of the nodes below a node, as a JSON list.
+    """
+    arguments = [('requestor', amp.Unicode()),
+                 ('target', amp.Unicode()),
+                 ('nodeIdentifier', amp.Unicode())]
+    response = [('nodes', LargeString())]
+
+
+
+class Send(amp.Command):
+    """
+    Send a stanza, like a notification, to the XMPP server.
+    """
+    arguments = [('stanza', LargeString())]
+    requiresAnswer = False
+
+
+
+class ShardUnavailable(Exception):
+    """
+    The worker owning a shard is not connected.
+    """
+
+
+
+class ShardWorker(object):
+    """
+    Handles the requests a router forwards to a worker.
+
+    The worker takes the place of the stream manager as the parent of the
+    publish-subscribe service. Responses to forwarded requests are returned
+    to the router as the result of L{Request}, all other stanzas are passed
+    on to the router with L{Send}.
+
+    @ivar service: The publish-subscribe service handling the requests.
+    @type service: L{PubSubService<idavoll.rsm.PubSubService>}
+    @ivar router: Connection to the router, or C{None} if not connected.
+    @type router: L{WorkerProtocol}
+    """
+
+    def __init__(self, service):
+        self.service = service
+        self.service.parent = self
+        self.router = None
+        self._pending = {}
+
+
+    def request(self, stanza):
+        """
+        Handle a request forwarded by the router.
+
+        @param stanza: The serialized request C{iq} stanza.
+        @type stanza: C{str}
+        @return: Deferred that fires with the serialized response stanza.
+        @rtype: L{defer.Deferred}
+        """
+        iq = parseXml(stanza)
+        d = defer.Deferred()
+        self._pending[iq.getAttribute('id'), iq.getAttribute('from')] = d
+        self.service.handleRequest(iq)
+        return d
+
+
+    def discoInfo(self, requestor, target, nodeIdentifier):
+        def toInfo(result):
+            info = disco.DiscoInfo()
+            info.nodeIdentifier = nodeIdentifier
+            for item in result:
+                info.append(item)
+            return info.toElement().toXml().encode('utf-8')
+
+        d = self.service.getDiscoInfo(requestor, target, nodeIdentifier)
+        d.addCallback(toInfo)
+        return d
+
+
+    def discoItems(self, requestor, target, nodeIdentifier):
+        d = self.service.getDiscoItems(requestor, target, nodeIdentifier)
+        d.addCallback(lambda items: json.dumps([item.nodeIdentifier
+                                                for item in items]))
+        return d
+
+
+    def send(self, obj):
+        if domish.IElement.providedBy(obj):
+            if (obj.name == 'iq' and
+                obj.getAttribute('type') in ('result', 'error')):
+                key = obj.getAttribute('id'), obj.getAttribute('to')
+                d = self._pending.pop(key, None)
+                if d is not None:
+                    d.callback(obj.toXml().encode('utf-8'))
+                    return
+            obj = obj.toXml()
+
+        if isinstance(obj, unicode):
+            obj = obj.encode('utf-8')
+
+        if self.router is None:
+            log.msg("Not connected to the router, dropping stanza")
+            return
+
+        self.router.callRemote(Send, stanza=obj)
+
+
+
+class WorkerProtocol(amp.AMP):
+    """
+    The worker's side of the connection with the router.
+
+    @ivar worker: The worker handling the commands of the router.
+    @type worker: L{ShardWorker}
+    """
+
+    worker = None
+
+    def connectionMade(self):
+        amp.AMP.connectionMade(self)
+        self.worker.router = self
+
+
+    def connectionLost(self, reason):
+        amp.AMP.connectionLost(self, reason)
+        if self.worker.router is self:
+            self.worker.router = None
+
+
+    @Request.responder
+    def request(self, stanza):
+        d = self.worker.request(stanza)
+        d.addCallback(lambda response: {'response': response})
+        return d
+
+
+    @DiscoInfo.responder
+    def discoInfo(self, requestor, target, nodeIdentifier):
+        d = self.worker.discoInfo(jid.JID(requestor), jid.JID(target),
+                                  nodeIdentifier)
+        d.addCallback(lambda info: {'info': info})
+        return d
+
+
+    @DiscoItems.responder
+    def discoItems(self, requestor, target, nodeIdentifier):
+        d = self.worker.discoItems(jid.JID(requestor), jid.JID(target),
+                                   nodeIdentifier)
+        d.addCallback(lambda nodes: {'nodes': nodes})
+        return d
+
+
+
+class WorkerFactory(protocol.ServerFactory):
+    """
+    Accepts the connection of the router to a worker.
+    """
+
+    protocol = WorkerProtocol
+
+    def __init__(self, worker):
+        self.worker = worker
+
+
+    def buildProtocol(self, addr):
+        p = protocol.ServerFactory.buildProtocol(self, addr)
+        p.worker = self.worker
+        return p
+
+
+
+class RouterProtocol(amp.AMP):
+    """
+    The router's side of the connection with a worker.
+
+    @ivar router: The router sending the stanzas of the worker.
+    @type router: L{ShardRouter}
+    """
+
+    router = None
+
+    @Send.responder
+    def send(self, stanza):
+        self.router.send(stanza)
+        return {}
+
+
+
+class Shard(protocol.ReconnectingClientFactory):
+    """
+    Connection from the router to the worker of a shard.
+
+    @ivar name: The name of the shard.
+    @type name: C{str}
+    @ivar connection: The connection to the worker, or C{None} if not
+                      connected.
+    @type connection: L{RouterProtocol}
+    """
+
+    protocol = RouterProtocol
+    maxDelay = 10
+
+    def __init__(self, name, router):
+        self.name = name
+        self.router = router
+        self.connection = None
+
+
+    def buildProtocol(self, addr):
+        self.resetDelay()
+        p = protocol.ReconnectingClientFactory.buildProtocol(self, addr)
+        p.router = self.router
+        self.connection = p
+        return p
+
+
+    def clientConnectionLost(self, connector, reason):
+        self.connection = None
+        protocol.ReconnectingClientFactory.clientConnectionLost(self,
+                                                                connector,
+                                                                reason)
+
+
+    def callRemote(self, command, **kwargs):
+        if self.connection is None:
+            return defer.fail(ShardUnavailable(self.name))
+        return self.connection.callRemote(command, **kwargs)
+
+
+
+class ShardRouter(XMPPHandler, IQHandlerMixin):
+    """
+    Forwards publish-subscribe requests to the workers owning the nodes.
+
+    Requests for the subscriptions or affiliations of an entity and for the
+    list of all nodes are sent to a single shard, as the workers share
+    their database. Instant nodes get their identifier here, so that the
+    request can be forwarded to the owner of the new node.
+
+    @ivar ring: The hash ring assigning nodes to shards.
+    @type ring: L{HashRing}
+    @ivar shards: Connections to the workers, by name of their shard.
+    @type shards: C{dict}
+    """
+
+    implements(iwokkel.IDisco)
+
+    iqHandlers = {'/*': '_onPubSubRequest'}
+
+    def __init__(self, ring):
+        XMPPHandler.__init__(self)
+        self.ring = ring
+        self.shards = {}
+
+
+    def connectionMade(self):
+        self.xmlstream.addObserver(PUBSUB_REQUEST, self.handleRequest)
+
+
+    def _call(self, shard, command, **kwargs):
+        d = self.shards[shard].callRemote(command, **kwargs)
+        d.addErrback(self._shardFailed, shard)
+        return d
+
+
+    def _shardFailed(self, failure, shard):
+        if not failure.check(ShardUnavailable):
+            log.err(failure, "Shard %r failed" % shard)
+        raise error.StanzaError('service-unavailable')
+
+
+    def _forward(self, shard, iq):
+        def unpack(result):
+            response = parseXml(result['response'])
+            if response.getAttribute('type') == 'error':
+                raise error.exceptionFromStanza(response)
+            return list(response.elements())
+
+        d = self._call(shard, Request, stanza=iq.toXml().encode('utf-8'))
+        d.addCallback(unpack)
+        return d
+
+
+    def _shardForEntity(self, entity):
+        """
+        Pick the shard to answer a request that is not about a single node.
+
+        Any worker can answer these, so they are spread over the shards by
+        the bare JID of the requesting entity, passing over shards without
+        a connected worker.
+
+        @type entity: L{JID<twisted.words.protocols.jabber.jid.JID>}
+        @rtype: C{str}
+        """
+        preferred = self.ring.shardFor(entity.userhost())
+        shards = self.ring.shards
+        index = shards.index(preferred)
+        for shard in shards[index:] + shards[:index]:
+            if self.shards[shard].connection is not None:
+                return shard
+        return preferred
+
+
+    def _onPubSubRequest(self, iq):
+        request = PubSubRequest.fromElement(iq)
+
+        if request.verb in ('subscriptions', 'affiliations'):
+            return self._forward(self._shardForEntity(request.sender), iq)
+
+        if request.verb == 'create' and not request.nodeIdentifier:
+            nodeIdentifier = 'generic/%s' % uuid.uuid4()
+            for element in iq.pubsub.elements(NS_PUBSUB, 'create'):
+                element['node'] = nodeIdentifier
+
+            def addCreate(elements):
+                if elements:
+                    return elements
+                response = domish.Element((NS_PUBSUB, 'pubsub'))
+                create = response.addElement('create')
+                create['node'] = nodeIdentifier
+                return response
+
+            d = self._forward(self.ring.shardFor(nodeIdentifier), iq)
+            d.addCallback(addCreate)
+            return d
+
+        shard = self.ring.shardFor(request.nodeIdentifier or '')
+        return self._forward(shard, iq)
+
+
+    def getDiscoInfo(self, requestor, target, nodeIdentifier=''):
+        d = self._call(self.ring.shardFor(nodeIdentifier), DiscoInfo,
+                       requestor=requestor.full(), target=target.full(),
+                       nodeIdentifier=nodeIdentifier)
+        d.addCallback(lambda result: list(disco.DiscoInfo.fromElement(
+                                              parseXml(result['info']))))
+        return d
+
+
+    def getDiscoItems(self, requestor, target, nodeIdentifier=''):
+        if nodeIdentifier:
+            shard = self.ring.shardFor(nodeIdentifier)
+        else:
+            shard = self._shardForEntity(requestor)
+
+        d = self._call(shard, DiscoItems,
+                       requestor=requestor.full(), target=target.full(),
+                       nodeIdentifier=nodeIdentifier)
+        d.addCallback(lambda result: [disco.DiscoItem(target, node)
+                                      for node in json.loads(result['nodes'])])
+        return d
@@ -1,7 +1,7 @@
 # Copyright (c) Ralph Meijer.
 # See LICENSE for details.
 
-from twisted.application import service
+from twisted.application import internet, service
 from twisted.python import usage
 from twisted.words.protocols.jabber.jid import JID
 
@@ -9,10 +9,10 @@ from wokkel.component import Component
 from wokkel.disco import DiscoHandler
 from wokkel.generic import FallbackHandler, VersionHandler
 from wokkel.iwokkel import IPubSubResource
-from wokkel.pubsub import PubSubService
 
-from idavoll import __version__
+from idavoll import __version__, codec
 from idavoll.backend import BackendService
+from idavoll.rsm import PubSubService
 
 class Options(usage.Options):
     optParameters = [
@@ -20,55 +20,332 @@ class Options(usage.Options):
         ('secret', None, 'secret', 'Jabber server component secret'),
         ('rhost', None, '127.0.0.1', 'Jabber server host'),
         ('rport', None, '5347', 'Jabber server port'),
-        ('backend', None, 'memory', 'Choice of storage backend'),
+        ('backend', None, 'memory', 'Choice of storage backend '
+                                    '(memory, pgsql or pgsql-async)'),
         ('dbuser', None, None, 'Database user (pgsql backend)'),
         ('dbname', None, 'pubsub', 'Database name (pgsql backend)'),
         ('dbpass', None, None, 'Database password (pgsql backend)'),
         ('dbhost', None, None, 'Database host (pgsql backend)'),
         ('dbport', None, None, 'Database port (pgsql backend)'),
+        ('dbreplicas', None, None, 'Comma separated list of read replica '
+                                   'hosts, as host or host:port '
+                                   '(pgsql backend)'),
+        ('dbreplica-policy', None, 'round-robin',
+            'Choice of replica for reads (round-robin or least-loaded)'),
+        ('dbreplica-stickiness', None, '5',
+            'Time reads go to the primary after a write, in seconds '
+            '(pgsql backend)'),
+        ('dbpool-min', None, '3', 'Minimum number of database '
+                                  'connections (pgsql backend)'),
+        ('dbpool-size', None, '10', 'Maximum number of database '
+                                    'connections (pgsql backend)'),
+        ('dbpool-stats-interval', None, '0',
+            'Interval for logging database pool statistics in seconds, '
+            '0 to disable (pgsql backend)'),
+        ('node-cache-size', None, '1000', 'Maximum number of cached nodes '
+                                          '(pgsql backend)'),
+        ('node-cache-ttl', None, '60', 'Time nodes are cached in seconds '
+                                       '(pgsql backend)'),
+        ('missing-node-cache-size', None, '1000',
+            'Maximum number of cached non-existing nodes (pgsql backend)'),
+        ('missing-node-cache-ttl', None, '10',
+            'Time non-existing nodes are cached in seconds (pgsql backend)'),
+        ('item-compression-threshold', None, None,
+            'Size in bytes from which items are stored compressed '
+            '(pgsql backend)'),
+        ('write-batch-delay', None, None,
+            'Time stores of items are held back to be committed together '
+            'in ms (pgsql backend)'),
+        ('write-batch-size', None, '100',
+            'Number of items from which held back stores are committed '
+            '(pgsql backend)'),
+        ('affiliation-cache-size', None, '10000',
+            'Maximum number of nodes to cache affiliations with'),
+        ('affiliation-cache-ttl', None, '60',
+            'Time affiliations are cached in seconds'),
+        ('subscriber-index-size', None, '1000',
+            'Maximum number of nodes to cache the subscribers of'),
+        ('xml-parser', None, 'domish', 'Parser for stored items '
+                                       '(domish or expat)'),
+        ('fanout-budget', None, '10', 'Time spent sending notifications '
+                                      'per reactor iteration (ms)'),
+        ('fanout-stats-interval', None, '0',
+            'Interval for logging the notification backlog in seconds, '
+            '0 to disable'),
+        ('cluster-size', None, '1', 'Number of processes sharing the '
+                                    'database (pgsql backend)'),
+        ('cluster-index', None, '0', 'Index of this process, from 0 up to '
+                                     '--cluster-size'),
+        ('shards', None, None, 'Comma separated list of UNIX sockets of '
+                               'shard workers to route requests to, '
+                               'instead of handling them'),
+        ('shard-listen', None, None, 'UNIX socket to handle the requests '
+                                     'of a shard router on, instead of '
+                                     'connecting to the Jabber server'),
     ]
 
     optFlags = [
         ('verbose', 'v', 'Show traffic'),
-        ('hide-nodes', None, 'Hide all nodes for disco')
+        ('hide-nodes', None, 'Hide all nodes for disco'),
+        ('dbpool-adaptive', None, 'Grow and shrink the database pool '
+                                  'between --dbpool-min and --dbpool-size '
+                                  'with demand (pgsql backend)'),
+        ('dbnotify', None, 'Invalidate cached state of other processes '
+                           'using the same database (pgsql backend)'),
     ]
 
     def postOptions(self):
-        if self['backend'] not in ['pgsql', 'memory']:
+        if self['backend'] not in ['pgsql', 'pgsql-async', 'memory']:
             raise usage.UsageError, "Unknown backend!"
 
+        if self['dbreplica-policy'] not in ['round-robin', 'least-loaded']:
+            raise usage.UsageError, "Unknown replica policy!"
+
+        try:
+            self['cluster-size'] = int(self['cluster-size'])
+            self['cluster-index'] = int(self['cluster-index'])
+        except ValueError:
+            raise usage.UsageError, "Invalid cluster size or index!"
+
+        if not 0 <= self['cluster-index'] < self['cluster-size']:
+            raise usage.UsageError, "Cluster index out of range!"
+
+        if self['cluster-size'] > 1:
+            if self['backend'] == 'memory':
+                raise usage.UsageError, \
+                      "Clustering requires the pgsql backend!"
+
+            # Other processes change subscriptions, too.
+            self['dbnotify'] = True
+
+        if self['shard-listen']:
+            if self['backend'] == 'memory':
+                raise usage.UsageError, \
+                      "Shard workers require the pgsql backend!"
+
+            # Other workers share the database, too.
+            self['dbnotify'] = True
+
+        if self['dbnotify'] and self['backend'] == 'memory':
+            raise usage.UsageError, \
+                  "Invalidation notifications require the pgsql backend!"
+
+        if self['dbpool-adaptive'] and self['backend'] != 'pgsql':
+            raise usage.UsageError, \
+                  "Adaptive database pool requires the pgsql backend!"
+
+        if self['shards'] and self['shard-listen']:
+            raise usage.UsageError, \
+                  "A process can not be both shard router and worker!"
+
+        if self['shard-listen'] and self['cluster-size'] > 1:
+            raise usage.UsageError, \
+                  "Sharding and clustering can not be combined!"
+
+        if self['xml-parser'] not in codec.parsers:
+            raise usage.UsageError, "Unknown XML parser!"
+
         self['jid'] = JID(self['jid'])
 
 
 
+def makeRouterService(config):
+    """
+    Create a component that forwards requests to shard workers.
+    """
+    from idavoll.sharding import HashRing, Shard, ShardRouter
+
+    s = service.MultiService()
+
+    cs = Component(config["rhost"], int(config["rport"]),
+                   config["jid"].full(), config["secret"])
+    cs.setName('component')
+    cs.setServiceParent(s)
+
+    cs.factory.maxDelay = 900
+
+    if config["verbose"]:
+        cs.logTraffic = True
+
+    FallbackHandler().setHandlerParent(cs)
+    VersionHandler('Idavoll', __version__).setHandlerParent(cs)
+    DiscoHandler().setHandlerParent(cs)
+
+    paths = [path.strip() for path in config['shards'].split(',')]
+    router = ShardRouter(HashRing(paths))
+    router.setHandlerParent(cs)
+
+    for path in paths:
+        shard = Shard(path, router)
+        router.shards[path] = shard
+        internet.UNIXClient(path, shard).setServiceParent(s)
+
+    return s
+
+
+
 def makeService(config):
+    if config['shards']:
+        return makeRouterService(config)
+
     s = service.MultiService()
 
+    codec.setParser(config['xml-parser'])
+
     # Create backend service with storage
 
-    if config['backend'] == 'pgsql':
-        from twisted.enterprise import adbapi
+    listener = None
+    if config['backend'] in ('pgsql', 'pgsql-async'):
         from idavoll.pgsql_storage import Storage
         from psycopg2.extras import NamedTupleConnection
-        dbpool = adbapi.ConnectionPool('psycopg2',
-                                       user=config['dbuser'],
-                                       password=config['dbpass'],
-                                       database=config['dbname'],
-                                       host=config['dbhost'],
-                                       port=config['dbport'],
-                                       cp_reconnect=True,
-                                       client_encoding='utf-8',
-                                       connection_factory=NamedTupleConnection,
-                                       )
-        st = Storage(dbpool)
+
+        def makePool(host, port):
+            if config['backend'] == 'pgsql':
+                from idavoll.dbpool import ConnectionPool
+                return ConnectionPool('psycopg2',
+                                      user=config['dbuser'],
+                                      password=config['dbpass'],
+                                      database=config['dbname'],
+                                      host=host,
+                                      port=port,
+                                      cp_min=int(config['dbpool-min']),
+                                      cp_max=int(config['dbpool-size']),
+                                      cp_reconnect=True,
+                                      client_encoding='utf-8',
+                                      connection_factory=NamedTupleConnection,
+                                      )
+            else:
+                from idavoll.dbpool import AsyncConnectionPool
+                return AsyncConnectionPool(int(config['dbpool-size']),
+                                           user=config['dbuser'],
+                                           password=config['dbpass'],
+                                           database=config['dbname'],
+                                           host=host,
+                                           port=port,
+                                           client_encoding='utf-8',
+                                           connection_factory=
+                                               NamedTupleConnection,
+                                           )
+
+        dbpool = makePool(config['dbhost'], config['dbport'])
+
+        replicas = []
+        if config['dbreplicas']:
+            for replica in config['dbreplicas'].split(','):
+                host, _, port = replica.strip().partition(':')
+                replicas.append(makePool(host, port or config['dbport']))
+
+        from idavoll.dbpool import MetricsLogger, PoolSizer
+        statsInterval = float(config['dbpool-stats-interval'])
+        if statsInterval > 0:
+            ts = internet.TimerService(statsInterval,
+                                       MetricsLogger(dbpool).report)
+            ts.setServiceParent(s)
+
+        if config['dbpool-adaptive']:
+            ts = internet.TimerService(1, PoolSizer(dbpool).adjust)
+            ts.setServiceParent(s)
+
+        if config['item-compression-threshold'] is None:
+            itemCompressionThreshold = None
+        else:
+            itemCompressionThreshold = int(
+                    config['item-compression-threshold'])
+
+        if config['write-batch-delay'] is None:
+            writeBatchDelay = None
+        else:
+            writeBatchDelay = float(config['write-batch-delay']) / 1000
+
+        st = Storage(dbpool,
+                     nodeCacheSize=int(config['node-cache-size']),
+                     nodeCacheTTL=float(config['node-cache-ttl']),
+                     missingNodeCacheSize=int(
+                         config['missing-node-cache-size']),
+                     missingNodeCacheTTL=float(
+                         config['missing-node-cache-ttl']),
+                     itemCompressionThreshold=itemCompressionThreshold,
+                     writeBatchDelay=writeBatchDelay,
+                     writeBatchSize=int(config['write-batch-size']),
+                     replicas=replicas,
+                     replicaPolicy=config['dbreplica-policy'],
+                     replicaStickiness=float(
+                         config['dbreplica-stickiness']),
+                     notifyInvalidations=config['dbnotify'])
+
+        if st.writeBatcher is not None:
+            # Store pending items before the database pool is closed.
+            st.writeBatcher.setServiceParent(s)
+
+        if config['dbnotify']:
+            from idavoll.dbpool import NotificationListener
+            from idavoll.pgsql_storage import INVALIDATION_CHANNEL
+            listener = NotificationListener(INVALIDATION_CHANNEL,
+                                            st.invalidationReceived,
+                                            user=config['dbuser'],
+                                            password=config['dbpass'],
+                                            database=config['dbname'],
+                                            host=config['dbhost'],
+                                            port=config['dbport'])
     elif config['backend'] == 'memory':
         from idavoll.memory_storage import Storage
         st = Storage()
 
-    bs = BackendService(st)
+    clusterSize = int(config['cluster-size'])
+    if clusterSize > 1:
+        from idavoll.cluster import Partition
+        partition = Partition(int(config['cluster-index']), clusterSize)
+    else:
+        partition = None
+
+    bs = BackendService(st,
+                        affiliationCacheSize=int(
+                            config['affiliation-cache-size']),
+                        partition=partition,
+                        affiliationCacheTTL=float(
+                            config['affiliation-cache-ttl']),
+                        subscriberIndexSize=int(
+                            config['subscriber-index-size']))
     bs.setName('backend')
     bs.setServiceParent(s)
 
+    if partition is not None:
+        from idavoll.cluster import EventBus
+        eventBus = EventBus(bs, dbpool,
+                            user=config['dbuser'],
+                            password=config['dbpass'],
+                            database=config['dbname'],
+                            host=config['dbhost'],
+                            port=config['dbport'])
+        eventBus.setServiceParent(s)
+
+    if listener is not None:
+        st.affiliationObservers.append(bs.invalidateAffiliations)
+        st.subscriptionObservers.append(bs.invalidateSubscribers)
+        listener.setServiceParent(s)
+
+    resource = IPubSubResource(bs)
+    resource.hideNodes = config["hide-nodes"]
+    resource.serviceJID = config["jid"]
+    resource.fanOutTimeBudget = float(config["fanout-budget"]) / 1000
+
+    fanOutStatsInterval = float(config['fanout-stats-interval'])
+    if fanOutStatsInterval > 0:
+        from idavoll.backend import FanOutLogger
+        ts = internet.TimerService(fanOutStatsInterval,
+                                   FanOutLogger(resource).report)
+        ts.setServiceParent(s)
+
+    ps = PubSubService(resource)
+    resource.pubsubService = ps
+
+    if config['shard-listen']:
+        from idavoll.sharding import ShardWorker, WorkerFactory
+        worker = ShardWorker(ps)
+        internet.UNIXServer(config['shard-listen'],
+                            WorkerFactory(worker)).setServiceParent(s)
+        return s
+
     # Set up XMPP server-side component with publish-subscribe capabilities
 
     cs = Component(config["rhost"], int(config["rport"]),
@@ -84,13 +361,6 @@ def makeService(config):
     FallbackHandler().setHandlerParent(cs)
     VersionHandler('Idavoll', __version__).setHandlerParent(cs)
     DiscoHandler().setHandlerParent(cs)
-
-    resource = IPubSubResource(bs)
-    resource.hideNodes = config["hide-nodes"]
-    resource.serviceJID = config["jid"]
-
-    ps = PubSubService(resource)
     ps.setHandlerParent(cs)
-    resource.pubsubService = ps
 
     return s
@@ -4,6 +4,7 @@
 from twisted.application import internet, strports
 from twisted.conch import manhole, manhole_ssh
 from twisted.cred import portal, checkers
+from twisted.python import usage
 from twisted.web import resource, server
 
 from idavoll import gateway, tap
@@ -14,6 +15,13 @@ class Options(tap.Options):
             ('webport', None, '8086', 'Web port'),
     ]
 
+    def postOptions(self):
+        tap.Options.postOptions(self)
+
+        if self['shards'] or self['shard-listen']:
+            raise usage.UsageError, \
+                  "Sharding is not supported by the HTTP gateway!"
+
 
 
 def getManholeFactory(namespace, **passwords):
@@ -38,7 +46,7 @@ def makeService(config):
 
     # Set up XMPP service for subscribing to remote nodes
 
-    if config['backend'] == 'pgsql':
+    if config['backend'] in ('pgsql', 'pgsql-async'):
         from idavoll.pgsql_storage import GatewayStorage
         gst = GatewayStorage(bs.storage.dbpool)
     elif config['backend'] == 'memory':
@@ -8,19 +8,23 @@ Tests for L{idavoll.backend}.
 from zope.interface import implements
 from zope.interface.verify import verifyObject
 
-from twisted.internet import defer
+from twisted.internet import defer, task
+from twisted.python import log
 from twisted.trial import unittest
 from twisted.words.protocols.jabber import jid
 from twisted.words.protocols.jabber.error import StanzaError
 
-from wokkel import iwokkel, pubsub
+from wokkel import iwokkel, pubsub, shim
+from wokkel.generic import parseXml
 
-from idavoll import backend, error, iidavoll
+from idavoll import backend, error, iidavoll, memory_storage
+from idavoll.codec import SerializedItem
 
 OWNER = jid.JID('owner@example.com')
 OWNER_FULL = jid.JID('owner@example.com/home')
 SERVICE = jid.JID('test.example.org')
 NS_PUBSUB = 'http://jabber.org/protocol/pubsub'
+NS_PUBSUB_EVENT = NS_PUBSUB + '#event'
 
 class BackendTest(unittest.TestCase):
 
@@ -32,16 +36,14 @@ class BackendTest(unittest.TestCase):
     def test_deleteNode(self):
         class TestNode:
             nodeIdentifier = 'to-be-deleted'
-            def getAffiliation(self, entity):
-                if entity.userhostJID() == OWNER:
-                    return defer.succeed('owner')
 
         class TestStorage:
             def __init__(self):
                 self.deleteCalled = []
 
-            def getNode(self, nodeIdentifier):
-                return defer.succeed(TestNode())
+            def getNodeAndAffiliation(self, nodeIdentifier, entity):
+                if entity.userhostJID() == OWNER:
+                    return defer.succeed((TestNode(), 'owner'))
 
             def deleteNode(self, nodeIdentifier):
                 if nodeIdentifier in ['to-be-deleted']:
@@ -60,6 +62,7 @@ class BackendTest(unittest.TestCase):
             data = preDeleteCalled[-1]
             self.assertEquals('to-be-deleted', data['nodeIdentifier'])
             self.assertTrue(self.storage.deleteCalled)
+            self.assertEquals(0, len(self.backend.affiliationCache))
 
         self.storage = TestStorage()
         self.backend = backend.BackendService(self.storage)
@@ -77,16 +80,14 @@ class BackendTest(unittest.TestCase):
 
         class TestNode:
             nodeIdentifier = 'to-be-deleted'
-            def getAffiliation(self, entity):
-                if entity.userhostJID() == OWNER:
-                    return defer.succeed('owner')
 
         class TestStorage:
             def __init__(self):
                 self.deleteCalled = []
 
-            def getNode(self, nodeIdentifier):
-                return defer.succeed(TestNode())
+            def getNodeAndAffiliation(self, nodeIdentifier, entity):
+                if entity.userhostJID() == OWNER:
+                    return defer.succeed((TestNode(), 'owner'))
 
             def deleteNode(self, nodeIdentifier):
                 if nodeIdentifier in ['to-be-deleted']:
@@ -181,6 +182,37 @@ class BackendTest(unittest.TestCase):
         d.addCallback(cb)
         return d
 
+    def test_getNotificationsPartition(self):
+        """
+        With a partition, only subscribers in it are notified.
+        """
+        from idavoll.cluster import Partition
+
+        subscribers = [jid.JID('user%d@example.org/Home' % n)
+                       for n in xrange(20)]
+        subs = [pubsub.Subscription('test', subscriber, 'subscribed')
+                for subscriber in subscribers]
+        partition = Partition(1, 3)
+
+        class TestNode:
+            def getSubscriptions(self, state=None):
+                return subs
+
+        def cb(result):
+            notified = set(subscriber for subscriber, _, _ in result)
+            self.assertEquals(set(subscriber for subscriber in subscribers
+                                  if subscriber in partition),
+                              notified)
+            self.assertTrue(0 < len(notified) < len(subscribers))
+
+        self.storage = self.NodeStore({'test': TestNode()})
+        self.backend = backend.BackendService(self.storage,
+                                              partition=partition)
+        d = self.backend.getNotifications('test', [pubsub.Item()])
+        d.addCallback(cb)
+        return d
+
+
     def test_getNotificationsRoot(self):
         """
         Ensure subscribers to the root node show up in the notification list
@@ -249,6 +281,335 @@ class BackendTest(unittest.TestCase):
         return d
 
 
+    def test_getNotificationsCached(self):
+        """
+        The subscriptions to a node are only retrieved from storage once.
+        """
+        item = pubsub.Item()
+        sub = pubsub.Subscription('test', OWNER, 'subscribed')
+        calls = []
+
+        class TestNode:
+            def getSubscriptions(self, state=None):
+                calls.append(state)
+                return [sub]
+
+        def cb(result):
+            self.assertEquals(1, len(calls))
+            self.assertEquals(1, len(result))
+            subscriber, subscriptions, items = result[-1]
+            self.assertEquals(OWNER, subscriber)
+            self.assertEquals([item], items)
+
+        self.storage = self.NodeStore({'test': TestNode()})
+        self.backend = backend.BackendService(self.storage)
+        d = self.backend.getNotifications('test', [pubsub.Item()])
+        d.addCallback(lambda _: self.backend.getNotifications('test', [item]))
+        d.addCallback(cb)
+        return d
+
+
+    def test_getNotificationsEvicted(self):
+        """
+        Only a bounded number of subscriber indexes is cached.
+        """
+        item = pubsub.Item()
+        calls = []
+
+        class TestNode:
+            def __init__(self, nodeIdentifier):
+                self.nodeIdentifier = nodeIdentifier
+
+            def getSubscriptions(self, state=None):
+                calls.append(self.nodeIdentifier)
+                return []
+
+        def cb(result):
+            self.assertEquals(['test', 'other', 'test'], calls)
+
+        self.storage = self.NodeStore({'test': TestNode('test'),
+                                       'other': TestNode('other')})
+        self.backend = backend.BackendService(self.storage,
+                                              subscriberIndexSize=1)
+        d = self.backend.getNotifications('test', [item])
+        d.addCallback(lambda _: self.backend.getNotifications('other',
+                                                              [item]))
+        d.addCallback(lambda _: self.backend.getNotifications('test', [item]))
+        d.addCallback(cb)
+        return d
+
+
+    def test_getNotificationsInvalidateOther(self):
+        """
+        Invalidating the subscriber index of a node while that of another
+        is being built does not keep the latter from being cached.
+        """
+        item = pubsub.Item()
+        subscriptions = defer.Deferred()
+        calls = []
+
+        class TestNode:
+            def getSubscriptions(self, state=None):
+                calls.append(state)
+                return subscriptions
+
+        self.storage = self.NodeStore({'test': TestNode()})
+        self.backend = backend.BackendService(self.storage)
+        d = self.backend.getNotifications('test', [item])
+        self.backend.invalidateSubscribers('other')
+        subscriptions.callback([])
+        d.addCallback(lambda _: self.backend.getNotifications('test', [item]))
+        d.addCallback(lambda _: self.assertEquals(['subscribed'], calls))
+        return d
+
+
+    def test_getNotificationsUnsubscribe(self):
+        """
+        Unsubscribing from a node invalidates its cached subscriber index.
+        """
+        item = pubsub.Item()
+        subscriptions = [pubsub.Subscription('test', OWNER, 'subscribed')]
+
+        class TestNode:
+            nodeIdentifier = 'test'
+
+            def getSubscriptions(self, state=None):
+                return list(subscriptions)
+
+            def removeSubscription(self, subscriber):
+                del subscriptions[:]
+                return defer.succeed(None)
+
+        def cb(result):
+            self.assertEquals([], result)
+
+        self.storage = self.NodeStore({'test': TestNode()})
+        self.backend = backend.BackendService(self.storage)
+        d = self.backend.getNotifications('test', [item])
+        d.addCallback(lambda _: self.backend.unsubscribe('test', OWNER_FULL,
+                                                         OWNER_FULL))
+        d.addCallback(lambda _: self.backend.getNotifications('test', [item]))
+        d.addCallback(cb)
+        return d
+
+
+    def test_invalidateSubscribersRoot(self):
+        """
+        Changes to root node subscriptions invalidate the index of all nodes.
+        """
+        item = pubsub.Item()
+        subRoot = pubsub.Subscription('', OWNER, 'subscribed')
+        rootSubscriptions = []
+
+        class TestNode:
+            def getSubscriptions(self, state=None):
+                return []
+
+        class TestRootNode:
+            def getSubscriptions(self, state=None):
+                return list(rootSubscriptions)
+
+        def subscribeRoot(result):
+            self.assertEquals([], result)
+            rootSubscriptions.append(subRoot)
+            self.backend.invalidateSubscribers('')
+            return self.backend.getNotifications('test', [item])
+
+        def cb(result):
+            self.assertEquals(1, len(result))
+            subscriber, subscriptions, items = result[-1]
+            self.assertEquals(set([subRoot]), subscriptions)
+
+        self.storage = self.NodeStore({'test': TestNode(),
+                                       '': TestRootNode()})
+        self.backend = backend.BackendService(self.storage)
+        d = self.backend.getNotifications('test', [item])
+        d.addCallback(subscribeRoot)
+        d.addCallback(cb)
+        return d
+
+
+    def test_affiliationCached(self):
+        """
+        Affiliations are only retrieved from storage once per entity.
+        """
+        calls = []
+
+        class TestNode:
+            nodeIdentifier = 'test'
+
+            def getItems(self, maxItems=None):
+                return []
+
+        class TestStorage:
+            node = TestNode()
+
+            def getNode(self, nodeIdentifier):
+                return defer.succeed(self.node)
+
+            def getNodeAndAffiliation(self, nodeIdentifier, entity):
+                calls.append((nodeIdentifier, entity))
+                return defer.succeed((self.node, None))
+
+        def cb(result):
+            self.assertEquals(1, len(calls))
+            self.assertEquals(1, self.backend.affiliationCache.hits)
+
+        self.storage = TestStorage()
+        self.backend = backend.BackendService(self.storage)
+        d = self.backend.getItems('test', OWNER_FULL)
+        d.addCallback(lambda _: self.backend.getItems('test', OWNER))
+        d.addCallback(cb)
+        return d
+
+
+    def test_affiliationCachedPerNode(self):
+        """
+        Affiliations of several entities with a node share its cache entry.
+        """
+        other = jid.JID('other@example.com')
+
+        class TestNode:
+            nodeIdentifier = 'test'
+
+            def getItems(self, maxItems=None):
+                return []
+
+        class TestStorage:
+            node = TestNode()
+
+            def getNode(self, nodeIdentifier):
+                return defer.succeed(self.node)
+
+            def getNodeAndAffiliation(self, nodeIdentifier, entity):
+                return defer.succeed((self.node, None))
+
+        self.storage = TestStorage()
+        self.backend = backend.BackendService(self.storage)
+        d = self.backend.getItems('test', OWNER)
+        d.addCallback(lambda _: self.backend.getItems('test', other))
+        d.addCallback(lambda _: self.assertEquals(
+            {OWNER.full(): None, other.full(): None},
+            self.backend.affiliationCache['test']))
+        return d
+
+
+    def test_affiliationCacheExpires(self):
+        """
+        Cached affiliations are retrieved again after they expire.
+        """
+        calls = []
+        clock = task.Clock()
+
+        class TestNode:
+            nodeIdentifier = 'test'
+
+            def getItems(self, maxItems=None):
+                return []
+
+        class TestStorage:
+            node = TestNode()
+
+            def getNode(self, nodeIdentifier):
+                return defer.succeed(self.node)
+
+            def getNodeAndAffiliation(self, nodeIdentifier, entity):
+                calls.append((nodeIdentifier, entity))
+                return defer.succeed((self.node, None))
+
+        def cb(result):
+            self.assertEquals(2, len(calls))
+
+        self.storage = TestStorage()
+        self.backend = backend.BackendService(self.storage,
+                                              affiliationCacheTTL=60)
+        self.backend.affiliationCache.clock = clock
+        d = self.backend.getItems('test', OWNER)
+        d.addCallback(lambda _: clock.advance(60))
+        d.addCallback(lambda _: self.backend.getItems('test', OWNER))
+        d.addCallback(cb)
+        return d
+
+
+    def test_invalidateAffiliations(self):
+        """
+        Invalidating the affiliations with a node leaves other nodes alone.
+        """
+        self.backend = backend.BackendService(None)
+        cache = self.backend.affiliationCache
+        cache['test'] = {OWNER.full(): 'owner'}
+        cache['other'] = {OWNER.full(): 'owner'}
+        self.backend.invalidateAffiliations('test')
+        self.assertNotIn('test', cache)
+        self.assertIn('other', cache)
+
+
+    def test_invalidateAffiliationsOther(self):
+        """
+        Invalidating the affiliations with a node while those with another
+        are being retrieved does not keep the latter from being cached.
+        """
+        retrieved = defer.Deferred()
+        calls = []
+
+        class TestNode:
+            nodeIdentifier = 'test'
+
+            def getItems(self, maxItems=None):
+                return []
+
+        class TestStorage:
+            node = TestNode()
+
+            def getNode(self, nodeIdentifier):
+                return defer.succeed(self.node)
+
+            def getNodeAndAffiliation(self, nodeIdentifier, entity):
+                calls.append((nodeIdentifier, entity))
+                return retrieved
+
+        self.storage = TestStorage()
+        self.backend = backend.BackendService(self.storage)
+        d = self.backend.getItems('test', OWNER)
+        self.backend.invalidateAffiliations('other')
+        retrieved.callback((self.storage.node, 'owner'))
+        d.addCallback(lambda _: self.assertEquals(
+            {OWNER.full(): 'owner'}, self.backend.affiliationCache['test']))
+        return d
+
+
+    def test_invalidateAffiliationsAll(self):
+        """
+        Invalidating the affiliations with no node given clears the cache.
+        """
+        self.backend = backend.BackendService(None)
+        cache = self.backend.affiliationCache
+        cache['test'] = {OWNER.full(): 'owner'}
+        cache['other'] = {OWNER.full(): 'owner'}
+        self.backend.invalidateAffiliations(None)
+        self.assertEqual(0, len(cache))
+
+
+    def test_iterItemsOutcast(self):
+        """
+        Outcasts cannot retrieve items in batches.
+        """
+        class TestNode:
+            implements(iidavoll.ILeafNode)
+
+            def iterItems(self, callback, batchSize=100):
+                raise Exception("Unexpected call")
+
+        class TestStorage:
+            def getNodeAndAffiliation(self, nodeIdentifier, entity):
+                return defer.succeed((TestNode(), 'outcast'))
+
+        self.backend = backend.BackendService(TestStorage())
+        d = self.backend.iterItems('test', OWNER, lambda items: None)
+        self.assertFailure(d, error.Forbidden)
+        return d
+
+
     def test_getDefaultConfiguration(self):
         """
         L{backend.BackendService.getDefaultConfiguration} should return
@@ -300,9 +661,6 @@ class BackendTest(unittest.TestCase):
     def test_setNodeConfiguration(self):
         class testNode:
             nodeIdentifier = 'node'
-            def getAffiliation(self, entity):
-                if entity.userhostJID() == OWNER:
-                    return defer.succeed('owner')
             def setConfiguration(self, options):
                 self.options = options
 
@@ -311,6 +669,10 @@ class BackendTest(unittest.TestCase):
                 self.nodes = {'node': testNode()}
             def getNode(self, nodeIdentifier):
                 return defer.succeed(self.nodes[nodeIdentifier])
+            def getNodeAndAffiliation(self, nodeIdentifier, entity):
+                if entity.userhostJID() == OWNER:
+                    return defer.succeed((self.nodes[nodeIdentifier],
+                                          'owner'))
 
         def checkOptions(node):
             options = node.options
@@ -336,6 +698,76 @@ class BackendTest(unittest.TestCase):
         return d
 
 
+    def setMaxItems(self, value):
+        """
+        Set C{pubsub#max_items} on a node, returning the options stored.
+        """
+        class TestNode:
+            nodeIdentifier = 'node'
+            def setConfiguration(self, options):
+                self.options = options
+                return defer.succeed(None)
+
+        class TestStorage:
+            def getNodeAndAffiliation(self, nodeIdentifier, entity):
+                return defer.succeed((node, 'owner'))
+
+        node = TestNode()
+        self.backend = backend.BackendService(TestStorage())
+        d = self.backend.setNodeConfiguration('node',
+                                              {'pubsub#max_items': value},
+                                              OWNER_FULL)
+        d.addCallback(lambda _: node.options)
+        return d
+
+
+    def test_setNodeConfigurationMaxItems(self):
+        """
+        The maximum number of items is stored as a number.
+        """
+        d = self.setMaxItems(u'5')
+        d.addCallback(self.assertEqual, {'pubsub#max_items': 5})
+        return d
+
+
+    def test_setNodeConfigurationMaxItemsUnlimited(self):
+        """
+        The maximum number of items can be removed with C{max}.
+        """
+        d = self.setMaxItems(u'max')
+        d.addCallback(self.assertEqual, {'pubsub#max_items': None})
+        return d
+
+
+    def test_setNodeConfigurationMaxItemsInvalid(self):
+        """
+        The maximum number of items must be a positive number.
+        """
+        d = self.setMaxItems(u'many')
+        self.assertFailure(d, error.InvalidConfigurationValue)
+        d.addCallback(lambda _: self.setMaxItems(u'0'))
+        self.assertFailure(d, error.InvalidConfigurationValue)
+        return d
+
+
+    def test_getNodeConfigurationMaxItems(self):
+        """
+        The maximum number of items is returned as a form value.
+        """
+        class TestNode:
+            def getConfiguration(self):
+                return {'pubsub#max_items': 5}
+
+        class TestStorage:
+            def getNode(self, nodeIdentifier):
+                return defer.succeed(TestNode())
+
+        self.backend = backend.BackendService(TestStorage())
+        d = self.backend.getNodeConfiguration('node')
+        d.addCallback(self.assertEqual, {'pubsub#max_items': u'5'})
+        return d
+
+
     def test_publishNoID(self):
         """
         Test publish request with an item without a node identifier.
@@ -343,16 +775,14 @@ class BackendTest(unittest.TestCase):
         class TestNode:
             nodeType = 'leaf'
             nodeIdentifier = 'node'
-            def getAffiliation(self, entity):
-                if entity.userhostJID() == OWNER:
-                    return defer.succeed('owner')
             def getConfiguration(self):
                 return {'pubsub#deliver_payloads': True,
                         'pubsub#persist_items': False}
 
         class TestStorage:
-            def getNode(self, nodeIdentifier):
-                return defer.succeed(TestNode())
+            def getNodeAndAffiliation(self, nodeIdentifier, entity):
+                if entity.userhostJID() == OWNER:
+                    return defer.succeed((TestNode(), 'owner'))
 
         def checkID(notification):
             self.assertNotIdentical(None, notification['items'][0]['id'])
@@ -368,6 +798,82 @@ class BackendTest(unittest.TestCase):
         return d
 
 
+    def test_publishSerializesOnce(self):
+        """
+        Published items are stored and notified in serialized form.
+        """
+        stored = []
+
+        class TestNode:
+            nodeType = 'leaf'
+            nodeIdentifier = 'node'
+            def getConfiguration(self):
+                return {'pubsub#deliver_payloads': True,
+                        'pubsub#persist_items': True}
+            def storeItems(self, items, publisher):
+                stored.extend(items)
+                return defer.succeed(None)
+
+        class TestStorage:
+            def getNodeAndAffiliation(self, nodeIdentifier, entity):
+                return defer.succeed((TestNode(), 'owner'))
+
+        def check(notification):
+            self.assertEquals(stored, notification['items'])
+
+        self.backend = backend.BackendService(TestStorage())
+        self.backend.registerNotifier(check)
+
+        item = pubsub.Item('item1')
+        item.addElement(('testns', 'test'))
+        d = self.backend.publish('node', [item], OWNER_FULL)
+        d.addCallback(lambda _: self.assertEquals(
+            [u"<item id='item1'><test xmlns='testns'/></item>"], stored))
+        d.addCallback(lambda _: self.assertIsInstance(stored[0],
+                                                      SerializedItem))
+        return d
+
+
+    def test_publishNoPayloads(self):
+        """
+        Notifications for nodes that do not deliver payloads omit them.
+        """
+        stored = []
+        notified = []
+
+        class TestNode:
+            nodeType = 'leaf'
+            nodeIdentifier = 'node'
+            def getConfiguration(self):
+                return {'pubsub#deliver_payloads': False,
+                        'pubsub#persist_items': True}
+            def storeItems(self, items, publisher):
+                stored.extend(items)
+                return defer.succeed(None)
+
+        class TestStorage:
+            def getNodeAndAffiliation(self, nodeIdentifier, entity):
+                return defer.succeed((TestNode(), 'owner'))
+
+        def cb(result):
+            self.assertEquals(u"<item id='item1'><test xmlns='testns'/>"
+                              u"</item>", stored[0])
+            self.assertEquals(u"<item id='item1'/>",
+                              notified[0]['items'][0].toXml())
+
+        def notify(data):
+            notified.append(data)
+
+        self.backend = backend.BackendService(TestStorage())
+        self.backend.registerNotifier(notify)
+
+        item = pubsub.Item('item1')
+        item.addElement(('testns', 'test'))
+        d = self.backend.publish('node', [item], OWNER_FULL)
+        d.addCallback(cb)
+        return d
+
+
     def test_notifyOnSubscription(self):
         """
         Test notification of last published item on subscription.
@@ -378,9 +884,6 @@ class BackendTest(unittest.TestCase):
             implements(iidavoll.ILeafNode)
             nodeIdentifier = 'node'
             nodeType = 'leaf'
-            def getAffiliation(self, entity):
-                if entity is OWNER:
-                    return defer.succeed('owner')
             def getConfiguration(self):
                 return {'pubsub#deliver_payloads': True,
                         'pubsub#persist_items': False,
@@ -397,6 +900,9 @@ class BackendTest(unittest.TestCase):
         class TestStorage:
             def getNode(self, nodeIdentifier):
                 return defer.succeed(TestNode())
+            def getNodeAndAffiliation(self, nodeIdentifier, entity):
+                if entity is OWNER:
+                    return defer.succeed((TestNode(), 'owner'))
 
         def cb(data):
             self.assertEquals('node', data['nodeIdentifier'])
@@ -488,6 +994,144 @@ class PubSubResourceFromBackendTest(unittest.TestCase):
         return defer.DeferredList([d1, d2], fireOnOneErrback=1)
 
 
+    def test_notify(self):
+        """
+        Publish notifications are sent to each subscriber, with collection
+        headers for subscriptions to the root node.
+        """
+        item = pubsub.Item(id='1', payload=u'Test \u2083 item')
+        subscriber = jid.JID('subscriber@example.org/Home')
+        sub = pubsub.Subscription('test', OWNER_FULL, 'subscribed')
+        subRoot = pubsub.Subscription('', subscriber, 'subscribed')
+
+        class TestBackend(BaseTestBackend):
+            def getNotifications(self, nodeIdentifier, items):
+                return defer.succeed([(OWNER_FULL, set([sub]), items),
+                                      (subscriber, set([subRoot]), items)])
+
+        sent = []
+        resource = backend.PubSubResourceFromBackend(TestBackend())
+        resource.serviceJID = SERVICE
+        resource.pubsubService = pubsub.PubSubService()
+        resource.pubsubService.send = sent.append
+        clock = task.Clock()
+        resource.cooperator = task.Cooperator(
+                scheduler=lambda f: clock.callLater(0, f))
+        resource._notify({'items': [item], 'nodeIdentifier': 'test'})
+        clock.advance(0)
+
+        self.assertEquals(2, len(sent))
+        messages = [parseXml(data) for data in sent]
+
+        for message, recipient in zip(messages, [OWNER_FULL, subscriber]):
+            self.assertEquals(SERVICE.full(), message['from'])
+            self.assertEquals(recipient.full(), message['to'])
+            items = message.event.items
+            self.assertEquals(NS_PUBSUB_EVENT, items.uri)
+            self.assertEquals('test', items['node'])
+            self.assertEquals(item.toXml(), items.item.toXml())
+
+        self.assertEquals({}, shim.extractHeaders(messages[0]))
+        self.assertEquals({'Collection': ['']},
+                          shim.extractHeaders(messages[1]))
+
+
+    def test_notifyChunked(self):
+        """
+        Notifications are sent in chunks, one chunk per iteration when the
+        time budget is used up, while keeping track of the backlog.
+        """
+        item = pubsub.Item(id='1')
+        subscribers = [jid.JID('subscriber%d@example.org' % i)
+                       for i in xrange(5)]
+
+        class TestBackend(BaseTestBackend):
+            def getNotifications(self, nodeIdentifier, items):
+                return defer.succeed([(subscriber,
+                                       [pubsub.Subscription('test',
+                                                            subscriber,
+                                                            'subscribed')],
+                                       items)
+                                      for subscriber in subscribers])
+
+        sent = []
+        resource = backend.PubSubResourceFromBackend(TestBackend())
+        resource.serviceJID = SERVICE
+        resource.pubsubService = pubsub.PubSubService()
+        resource.pubsubService.send = sent.append
+        resource.fanOutChunkSize = 2
+        clock = task.Clock()
+        resource.cooperator = task.Cooperator(
+                terminationPredicateFactory=lambda: lambda: True,
+                scheduler=lambda f: clock.callLater(1, f))
+        resource._notify({'items': [item], 'nodeIdentifier': 'test'})
+
+        self.assertEquals(0, len(sent))
+        self.assertEquals(5, resource.fanOutBacklog)
+        clock.advance(1)
+        self.assertEquals(2, len(sent))
+        self.assertEquals(3, resource.fanOutBacklog)
+        clock.advance(1)
+        self.assertEquals(4, len(sent))
+        clock.advance(1)
+        self.assertEquals(5, len(sent))
+        self.assertEquals(0, resource.fanOutBacklog)
+
+
+    def test_fanOutLogger(self):
+        """
+        The notification backlog and the notifications sent since the
+        previous report are logged.
+        """
+        item = pubsub.Item(id='1')
+        subscribers = [jid.JID('subscriber%d@example.org' % i)
+                       for i in xrange(5)]
+
+        class TestBackend(BaseTestBackend):
+            def getNotifications(self, nodeIdentifier, items):
+                return defer.succeed([(subscriber,
+                                       [pubsub.Subscription('test',
+                                                            subscriber,
+                                                            'subscribed')],
+                                       items)
+                                      for subscriber in subscribers])
+
+        messages = []
+        observer = lambda event: messages.append(log.textFromEventDict(event))
+        log.addObserver(observer)
+        self.addCleanup(log.removeObserver, observer)
+
+        resource = backend.PubSubResourceFromBackend(TestBackend())
+        resource.serviceJID = SERVICE
+        resource.pubsubService = pubsub.PubSubService()
+        resource.pubsubService.send = lambda obj: None
+        resource.fanOutChunkSize = 2
+        clock = task.Clock()
+        resource.cooperator = task.Cooperator(
+                terminationPredicateFactory=lambda: lambda: True,
+                scheduler=lambda f: clock.callLater(1, f))
+        logger = backend.FanOutLogger(resource)
+        resource._notify({'items': [item], 'nodeIdentifier': 'test'})
+        clock.advance(1)
+        logger.report()
+        clock.advance(1)
+        clock.advance(1)
+        logger.report()
+
+        self.assertEquals(["Notifications: 3 waiting, 2 sent",
+                           "Notifications: 0 waiting, 3 sent"], messages)
+
+
+    def test_notificationTemplateEscaping(self):
+        """
+        The recipient is escaped when rendering a notification.
+        """
+        template = backend.NotificationTemplate(SERVICE, 'test', [])
+        data = template.render(jid.JID(u'a@example.org/b&c\u00e9"'))
+        message = parseXml(data)
+        self.assertEquals(u'a@example.org/b&c\u00e9"', message['to'])
+
+
     def test_preDeleteRedirect(self):
         """
         Test pre-delete sending out notifications to subscribers.
@@ -549,6 +1193,167 @@ class PubSubResourceFromBackendTest(unittest.TestCase):
         return d
 
 
+    def test_itemsRSM(self):
+        """
+        Items requests with a result set request return a page of items.
+        """
+        xml = """
+        <iq type='get' to='pubsub.example.org'
+                       from='user@example.org'>
+          <pubsub xmlns='http://jabber.org/protocol/pubsub'>
+            <items node='test'/>
+            <set xmlns='http://jabber.org/protocol/rsm'>
+              <max>2</max>
+              <after>item3</after>
+            </set>
+          </pubsub>
+        </iq>
+        """
+
+        calls = []
+
+        class TestBackend(BaseTestBackend):
+            def getItems(self, nodeIdentifier, requestor, maxItems=None,
+                               itemIdentifiers=None, after=None, before=None):
+                calls.append((maxItems, after, before))
+                return defer.succeed([pubsub.Item('item2'),
+                                      pubsub.Item('item1')])
+
+        def cb(result):
+            self.assertEquals([(2, 'item3', None)], calls)
+            self.assertEquals('item2', result.rsm.first)
+            self.assertEquals('item1', result.rsm.last)
+
+        resource = backend.PubSubResourceFromBackend(TestBackend())
+        request = pubsub.PubSubRequest.fromElement(parseXml(xml))
+        d = resource.items(request)
+        d.addCallback(cb)
+        return d
+
+
+    def test_itemsRSMDefaultPageSize(self):
+        """
+        Result set requests without a maximum get the default page size.
+        """
+        xml = """
+        <iq type='get' to='pubsub.example.org'
+                       from='user@example.org'>
+          <pubsub xmlns='http://jabber.org/protocol/pubsub'>
+            <items node='test'/>
+            <set xmlns='http://jabber.org/protocol/rsm'>
+              <before/>
+            </set>
+          </pubsub>
+        </iq>
+        """
+
+        calls = []
+
+        class TestBackend(BaseTestBackend):
+            def getItems(self, nodeIdentifier, requestor, maxItems=None,
+                               itemIdentifiers=None, after=None, before=None):
+                calls.append((maxItems, after, before))
+                return defer.succeed([])
+
+        def cb(result):
+            self.assertEquals([(10, None, '')], calls)
+            self.assertIdentical(None, result.rsm.first)
+
+        resource = backend.PubSubResourceFromBackend(TestBackend())
+        resource.defaultPageSize = 10
+        request = pubsub.PubSubRequest.fromElement(parseXml(xml))
+        d = resource.items(request)
+        d.addCallback(cb)
+        return d
+
+
+    def test_itemsRSMItemNotFound(self):
+        """
+        A cursor referring to a non-existing item results in an error.
+        """
+
+        class TestBackend(BaseTestBackend):
+            def getItems(self, nodeIdentifier, requestor, maxItems=None,
+                               itemIdentifiers=None, after=None, before=None):
+                return defer.fail(error.ItemNotFound())
+
+        def cb(e):
+            self.assertEquals('item-not-found', e.condition)
+
+        resource = backend.PubSubResourceFromBackend(TestBackend())
+        request = pubsub.PubSubRequest()
+        request.sender = OWNER
+        request.recipient = SERVICE
+        request.nodeIdentifier = 'test'
+        d = resource.items(request)
+        self.assertFailure(d, StanzaError)
+        d.addCallback(cb)
+        return d
+
+
+    def itemsEmptyPage(self, storage):
+        """
+        Request an empty page of items of node C{test}.
+        """
+        xml = """
+        <iq type='get' to='pubsub.example.org'
+                       from='user@example.org'>
+          <pubsub xmlns='http://jabber.org/protocol/pubsub'>
+            <items node='test'/>
+            <set xmlns='http://jabber.org/protocol/rsm'>
+              <max>0</max>
+            </set>
+          </pubsub>
+        </iq>
+        """
+
+        resource = backend.PubSubResourceFromBackend(
+                backend.BackendService(storage))
+        request = pubsub.PubSubRequest.fromElement(parseXml(xml))
+        return resource.items(request)
+
+
+    def test_itemsRSMEmptyPage(self):
+        """
+        A result set request for no items returns an empty page.
+        """
+        storage = memory_storage.Storage()
+        storage.createNode('test', OWNER, {'pubsub#node_type': 'leaf'})
+        d = self.itemsEmptyPage(storage)
+        d.addCallback(lambda result: self.assertEquals([], result))
+        return d
+
+
+    def test_itemsRSMEmptyPageNodeNotFound(self):
+        """
+        A result set request for no items of a non-existing node results
+        in an error.
+        """
+        def cb(e):
+            self.assertEquals('item-not-found', e.condition)
+
+        d = self.itemsEmptyPage(memory_storage.Storage())
+        self.assertFailure(d, StanzaError)
+        d.addCallback(cb)
+        return d
+
+
+    def test_itemsRSMEmptyPageOutcast(self):
+        """
+        A result set request for no items by an outcast is forbidden.
+        """
+        def cb(e):
+            self.assertEquals('forbidden', e.condition)
+
+        storage = memory_storage.Storage()
+        storage.createNode('test', OWNER, {'pubsub#node_type': 'leaf'})
+        storage._nodes['test']._affiliations['user@example.org'] = 'outcast'
+        d = self.itemsEmptyPage(storage)
+        self.assertFailure(d, StanzaError)
+        d.addCallback(cb)
+        return d
+
+
     def test_getInfo(self):
         """
         Test retrieving node information.
@@ -0,0 +1,149 @@
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Tests for L{idavoll.cache}.
+"""
+
+from twisted.internet import task
+from twisted.trial import unittest
+
+from idavoll.cache import LRUCache
+
+class LRUCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.cache = LRUCache(2, clock=self.clock)
+
+
+    def test_getItem(self):
+        self.cache['a'] = 1
+        self.assertEquals(1, self.cache['a'])
+        self.assertEquals(1, self.cache.hits)
+        self.assertEquals(0, self.cache.misses)
+
+
+    def test_getItemMissing(self):
+        self.assertRaises(KeyError, self.cache.__getitem__, 'a')
+        self.assertEquals(0, self.cache.hits)
+        self.assertEquals(1, self.cache.misses)
+
+
+    def test_getCachedNone(self):
+        """
+        C{None} is a valid value to cache.
+        """
+        self.cache['a'] = None
+        self.assertIdentical(None, self.cache['a'])
+        self.assertIdentical(None, self.cache.get('a', 1))
+
+
+    def test_evictLeastRecentlyUsed(self):
+        self.cache['a'] = 1
+        self.cache['b'] = 2
+        self.cache['a']
+        self.cache['c'] = 3
+        self.assertEquals(2, len(self.cache))
+        self.assertIn('a', self.cache)
+        self.assertNotIn('b', self.cache)
+        self.assertIn('c', self.cache)
+
+
+    def test_replace(self):
+        self.cache['a'] = 1
+        self.cache['a'] = 2
+        self.assertEquals(1, len(self.cache))
+        self.assertEquals(2, self.cache['a'])
+
+
+    def test_ttl(self):
+        self.cache.ttl = 10
+        self.cache['a'] = 1
+        self.clock.advance(9)
+        self.assertEquals(1, self.cache['a'])
+        self.clock.advance(1)
+        self.assertRaises(KeyError, self.cache.__getitem__, 'a')
+        self.assertEquals(0, len(self.cache))
+
+
+    def test_keys(self):
+        self.cache['a'] = 1
+        self.cache['b'] = 2
+        self.assertEquals(set(['a', 'b']), set(self.cache.keys()))
+
+
+    def test_discard(self):
+        self.cache['a'] = 1
+        self.cache.discard('a')
+        self.cache.discard('b')
+        self.assertNotIn('a', self.cache)
+
+
+    def test_clear(self):
+        self.cache['a'] = 1
+        self.cache['b'] = 2
+        self.cache.clear()
+        self.assertEquals(0, len(self.cache))
+        self.cache['c'] = 3
+        self.assertEquals(3, self.cache['c'])
+
+
+    def test_setGeneration(self):
+        """
+        Values retrieved before an invalidation are not stored.
+        """
+        generation = self.cache.generation
+        self.cache.discard('a')
+        self.cache.set('a', 1, generation)
+        self.assertNotIn('a', self.cache)
+        self.cache.set('a', 2, self.cache.generation)
+        self.assertEquals(2, self.cache['a'])
+
+
+    def test_setGenerationOtherKey(self):
+        """
+        Invalidating an entry does not keep others from being stored.
+        """
+        generation = self.cache.generation
+        self.cache.discard('a')
+        self.cache.set('b', 1, generation)
+        self.assertEquals(1, self.cache['b'])
+
+
+    def test_setGenerationClear(self):
+        """
+        Values retrieved before all entries were invalidated are not stored.
+        """
+        generation = self.cache.generation
+        self.cache.clear()
+        self.cache.set('a', 1, generation)
+        self.assertNotIn('a', self.cache)
+
+
+    def test_setGenerationManyInvalidations(self):
+        """
+        Values retrieved before more than C{size} invalidations are not
+        stored.
+        """
+        generation = self.cache.generation
+        self.cache.discard('a')
+        self.cache.discard('b')
+        self.cache.discard('c')
+        self.assertFalse(self.cache.current('a', generation))
+        self.assertFalse(self.cache.current('d', generation))
+        self.assertTrue(self.cache.current('d', self.cache.generation))
+
+
+    def test_disabled(self):
+        cache = LRUCache(0)
+        cache['a'] = 1
+        self.assertNotIn('a', cache)
+
+
+    def test_hitRate(self):
+        self.assertEquals(0.0, self.cache.hitRate())
+        self.cache['a'] = 1
+        self.cache.get('a')
+        self.cache.get('b')
+        self.assertEquals(0.5, self.cache.hitRate())
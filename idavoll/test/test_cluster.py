@@ -0,0 +1,272 @@
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Tests for L{idavoll.cluster}.
+"""
+
+from twisted.internet import defer
+from twisted.trial import unittest
+from twisted.words.protocols.jabber import jid
+from twisted.words.xish import utility
+
+from idavoll.cluster import NOTIFY, PURGE, RETRACT, EventBus, Partition
+from idavoll.codec import SerializedItem
+
+class PartitionTest(unittest.TestCase):
+    """
+    Tests for L{Partition}.
+    """
+
+    def test_contains(self):
+        """
+        Every entity is in exactly one of the partitions.
+        """
+        partitions = [Partition(index, 3) for index in xrange(3)]
+        for n in xrange(100):
+            entity = jid.JID('user%d@example.org' % n)
+            self.assertEqual(1, len([partition for partition in partitions
+                                     if entity in partition]))
+
+
+    def test_containsBareJID(self):
+        """
+        All resources of an entity are in the same partition.
+        """
+        partition = Partition(0, 2)
+        for n in xrange(10):
+            entity = jid.JID('user%d@example.org' % n)
+            self.assertEqual(entity in partition,
+                             jid.JID('user%d@example.org/Home' % n)
+                             in partition)
+
+
+    def test_indexOutOfRange(self):
+        """
+        The index of a partition must be lower than the number of
+        partitions.
+        """
+        self.assertRaises(ValueError, Partition, 2, 2)
+
+
+
+class FakeListener(object):
+
+    def startService(self):
+        pass
+
+
+    def stopService(self):
+        pass
+
+
+
+class FakeCursor(object):
+
+    def __init__(self, executed):
+        self.executed = executed
+
+
+    def execute(self, query, args):
+        self.executed.append(args)
+
+
+
+class FakePool(object):
+    """
+    Pool that records the queries of interactions, without running them.
+    """
+
+    def __init__(self):
+        self.executed = []
+
+
+    def runInteraction(self, interaction, *args, **kwargs):
+        list(interaction(FakeCursor(self.executed), *args, **kwargs))
+        return defer.succeed(None)
+
+
+
+class EventBusTest(unittest.TestCase):
+    """
+    Tests for L{EventBus}.
+    """
+
+    def setUp(self):
+        self.backend, self.bus = self.makeBus()
+        self.otherBackend, self.otherBus = self.makeBus()
+        self.received = []
+        self.otherBackend.addObserver(NOTIFY, self.receive)
+        self.otherBackend.addObserver(RETRACT, self.receive)
+        self.otherBackend.addObserver(PURGE, self.receive)
+
+
+    def receive(self, data):
+        self.received.append(data)
+
+
+    def makeBus(self):
+        backend = utility.EventDispatcher()
+        bus = EventBus(backend, FakePool())
+        bus.listener = FakeListener()
+        bus.startService()
+        self.addCleanup(bus.stopService)
+        return backend, bus
+
+
+    def deliver(self):
+        """
+        Deliver the events broadcast by L{bus} to L{otherBus}.
+        """
+        for channel, payload in self.bus.dbpool.executed:
+            self.assertEqual(self.bus.channel, channel)
+            self.otherBus.notificationReceived(payload)
+
+
+    def test_notify(self):
+        """
+        Publish notifications are dispatched by the other backends.
+        """
+        item = SerializedItem(u"<item id='1'><test>\u2083</test></item>")
+        self.backend.dispatch({'items': [item], 'nodeIdentifier': 'test'},
+                              NOTIFY)
+        self.deliver()
+        self.assertEqual(1, len(self.received))
+        self.assertEqual('test', self.received[0]['nodeIdentifier'])
+        self.assertEqual([item.toXml()],
+                         [received.toXml()
+                          for received in self.received[0]['items']])
+
+
+    def test_retract(self):
+        """
+        Retractions are dispatched by the other backends.
+        """
+        self.backend.dispatch({'itemIdentifiers': ['1', '2'],
+                               'nodeIdentifier': 'test'},
+                              RETRACT)
+        self.deliver()
+        self.assertEqual([{'itemIdentifiers': ['1', '2'],
+                           'nodeIdentifier': 'test'}], self.received)
+
+
+    def test_purge(self):
+        """
+        Purges are dispatched by the other backends.
+        """
+        self.backend.dispatch('test', PURGE)
+        self.deliver()
+        self.assertEqual(['test'], self.received)
+
+
+    def test_chunked(self):
+        """
+        Large events are split into chunks that fit a notification.
+        """
+        item = SerializedItem(u"<item id='1'>%s</item>" % (u'x' * 20000))
+        self.backend.dispatch({'items': [item], 'nodeIdentifier': 'test'},
+                              NOTIFY)
+        payloads = [payload for _, payload in self.bus.dbpool.executed]
+        self.assertEqual(3, len(payloads))
+        for payload in payloads:
+            self.assertTrue(len(payload) < 8000)
+
+        self.deliver()
+        self.assertEqual(1, len(self.received))
+        self.assertEqual(item.toXml(), self.received[0]['items'][0].toXml())
+
+
+    def test_ownEvents(self):
+        """
+        Events broadcast by a bus are not dispatched again by its backend.
+        """
+        self.backend.addObserver(PURGE, self.receive)
+        self.backend.dispatch('test', PURGE)
+        for channel, payload in self.bus.dbpool.executed:
+            self.bus.notificationReceived(payload)
+        self.assertEqual(['test'], self.received)
+
+
+    def test_notRebroadcast(self):
+        """
+        Events received from other processes are not broadcast again.
+        """
+        self.backend.dispatch('test', PURGE)
+        self.deliver()
+        self.assertEqual(['test'], self.received)
+        self.assertEqual([], self.otherBus.dbpool.executed)
+
+
+    def test_lastPublishedNotBroadcast(self):
+        """
+        Notifications for a single subscription are not broadcast.
+        """
+        self.backend.dispatch({'items': [], 'nodeIdentifier': 'test',
+                               'subscription': None},
+                              NOTIFY)
+        self.assertEqual([], self.bus.dbpool.executed)
+
+
+    def test_stopService(self):
+        """
+        Events are no longer broadcast when the bus has been stopped.
+        """
+        self.bus.stopService()
+        self.backend.dispatch('test', PURGE)
+        self.assertEqual([], self.bus.dbpool.executed)
+
+
+
+class EventBusPostgresTest(unittest.TestCase):
+    """
+    Tests for L{EventBus} broadcasting through PostgreSQL.
+    """
+
+    def setUp(self):
+        from idavoll.dbpool import ConnectionPool
+
+        self.dbpool = ConnectionPool('psycopg2', database='pubsub_test')
+        self.dbpool.start()
+        self.addCleanup(self.dbpool.close)
+
+        self.received = []
+        self.backend = utility.EventDispatcher()
+        self.otherBackend = utility.EventDispatcher()
+        self.otherBackend.addObserver(NOTIFY, self.receive)
+        self.bus = EventBus(self.backend, self.dbpool, 'idavoll_test',
+                            database='pubsub_test')
+        self.otherBus = EventBus(self.otherBackend, self.dbpool,
+                                 'idavoll_test', database='pubsub_test')
+        self.addCleanup(self.bus.stopService)
+        self.addCleanup(self.otherBus.stopService)
+        return defer.gatherResults([self.bus.startService(),
+                                    self.otherBus.startService()])
+
+
+    def receive(self, data):
+        self.received.append(data)
+
+
+    def test_notify(self):
+        """
+        Publish notifications reach the backends of other processes.
+        """
+        from idavoll.test.test_dbpool import waitFor
+
+        item = SerializedItem(u"<item id='1'>%s</item>" % (u'x' * 10000))
+        self.backend.dispatch({'items': [item], 'nodeIdentifier': 'test'},
+                              NOTIFY)
+        d = waitFor(lambda: self.received)
+        d.addCallback(lambda _: self.assertEqual(
+            [item.toXml()],
+            [received.toXml() for received in self.received[0]['items']]))
+        return d
+
+
+
+try:
+    import psycopg2
+    psycopg2
+except ImportError:
+    EventBusTest.skip = "psycopg2 not available"
+    EventBusPostgresTest.skip = "psycopg2 not available"
@@ -0,0 +1,152 @@
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Tests for L{idavoll.codec}.
+"""
+
+from twisted.trial import unittest
+from twisted.words.xish import domish
+
+from idavoll import codec
+from idavoll.codec import SerializedItem
+
+class SerializedItemTest(unittest.TestCase):
+
+    def test_fromElement(self):
+        """
+        The serialized form of a parsed item is kept with the item.
+        """
+        element = domish.Element((None, 'item'))
+        element['id'] = 'item1'
+        item = SerializedItem.fromElement(element)
+        self.assertEquals(element.toXml(), item.toXml())
+        self.assertIdentical(element, item.element)
+
+
+    def test_elementLazy(self):
+        """
+        The item is only parsed when accessed.
+        """
+        item = SerializedItem(u"<item id='item1'><test xmlns='testns'>"
+                              u"\u2083</test></item>")
+        self.assertIdentical(None, item._element)
+        self.assertEquals(u'item1', item.element['id'])
+        self.assertEquals((None, 'item'), (item.element.uri,
+                                           item.element.name))
+        self.assertEquals(u'\u2083', unicode(item.element.test))
+
+
+    def test_getAttribute(self):
+        item = SerializedItem(u"<item id='item1'/>")
+        self.assertEquals(u'item1', item.getAttribute('id'))
+        self.assertIdentical(None, item.getAttribute('publisher'))
+
+
+    def test_getItem(self):
+        """
+        Indexing with a string returns an attribute.
+        """
+        item = SerializedItem(u"<item id='item1'/>")
+        self.assertEquals(u'item1', item['id'])
+        self.assertEquals(u'<', item[0])
+
+
+    def test_serializeAsChild(self):
+        """
+        An item is included verbatim when serializing its parent.
+        """
+        item = SerializedItem(u"<item id='item1'><test xmlns='testns'/></item>")
+        items = domish.Element((None, 'items'))
+        items.addChild(item)
+        self.assertEquals(u"<items><item id='item1'><test xmlns='testns'/>"
+                          u"</item></items>",
+                          items.toXml())
+
+
+
+class ParseTestsMixin(object):
+    """
+    Tests for parsers in L{idavoll.codec.parsers}.
+    """
+
+    def assertEquivalent(self, expected, element):
+        self.assertEquals((expected.uri, expected.name, expected.defaultUri),
+                          (element.uri, element.name, element.defaultUri))
+        self.assertEquals(expected.attributes, element.attributes)
+        self.assertEquals(expected.localPrefixes, element.localPrefixes)
+        self.assertEquals(len(expected.children), len(element.children))
+        for expectedChild, child in zip(expected.children, element.children):
+            if isinstance(expectedChild, domish.Element):
+                self.assertIdentical(element, child.parent)
+                self.assertEquivalent(expectedChild, child)
+            else:
+                self.assertEquals(expectedChild, child)
+
+
+    def test_parse(self):
+        xml = ("<item xmlns='http://jabber.org/protocol/pubsub' id='1'>"
+               "<entry xmlns='http://www.w3.org/2005/Atom' xmlns:t='urn:t'>"
+               "<title type='text' t:lang='en'>Test &amp; \xe2\x82\x83</title>"
+               "<t:extra><t:value>1</t:value><plain/></t:extra>"
+               "<content><div xmlns='http://www.w3.org/1999/xhtml'>"
+               "<p>Some <em>text</em>.</p></div></content>"
+               "</entry></item>")
+
+        item = domish.Element(('http://jabber.org/protocol/pubsub', 'item'))
+        item['id'] = '1'
+        entry = item.addElement(('http://www.w3.org/2005/Atom', 'entry'))
+        entry.localPrefixes = {'t': 'urn:t'}
+        title = entry.addElement('title', content=u'Test & \u2083')
+        title['type'] = 'text'
+        title[('urn:t', 'lang')] = 'en'
+        extra = entry.addElement(('urn:t', 'extra'), entry.defaultUri)
+        extra.addElement(('urn:t', 'value'), entry.defaultUri, u'1')
+        extra.addElement('plain')
+        content = entry.addElement('content')
+        div = content.addElement(('http://www.w3.org/1999/xhtml', 'div'))
+        p = div.addElement('p', content=u'Some ')
+        p.addElement('em', content=u'text')
+        p.addContent(u'.')
+
+        self.assertEquivalent(item, self.parse(xml))
+
+
+    def test_parseInvalid(self):
+        self.assertRaises(domish.ParserError, self.parse, "<item></other>")
+
+
+
+class DomishParseTest(unittest.TestCase, ParseTestsMixin):
+
+    def setUp(self):
+        self.parse = codec.parsers['domish']
+
+
+
+class ExpatParseTest(unittest.TestCase, ParseTestsMixin):
+
+    def setUp(self):
+        self.parse = codec.parsers['expat']
+
+
+    def test_rootCharacterData(self):
+        element = self.parse("<item>text</item>")
+        self.assertEquals([u'text'], element.children)
+
+
+
+class SetParserTest(unittest.TestCase):
+
+    def tearDown(self):
+        codec.setParser('domish')
+
+
+    def test_setParser(self):
+        codec.setParser('expat')
+        item = SerializedItem(u"<item id='item1'>text</item>")
+        self.assertEquals([u'text'], item.element.children)
+
+
+    def test_setParserUnknown(self):
+        self.assertRaises(ValueError, codec.setParser, 'unknown')
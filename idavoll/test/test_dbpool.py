@@ -0,0 +1,650 @@
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Tests for L{idavoll.dbpool}.
+"""
+
+from twisted.internet import defer, reactor, task
+from twisted.trial import unittest
+
+try:
+    from idavoll.dbpool import NotificationListener, PoolMetrics, PoolSizer
+    from idavoll.dbpool import ReplicaRouter, returnValue
+except ImportError:
+    pass
+
+JID = 'dbpool@example.org'
+CHANNEL = 'idavoll_test'
+
+@defer.inlineCallbacks
+def waitFor(condition, timeout=5):
+    """
+    Wait until C{condition} returns true, polling the reactor.
+    """
+    for i in xrange(int(timeout / 0.01)):
+        if condition():
+            return
+        yield task.deferLater(reactor, 0.01, lambda: None)
+    raise AssertionError("Condition not met within %s seconds" % timeout)
+
+
+
+class ConnectionPoolTestsMixin:
+    """
+    Tests for running generator based interactions, for both pools.
+    """
+
+    def setUp(self):
+        self.dbpool = self.makePool()
+
+
+    def tearDown(self):
+        d = self.dbpool.runOperation("""DELETE FROM entities WHERE jid=%s""",
+                                     (JID,))
+        d.addCallback(lambda _: self.dbpool.close())
+        return d
+
+
+    def test_runInteraction(self):
+        """
+        The result of an interaction is passed with returnValue.
+        """
+        def interaction(cursor, value):
+            yield cursor.execute("""SELECT %s""", (value,))
+            returnValue(cursor.fetchone()[0])
+
+        d = self.dbpool.runInteraction(interaction, 1)
+        d.addCallback(self.assertEqual, 1)
+        return d
+
+
+    def test_runInteractionNested(self):
+        """
+        Interactions yielded from an interaction are run, passing back their
+        result.
+        """
+        def inner(cursor):
+            yield cursor.execute("""SELECT 2""")
+            returnValue(cursor.fetchone()[0])
+
+        def outer(cursor):
+            value = yield inner(cursor)
+            returnValue(value + 1)
+
+        d = self.dbpool.runInteraction(outer)
+        d.addCallback(self.assertEqual, 3)
+        return d
+
+
+    def test_runInteractionNestedError(self):
+        """
+        Exceptions in nested interactions are raised in the outer one.
+        """
+        def inner(cursor):
+            yield cursor.execute("""SELECT 1/0""")
+
+        def outer(cursor):
+            try:
+                yield inner(cursor)
+            except self.dbpool.dbapi.DataError:
+                returnValue('caught')
+
+        d = self.dbpool.runInteraction(outer)
+        d.addCallback(self.assertEqual, 'caught')
+        return d
+
+
+    def test_runInteractionReturnNotCaught(self):
+        """
+        Passing a result is not mistaken for an error by interactions
+        catching exceptions.
+        """
+        def interaction(cursor):
+            yield cursor.execute("""SELECT 1""")
+            try:
+                returnValue(cursor.fetchone()[0])
+            except Exception:
+                returnValue('caught')
+
+        d = self.dbpool.runInteraction(interaction)
+        d.addCallback(self.assertEqual, 1)
+        return d
+
+
+    def test_runInteractionCall(self):
+        """
+        Calls yielded from an interaction are made, waiting for Deferreds.
+        """
+        from idavoll.dbpool import Call
+
+        def interaction(cursor):
+            value = yield Call(defer.succeed, 4)
+            returnValue(value)
+
+        d = self.dbpool.runInteraction(interaction)
+        d.addCallback(self.assertEqual, 4)
+        return d
+
+
+    def test_runInteractionRollback(self):
+        """
+        The transaction of a failing interaction is rolled back.
+        """
+        def interaction(cursor):
+            yield cursor.execute("""INSERT INTO entities (jid) VALUES (%s)""",
+                                 (JID,))
+            raise ValueError()
+
+        d = self.dbpool.runInteraction(interaction)
+        self.assertFailure(d, ValueError)
+        d.addCallback(lambda _: self.dbpool.runQuery(
+            """SELECT count(*) FROM entities WHERE jid=%s""", (JID,)))
+        d.addCallback(lambda result: self.assertEqual(0, result[0][0]))
+        return d
+
+
+    def test_runInteractionCommit(self):
+        """
+        The transaction of an interaction is committed when it returns.
+        """
+        def interaction(cursor):
+            yield cursor.execute("""INSERT INTO entities (jid) VALUES (%s)""",
+                                 (JID,))
+
+        d = self.dbpool.runInteraction(interaction)
+        d.addCallback(lambda _: self.dbpool.runQuery(
+            """SELECT count(*) FROM entities WHERE jid=%s""", (JID,)))
+        d.addCallback(lambda result: self.assertEqual(1, result[0][0]))
+        return d
+
+
+    def test_metrics(self):
+        """
+        Interactions are counted, along with the time spent in them.
+        """
+        def cb(_):
+            snapshot = self.dbpool.metrics.snapshot()
+            self.assertEqual(0, snapshot.queued)
+            self.assertEqual(0, snapshot.active)
+            self.assertEqual(2, snapshot.started)
+            self.assertEqual(2, snapshot.interactions)
+            self.assertTrue(snapshot.waitTime >= 0)
+            self.assertTrue(snapshot.interactionTime >= 0.01)
+
+        d = self.dbpool.runQuery("""SELECT pg_sleep(0.01)""")
+        d.addCallback(lambda _: self.dbpool.runQuery("""SELECT 1/0"""))
+        self.assertFailure(d, self.dbpool.dbapi.DataError)
+        d.addCallback(cb)
+        return d
+
+
+    def test_metricsQueued(self):
+        """
+        Interactions are queued until they get a connection.
+        """
+        d = self.dbpool.runQuery("""SELECT 1""")
+        self.assertEqual(1, self.dbpool.metrics.queued +
+                            self.dbpool.metrics.started)
+        d.addCallback(lambda _: self.assertEqual(
+                                    0, self.dbpool.metrics.queued))
+        return d
+
+
+
+class ConnectionPoolTest(ConnectionPoolTestsMixin, unittest.TestCase):
+
+    def makePool(self):
+        from idavoll.dbpool import ConnectionPool
+        return ConnectionPool('psycopg2', database='pubsub_test')
+
+
+    def test_runInteractionPlain(self):
+        """
+        Plain functions can also be used as interactions.
+        """
+        def interaction(cursor):
+            cursor.execute("""SELECT 5""")
+            return cursor.fetchone()[0]
+
+        d = self.dbpool.runInteraction(interaction)
+        d.addCallback(self.assertEqual, 5)
+        return d
+
+
+    def test_resize(self):
+        """
+        The size of the pool is kept between its minimum and maximum.
+        """
+        self.dbpool.resize(4)
+        self.assertEqual(4, self.dbpool.size)
+        self.dbpool.resize(self.dbpool.max + 1)
+        self.assertEqual(self.dbpool.max, self.dbpool.size)
+        self.dbpool.resize(0)
+        self.assertEqual(self.dbpool.min, self.dbpool.size)
+
+
+    def test_reapConnections(self):
+        """
+        Connections of threads that have stopped are closed.
+        """
+        import thread
+
+        closed = []
+
+        class FakeConnection(object):
+            def close(self):
+                closed.append(self)
+
+        connection = FakeConnection()
+        self.dbpool.connections[-1] = connection
+        self.dbpool.connections[thread.get_ident()] = FakeConnection()
+        self.dbpool.reapConnections()
+        self.assertEqual([connection], closed)
+        self.assertNotIn(-1, self.dbpool.connections)
+        del self.dbpool.connections[thread.get_ident()]
+
+
+
+class AsyncConnectionPoolTest(ConnectionPoolTestsMixin, unittest.TestCase):
+
+    def makePool(self):
+        from idavoll.dbpool import AsyncConnectionPool
+        return AsyncConnectionPool(2, database='pubsub_test')
+
+
+    def test_waitForConnection(self):
+        """
+        Interactions wait for a connection when all are in use.
+        """
+        def interaction(cursor, value):
+            yield cursor.execute("""SELECT %s, pg_sleep(0.01)""", (value,))
+            returnValue(cursor.fetchone()[0])
+
+        d = defer.gatherResults([self.dbpool.runInteraction(interaction, n)
+                                 for n in xrange(5)])
+        d.addCallback(self.assertEqual, range(5))
+        d.addCallback(lambda _: self.assertEqual(
+                                    2, len(self.dbpool._connections)))
+        return d
+
+
+    def test_metricsWaiting(self):
+        """
+        The time interactions wait for a connection is recorded.
+        """
+        def interaction(cursor):
+            yield cursor.execute("""SELECT pg_sleep(0.01)""")
+
+        d = defer.gatherResults([self.dbpool.runInteraction(interaction)
+                                 for n in xrange(4)])
+        self.assertEqual(4, self.dbpool.metrics.queued)
+        d.addCallback(lambda _: self.assertTrue(
+                                    self.dbpool.metrics.waitTime >= 0.02))
+        return d
+
+
+    def test_brokenConnection(self):
+        """
+        Broken connections are discarded.
+        """
+        d = self.dbpool.runQuery("""SELECT pg_terminate_backend(
+                                               pg_backend_pid())""")
+        self.assertFailure(d, self.dbpool.dbapi.OperationalError)
+        d.addCallback(lambda _: self.assertEqual(
+                                    0, len(self.dbpool._connections)))
+        d.addCallback(lambda _: self.dbpool.runQuery("""SELECT 1"""))
+        d.addCallback(self.assertEqual, [(1,)])
+        return d
+
+
+    def test_metricsConnectFailed(self):
+        """
+        Interactions that fail to get a connection are no longer queued.
+        """
+        self.dbpool.connectionKeywords['database'] = 'idavoll_nonexisting'
+        d = self.dbpool.runQuery("""SELECT 1""")
+        self.assertFailure(d, self.dbpool.dbapi.OperationalError)
+        d.addCallback(lambda _: self.assertEqual(
+                                    0, self.dbpool.metrics.queued))
+        def restore(result):
+            self.dbpool.connectionKeywords['database'] = 'pubsub_test'
+            return result
+        d.addBoth(restore)
+        return d
+
+
+
+class PoolMetricsTest(unittest.TestCase):
+    """
+    Tests for L{PoolMetrics}.
+    """
+
+    def test_snapshot(self):
+        """
+        Interactions move from queued to active, and are counted when they
+        have ended.
+        """
+        metrics = PoolMetrics()
+        metrics.queue()
+        metrics.queue()
+        metrics.start(0.5)
+        self.assertEqual((1, 1, 1, 0, 0.5, 0.0), metrics.snapshot())
+        metrics.finish(2.0)
+        self.assertEqual((1, 0, 1, 1, 0.5, 2.0), metrics.snapshot())
+
+
+    def test_abandon(self):
+        """
+        Abandoned interactions are no longer queued.
+        """
+        metrics = PoolMetrics()
+        metrics.queue()
+        metrics.abandon()
+        self.assertEqual((0, 0, 0, 0, 0.0, 0.0), metrics.snapshot())
+
+
+
+class FakePool(object):
+    """
+    Stand-in for L{idavoll.dbpool.ConnectionPool}.
+    """
+
+    def __init__(self, min=1, max=1):
+        self.min = min
+        self.max = max
+        self.metrics = PoolMetrics()
+        self.size = max
+        self.interactions = []
+        self.error = None
+
+        import psycopg2
+        self.dbapi = psycopg2
+
+
+    def resize(self, size):
+        self.size = max(self.min, min(self.max, size))
+
+
+    def runInteraction(self, interaction, *args, **kwargs):
+        self.interactions.append(interaction)
+        if self.error is not None:
+            return defer.fail(self.error)
+        return defer.maybeDeferred(interaction, None, *args, **kwargs)
+
+
+
+class PoolSizerTest(unittest.TestCase):
+    """
+    Tests for L{PoolSizer}.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.pool = FakePool(2, 10)
+        self.sizer = PoolSizer(self.pool, waitThreshold=0.01, idleChecks=3,
+                               clock=self.clock)
+
+
+    def interact(self, waitTime, interactionTime):
+        self.pool.metrics.queue()
+        self.pool.metrics.start(waitTime)
+        self.pool.metrics.finish(interactionTime)
+
+
+    def test_initialSize(self):
+        """
+        The pool starts at its minimum size.
+        """
+        self.assertEqual(2, self.pool.size)
+
+
+    def test_growQueued(self):
+        """
+        The pool grows by the number of waiting interactions.
+        """
+        for i in xrange(3):
+            self.pool.metrics.queue()
+        self.clock.advance(1)
+        self.sizer.adjust()
+        self.assertEqual(5, self.pool.size)
+
+
+    def test_growWaited(self):
+        """
+        The pool grows when interactions waited too long on average.
+        """
+        self.interact(0.05, 0.1)
+        self.clock.advance(1)
+        self.sizer.adjust()
+        self.assertEqual(3, self.pool.size)
+
+
+    def test_growMaximum(self):
+        """
+        The pool does not grow beyond its maximum.
+        """
+        for i in xrange(20):
+            self.pool.metrics.queue()
+        self.clock.advance(1)
+        self.sizer.adjust()
+        self.assertEqual(10, self.pool.size)
+
+
+    def test_busy(self):
+        """
+        The pool keeps its size while all connections are in use.
+        """
+        self.pool.size = 4
+        for i in xrange(5):
+            self.interact(0.001, 4)
+            self.clock.advance(1)
+            self.sizer.adjust()
+        self.assertEqual(4, self.pool.size)
+
+
+    def test_shrink(self):
+        """
+        The pool shrinks by one after a number of checks with unused
+        connections.
+        """
+        self.pool.size = 4
+        for i in xrange(2):
+            self.interact(0.001, 1)
+            self.clock.advance(1)
+            self.sizer.adjust()
+        self.assertEqual(4, self.pool.size)
+        self.clock.advance(1)
+        self.sizer.adjust()
+        self.assertEqual(3, self.pool.size)
+
+
+    def test_shrinkMinimum(self):
+        """
+        The pool does not shrink below its minimum.
+        """
+        for i in xrange(6):
+            self.clock.advance(1)
+            self.sizer.adjust()
+        self.assertEqual(2, self.pool.size)
+
+
+
+class ReplicaRouterTest(unittest.TestCase):
+    """
+    Tests for L{ReplicaRouter}.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.primary = FakePool()
+        self.replicas = [FakePool(), FakePool()]
+
+
+    def interaction(self, cursor):
+        return 'result'
+
+
+    def test_noReplicas(self):
+        """
+        Without replicas, all reads go to the primary.
+        """
+        router = ReplicaRouter(self.primary, [])
+        router.wrote('key')
+        self.assertIdentical(self.primary, router.choose([]))
+        self.assertNotIn('key', router.pinned)
+
+
+    def test_roundRobin(self):
+        """
+        Replicas are picked in turn.
+        """
+        router = ReplicaRouter(self.primary, self.replicas)
+        self.assertEqual(self.replicas + self.replicas,
+                         [router.choose([]) for i in xrange(4)])
+
+
+    def test_leastLoaded(self):
+        """
+        The replica with the fewest queued and active interactions is
+        picked.
+        """
+        router = ReplicaRouter(self.primary, self.replicas, 'least-loaded')
+        self.replicas[0].metrics.queue()
+        self.assertEqual([self.replicas[1]] * 2,
+                         [router.choose([]) for i in xrange(2)])
+        self.replicas[1].metrics.queue()
+        self.assertEqual(self.replicas,
+                         [router.choose([]) for i in xrange(2)])
+
+
+    def test_unknownPolicy(self):
+        """
+        An unknown policy is rejected.
+        """
+        self.assertRaises(ValueError, ReplicaRouter, self.primary,
+                          self.replicas, 'random')
+
+
+    def test_stickiness(self):
+        """
+        Reads depending on a recent write go to the primary.
+        """
+        router = ReplicaRouter(self.primary, self.replicas, stickiness=5,
+                               clock=self.clock)
+        router.wrote('written')
+        self.assertIdentical(self.primary,
+                             router.choose(['other', 'written']))
+        self.assertIn(router.choose(['other']), self.replicas)
+        self.clock.advance(5)
+        self.assertIn(router.choose(['written']), self.replicas)
+
+
+    def test_wroteAll(self):
+        """
+        After a write to anything, all reads go to the primary.
+        """
+        router = ReplicaRouter(self.primary, self.replicas, stickiness=5,
+                               clock=self.clock)
+        router.wroteAll()
+        self.assertIdentical(self.primary, router.choose([]))
+        self.assertIdentical(self.primary, router.choose(['other']))
+        self.clock.advance(5)
+        self.assertIn(router.choose(['other']), self.replicas)
+
+
+    def test_runInteraction(self):
+        """
+        Read-only interactions are run on the chosen pool.
+        """
+        router = ReplicaRouter(self.primary, self.replicas)
+        d = router.runInteraction([], self.interaction)
+        d.addCallback(self.assertEqual, 'result')
+        self.assertEqual([self.interaction], self.replicas[0].interactions)
+        self.assertEqual([], self.primary.interactions)
+        return d
+
+
+    def test_runInteractionReplicaFailed(self):
+        """
+        Interactions are retried on the primary when a replica fails.
+        """
+        import psycopg2
+
+        router = ReplicaRouter(self.primary, self.replicas)
+        self.replicas[0].error = psycopg2.OperationalError()
+        d = router.runInteraction([], self.interaction)
+        d.addCallback(self.assertEqual, 'result')
+        d.addCallback(lambda _: self.assertEqual(
+            1, len(self.flushLoggedErrors(psycopg2.OperationalError))))
+        d.addCallback(lambda _: self.assertEqual(
+            [self.interaction], self.primary.interactions))
+        return d
+
+
+
+class NotificationListenerTest(unittest.TestCase):
+    """
+    Tests for L{NotificationListener}.
+    """
+
+    def setUp(self):
+        from idavoll.dbpool import ConnectionPool
+        self.dbpool = ConnectionPool('psycopg2', database='pubsub_test')
+        self.dbpool.start()
+        self.received = []
+        self.listener = NotificationListener(CHANNEL, self.received.append,
+                                             retryDelay=0,
+                                             database='pubsub_test')
+        return self.listener.startService()
+
+
+    def tearDown(self):
+        self.listener.stopService()
+        self.dbpool.close()
+
+
+    def test_listen(self):
+        """
+        The payload of notifications is passed to the callback, after
+        C{None} when listening starts.
+        """
+        self.assertEqual([None], self.received)
+        d = self.dbpool.runOperation("""SELECT pg_notify(%s, 'payload')""",
+                                     (CHANNEL,))
+        d.addCallback(lambda _: waitFor(lambda: len(self.received) == 2))
+        d.addCallback(lambda _: self.assertEqual([None, 'payload'],
+                                                 self.received))
+        return d
+
+
+    def test_reconnect(self):
+        """
+        After losing the connection, listening resumes on a new one, passing
+        C{None} to the callback.
+        """
+        d = self.dbpool.runQuery("""SELECT pg_terminate_backend(pid)
+                                    FROM pg_stat_activity
+                                    WHERE query LIKE 'LISTEN%%'""")
+        d.addCallback(lambda _: waitFor(lambda: len(self.received) == 2))
+        d.addCallback(lambda _: self.assertEqual(1, len(
+            self.flushLoggedErrors(self.dbpool.dbapi.OperationalError))))
+        d.addCallback(lambda _: self.dbpool.runOperation(
+            """SELECT pg_notify(%s, 'payload')""", (CHANNEL,)))
+        d.addCallback(lambda _: waitFor(lambda: len(self.received) == 3))
+        d.addCallback(lambda _: self.assertEqual([None, None, 'payload'],
+                                                 self.received))
+        return d
+
+
+
+try:
+    import psycopg2
+    psycopg2
+except ImportError:
+    ConnectionPoolTest.skip = "psycopg2 not available"
+    AsyncConnectionPoolTest.skip = "psycopg2 not available"
+    PoolMetricsTest.skip = "psycopg2 not available"
+    PoolSizerTest.skip = "psycopg2 not available"
+    ReplicaRouterTest.skip = "psycopg2 not available"
+    NotificationListenerTest.skip = "psycopg2 not available"
@@ -0,0 +1,132 @@
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Tests for L{idavoll.rsm}.
+"""
+
+from twisted.trial import unittest
+from twisted.words.protocols.jabber.error import StanzaError
+
+from wokkel import pubsub
+from wokkel.generic import parseXml
+
+from idavoll import rsm
+
+NS_PUBSUB = 'http://jabber.org/protocol/pubsub'
+
+class RSMRequestTest(unittest.TestCase):
+
+    def test_fromElement(self):
+        xml = """
+        <set xmlns='http://jabber.org/protocol/rsm'>
+          <max>10</max>
+          <after>item1</after>
+        </set>
+        """
+
+        request = rsm.RSMRequest.fromElement(parseXml(xml))
+        self.assertEquals(10, request.max)
+        self.assertEquals(u'item1', request.after)
+        self.assertIdentical(None, request.before)
+
+
+    def test_fromElementBeforeEmpty(self):
+        xml = """
+        <set xmlns='http://jabber.org/protocol/rsm'>
+          <before/>
+        </set>
+        """
+
+        request = rsm.RSMRequest.fromElement(parseXml(xml))
+        self.assertIdentical(None, request.max)
+        self.assertEquals(u'', request.before)
+
+
+    def test_fromElementInvalidMax(self):
+        xml = """
+        <set xmlns='http://jabber.org/protocol/rsm'>
+          <max>-1</max>
+        </set>
+        """
+
+        self.assertRaises(StanzaError, rsm.RSMRequest.fromElement,
+                          parseXml(xml))
+
+
+    def test_fromParent(self):
+        xml = """
+        <pubsub xmlns='http://jabber.org/protocol/pubsub'>
+          <items node='test'/>
+          <set xmlns='http://jabber.org/protocol/rsm'>
+            <max>10</max>
+          </set>
+        </pubsub>
+        """
+
+        request = rsm.RSMRequest.fromParent(parseXml(xml))
+        self.assertEquals(10, request.max)
+
+
+    def test_fromParentNone(self):
+        xml = """
+        <pubsub xmlns='http://jabber.org/protocol/pubsub'>
+          <items node='test'/>
+        </pubsub>
+        """
+
+        self.assertIdentical(None, rsm.RSMRequest.fromParent(parseXml(xml)))
+
+
+
+class RSMResponseTest(unittest.TestCase):
+
+    def test_fromItems(self):
+        items = [pubsub.Item('item2'), pubsub.Item('item1')]
+        response = rsm.RSMResponse.fromItems(items)
+        self.assertEquals('item2', response.first)
+        self.assertEquals('item1', response.last)
+
+
+    def test_toElement(self):
+        element = rsm.RSMResponse('item2', 'item1').toElement()
+        self.assertEquals((rsm.NS_RSM, 'set'), (element.uri, element.name))
+        self.assertEquals(u'item2', unicode(element.first))
+        self.assertEquals(u'item1', unicode(element.last))
+
+
+    def test_toElementEmpty(self):
+        element = rsm.RSMResponse().toElement()
+        self.assertEquals([], list(element.elements()))
+
+
+
+class PubSubServiceTest(unittest.TestCase):
+
+    def test_toResponseItems(self):
+        """
+        The result set response of a page is added to the response.
+        """
+        request = pubsub.PubSubRequest('items')
+        request.nodeIdentifier = 'test'
+        page = rsm.Page([pubsub.Item('item1')],
+                        rsm.RSMResponse('item1', 'item1'))
+
+        service = rsm.PubSubService()
+        response = service._toResponse_items(page, None, request)
+
+        self.assertEquals((NS_PUBSUB, 'pubsub'),
+                          (response.uri, response.name))
+        self.assertEquals(u'item1', response.items.item['id'])
+        self.assertEquals(rsm.NS_RSM, response.set.uri)
+        self.assertEquals(u'item1', unicode(response.set.first))
+
+
+    def test_toResponseItemsNoPage(self):
+        request = pubsub.PubSubRequest('items')
+        request.nodeIdentifier = 'test'
+
+        service = rsm.PubSubService()
+        response = service._toResponse_items([pubsub.Item('item1')], None,
+                                             request)
+        self.assertIdentical(None, response.set)
@@ -0,0 +1,387 @@
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Tests for L{idavoll.sharding}.
+"""
+
+from twisted.internet import task
+from twisted.test import iosim
+from twisted.trial import unittest
+from twisted.words.protocols.jabber import jid
+from twisted.words.protocols.jabber.error import NS_XMPP_STANZAS
+
+from wokkel.generic import parseXml
+from wokkel.pubsub import NS_PUBSUB, NS_PUBSUB_EVENT
+
+from idavoll import backend, memory_storage
+from idavoll.rsm import PubSubService
+from idavoll.sharding import HashRing, LargeString, Shard
+from idavoll.sharding import ShardRouter, ShardWorker, WorkerProtocol
+
+SERVICE = jid.JID('pubsub.example.org')
+OWNER = jid.JID('owner@example.org/Home')
+SUBSCRIBER = jid.JID('subscriber@example.org/Home')
+
+class HashRingTest(unittest.TestCase):
+    """
+    Tests for L{HashRing}.
+    """
+
+    def test_shardFor(self):
+        """
+        Nodes are spread over all shards, the same way every time.
+        """
+        ring = HashRing(['a', 'b', 'c'])
+        shards = [ring.shardFor(u'node%d' % n) for n in xrange(300)]
+        self.assertEqual(set(['a', 'b', 'c']), set(shards))
+        self.assertEqual(shards, [HashRing(['c', 'b', 'a']).shardFor(
+                                      u'node%d' % n) for n in xrange(300)])
+
+
+    def test_consistent(self):
+        """
+        Adding a shard only moves nodes to the new shard.
+        """
+        ring = HashRing(['a', 'b', 'c'])
+        newRing = HashRing(['a', 'b', 'c', 'd'])
+        moved = 0
+        for n in xrange(300):
+            nodeIdentifier = u'node%d' % n
+            shard = newRing.shardFor(nodeIdentifier)
+            if shard != ring.shardFor(nodeIdentifier):
+                self.assertEqual('d', shard)
+                moved += 1
+        self.assertTrue(0 < moved < 150)
+
+
+    def test_unicode(self):
+        """
+        Node identifiers may contain non-ASCII characters.
+        """
+        ring = HashRing(['a', 'b'])
+        self.assertIn(ring.shardFor(u'caf\u00e9'), ['a', 'b'])
+
+
+    def test_noShards(self):
+        """
+        A hash ring needs at least one shard.
+        """
+        self.assertRaises(ValueError, HashRing, [])
+
+
+
+class LargeStringTest(unittest.TestCase):
+    """
+    Tests for L{LargeString}.
+    """
+
+    def test_roundTrip(self):
+        """
+        Strings larger than an AMP value are split into chunks and joined.
+        """
+        argument = LargeString()
+        value = 'x' * 150000
+        strings = {}
+        argument.toBox('stanza', strings, {'stanza': value}, None)
+        self.assertEqual(3, len(strings))
+        self.assertTrue(max(len(chunk) for chunk in strings.values()) < 65535)
+
+        objects = {}
+        argument.fromBox('stanza', strings, objects, None)
+        self.assertEqual(value, objects['stanza'])
+
+
+    def test_empty(self):
+        """
+        The empty string is sent as a single empty chunk.
+        """
+        argument = LargeString()
+        strings = {}
+        argument.toBox('stanza', strings, {'stanza': ''}, None)
+        objects = {}
+        argument.fromBox('stanza', strings, objects, None)
+        self.assertEqual('', objects['stanza'])
+
+
+
+class ShardRouterTest(unittest.TestCase):
+    """
+    Tests for L{ShardRouter} forwarding to L{ShardWorker}s.
+    """
+
+    def setUp(self):
+        self.output = []
+        self.clock = task.Clock()
+        self.router = ShardRouter(HashRing(['a', 'b']))
+        self.router.parent = self
+        self.storage = memory_storage.Storage()
+        self.handled = []
+        self.pumps = []
+        for name in ('a', 'b'):
+            self.connect(name)
+
+
+    def connect(self, name):
+        """
+        Connect a worker, sharing the storage with the other workers and
+        recording the requests it handles.
+        """
+        bs = backend.BackendService(self.storage)
+        resource = backend.PubSubResourceFromBackend(bs)
+        resource.serviceJID = SERVICE
+        resource.cooperator = task.Cooperator(
+                scheduler=lambda f: self.clock.callLater(0, f))
+        service = PubSubService(resource)
+        resource.pubsubService = service
+        worker = ShardWorker(service)
+
+        request = worker.request
+        def recordingRequest(stanza):
+            self.handled.append(name)
+            return request(stanza)
+        worker.request = recordingRequest
+
+        shard = Shard(name, self.router)
+        server = WorkerProtocol()
+        server.worker = worker
+        client, server, pump = iosim.connectedServerAndClient(
+            lambda: server,
+            lambda: shard.buildProtocol(None))
+        self.router.shards[name] = shard
+        self.pumps.append(pump)
+
+
+    def send(self, obj):
+        self.output.append(obj)
+
+
+    def flush(self):
+        for _ in xrange(3):
+            self.clock.advance(0)
+            for pump in self.pumps:
+                pump.flush()
+
+
+    def nodeOn(self, shard):
+        """
+        Return a node identifier owned by a shard.
+        """
+        for n in xrange(100):
+            nodeIdentifier = u'node%d' % n
+            if self.router.ring.shardFor(nodeIdentifier) == shard:
+                return nodeIdentifier
+
+
+    def request(self, xml, sender=OWNER):
+        iq = parseXml(xml)
+        iq['from'] = sender.full()
+        iq['to'] = SERVICE.full()
+        iq['id'] = 'request1'
+        self.router.handleRequest(iq)
+        self.flush()
+        for stanza in self.output:
+            if isinstance(stanza, basestring):
+                response = parseXml(stanza)
+            else:
+                response = stanza
+            if (response.name == 'iq' and
+                response.getAttribute('id') == 'request1'):
+                self.output.remove(stanza)
+                return response
+
+
+    def create(self, nodeIdentifier):
+        return self.request(u"""
+            <iq type='set'>
+              <pubsub xmlns='http://jabber.org/protocol/pubsub'>
+                <create node='%s'/>
+              </pubsub>
+            </iq>""" % nodeIdentifier)
+
+
+    def subscribe(self, nodeIdentifier):
+        return self.request(u"""
+            <iq type='set'>
+              <pubsub xmlns='http://jabber.org/protocol/pubsub'>
+                <subscribe node='%s' jid='%s'/>
+              </pubsub>
+            </iq>""" % (nodeIdentifier, SUBSCRIBER.full()),
+            sender=SUBSCRIBER)
+
+
+    def test_create(self):
+        """
+        Nodes are created by the worker of the shard owning them.
+        """
+        response = self.create(self.nodeOn('b'))
+        self.assertEqual('result', response['type'])
+        self.assertEqual('request1', response['id'])
+        self.assertEqual(OWNER.full(), response['to'])
+        self.assertIn(self.nodeOn('b'), self.storage._nodes)
+        self.assertEqual(['b'], self.handled)
+
+
+    def test_createInstant(self):
+        """
+        Instant nodes get their identifier from the router, and are created
+        on the owning shard.
+        """
+        response = self.request(u"""
+            <iq type='set'>
+              <pubsub xmlns='http://jabber.org/protocol/pubsub'>
+                <create/>
+              </pubsub>
+            </iq>""")
+        self.assertEqual('result', response['type'])
+        create = response.pubsub.create
+        nodeIdentifier = create['node']
+        self.assertTrue(nodeIdentifier.startswith('generic/'))
+        shard = self.router.ring.shardFor(nodeIdentifier)
+        self.assertIn(nodeIdentifier, self.storage._nodes)
+        self.assertEqual([shard], self.handled)
+
+
+    def test_error(self):
+        """
+        Error responses of workers are passed on.
+        """
+        response = self.subscribe(u'missing')
+        self.assertEqual('error', response['type'])
+        self.assertEqual('request1', response['id'])
+        conditions = [element.name for element in response.error.elements()
+                      if element.uri == NS_XMPP_STANZAS]
+        self.assertEqual(['item-not-found'], conditions)
+
+
+    def test_unavailable(self):
+        """
+        Requests for shards without a connected worker fail.
+        """
+        self.router.shards['b'].connection = None
+        response = self.create(self.nodeOn('b'))
+        self.assertEqual('error', response['type'])
+        conditions = [element.name for element in response.error.elements()
+                      if element.uri == NS_XMPP_STANZAS]
+        self.assertEqual(['service-unavailable'], conditions)
+
+
+    def test_subscriptions(self):
+        """
+        The subscriptions of an entity are retrieved from a single shard,
+        listing those to the nodes of all shards once.
+        """
+        for shard in ('a', 'b'):
+            self.create(self.nodeOn(shard))
+            self.subscribe(self.nodeOn(shard))
+
+        del self.handled[:]
+        response = self.request(u"""
+            <iq type='get'>
+              <pubsub xmlns='http://jabber.org/protocol/pubsub'>
+                <subscriptions/>
+              </pubsub>
+            </iq>""", sender=SUBSCRIBER)
+        self.assertEqual('result', response['type'])
+        subscriptions = response.pubsub.subscriptions
+        self.assertEqual(NS_PUBSUB, subscriptions.uri)
+        self.assertEqual(sorted([self.nodeOn('a'), self.nodeOn('b')]),
+                         sorted(subscription['node'] for subscription
+                                in subscriptions.elements()))
+        self.assertEqual(1, len(self.handled))
+
+
+    def test_subscriptionsUnavailable(self):
+        """
+        Requests that any shard can answer pass over shards without a
+        connected worker.
+        """
+        self.create(self.nodeOn('a'))
+        self.subscribe(self.nodeOn('a'))
+        preferred = self.router.ring.shardFor(SUBSCRIBER.userhost())
+        self.router.shards[preferred].connection = None
+
+        del self.handled[:]
+        response = self.request(u"""
+            <iq type='get'>
+              <pubsub xmlns='http://jabber.org/protocol/pubsub'>
+                <subscriptions/>
+              </pubsub>
+            </iq>""", sender=SUBSCRIBER)
+        self.assertEqual('result', response['type'])
+        self.assertNotIn(preferred, self.handled)
+
+
+    def test_notification(self):
+        """
+        Notifications of workers are sent out by the router.
+        """
+        nodeIdentifier = self.nodeOn('a')
+        self.create(nodeIdentifier)
+        self.subscribe(nodeIdentifier)
+        response = self.request(u"""
+            <iq type='set'>
+              <pubsub xmlns='http://jabber.org/protocol/pubsub'>
+                <publish node='%s'>
+                  <item id='1'><test xmlns='testns'/></item>
+                </publish>
+              </pubsub>
+            </iq>""" % nodeIdentifier)
+        self.assertEqual('result', response['type'])
+
+        self.assertEqual(1, len(self.output))
+        message = parseXml(self.output[0])
+        self.assertEqual('message', message.name)
+        self.assertEqual(SUBSCRIBER.full(), message['to'])
+        self.assertEqual(NS_PUBSUB_EVENT, message.event.uri)
+        self.assertEqual(nodeIdentifier, message.event.items['node'])
+
+
+    def test_getDiscoItems(self):
+        """
+        The nodes of all shards are listed once.
+        """
+        for shard in ('a', 'b'):
+            self.create(self.nodeOn(shard))
+
+        d = self.router.getDiscoItems(OWNER, SERVICE, '')
+        self.flush()
+
+        def cb(items):
+            nodeIdentifiers = [item.nodeIdentifier for item in items]
+            self.assertIn(self.nodeOn('a'), nodeIdentifiers)
+            self.assertIn(self.nodeOn('b'), nodeIdentifiers)
+            self.assertEqual(len(set(nodeIdentifiers)), len(nodeIdentifiers))
+
+        d.addCallback(cb)
+        return d
+
+
+    def test_getDiscoInfo(self):
+        """
+        The service discovery information of a node comes from its shard.
+        """
+        nodeIdentifier = self.nodeOn('b')
+        self.create(nodeIdentifier)
+
+        d = self.router.getDiscoInfo(OWNER, SERVICE, nodeIdentifier)
+        self.flush()
+
+        def cb(info):
+            identities = [(item.category, item.type) for item in info
+                          if hasattr(item, 'category')]
+            self.assertEqual([('pubsub', 'leaf')], identities)
+
+        d.addCallback(cb)
+        return d
+
+
+    def test_getDiscoInfoMissing(self):
+        """
+        Nodes not known by their shard have no service discovery
+        information.
+        """
+        d = self.router.getDiscoInfo(OWNER, SERVICE, u'missing')
+        self.flush()
+        d.addCallback(self.assertEqual, [])
+        return d
@@ -5,14 +5,18 @@
 Tests for L{idavoll.memory_storage} and L{idavoll.pgsql_storage}.
 """
 
+import os
+
 from zope.interface.verify import verifyObject
 from twisted.trial import unittest
 from twisted.words.protocols.jabber import jid
-from twisted.internet import defer
+from twisted.internet import defer, task
 from twisted.words.xish import domish
 
 from idavoll import error, iidavoll
 
+DB_DIR = os.path.join(os.path.dirname(__file__), os.pardir, os.pardir, 'db')
+
 OWNER = jid.JID('owner@example.com/Work')
 SUBSCRIBER = jid.JID('subscriber@example.com/Home')
 SUBSCRIBER_NEW = jid.JID('new@example.com/Home')
@@ -73,6 +77,34 @@ class StorageTests:
         return d
 
 
+    def test_getNodeAndAffiliation(self):
+        def cb(result):
+            node, affiliation = result
+            self.assertEquals('pre-existing', node.nodeIdentifier)
+            self.assertEquals('owner', affiliation)
+
+        d = self.s.getNodeAndAffiliation('pre-existing', OWNER)
+        d.addCallback(cb)
+        return d
+
+
+    def test_getNodeAndNonExistingAffiliation(self):
+        def cb(result):
+            node, affiliation = result
+            self.assertEquals('pre-existing', node.nodeIdentifier)
+            self.assertIdentical(None, affiliation)
+
+        d = self.s.getNodeAndAffiliation('pre-existing', SUBSCRIBER)
+        d.addCallback(cb)
+        return d
+
+
+    def test_getNonExistingNodeAndAffiliation(self):
+        d = self.s.getNodeAndAffiliation('non-existing', OWNER)
+        self.assertFailure(d, error.NodeNotFound)
+        return d
+
+
     def test_getNodeIDs(self):
         def cb(nodeIdentifiers):
             self.assertIn('pre-existing', nodeIdentifiers)
@@ -335,6 +367,66 @@ class StorageTests:
         return d
 
 
+    def test_storeMultipleItems(self):
+        """
+        Items with the same identifier in one publish replace each other.
+        """
+        def cb1(void):
+            return self.node.getItemsById(['new', 'current'])
+
+        def cb2(result):
+            self.assertEqual([ITEM_NEW.toXml(), ITEM_UPDATED.toXml()],
+                             [item.toXml() for item in result])
+
+        d = self.node.storeItems([ITEM_NEW, ITEM, ITEM_UPDATED], PUBLISHER)
+        d.addCallback(cb1)
+        d.addCallback(cb2)
+        return d
+
+
+    def test_storeItemsMaxItems(self):
+        """
+        Storing items beyond the maximum number drops the oldest items.
+        """
+        d = self.s.getNode('to-be-reconfigured')
+
+        def cb(node):
+            d = node.setConfiguration({'pubsub#max_items': 2})
+            d.addCallback(lambda _: node.storeItems([ITEM], PUBLISHER))
+            d.addCallback(lambda _: node.storeItems([ITEM_NEW], PUBLISHER))
+            d.addCallback(lambda _: node.storeItems([ITEM_TO_BE_DELETED],
+                                                    PUBLISHER))
+            d.addCallback(lambda _: node.getItems())
+            return d
+
+        d.addCallback(cb)
+        d.addCallback(lambda items: self.assertEqual(
+            [ITEM_TO_BE_DELETED.toXml(), ITEM_NEW.toXml()],
+            [item.toXml() for item in items]))
+        return d
+
+
+    def test_storeItemsMaxItemsOnePublish(self):
+        """
+        Items beyond the maximum number are dropped when stored together.
+        """
+        d = self.s.getNode('to-be-reconfigured')
+
+        def cb(node):
+            d = node.setConfiguration({'pubsub#max_items': 2})
+            d.addCallback(lambda _: node.storeItems(
+                [ITEM, ITEM_NEW, ITEM_TO_BE_DELETED], PUBLISHER))
+            d.addCallback(lambda _: node.getItemsById(
+                ['current', 'new', 'to-be-deleted']))
+            return d
+
+        d.addCallback(cb)
+        d.addCallback(lambda items: self.assertEqual(
+            [ITEM_NEW.toXml(), ITEM_TO_BE_DELETED.toXml()],
+            [item.toXml() for item in items]))
+        return d
+
+
     def test_removeItems(self):
         def cb1(result):
             self.assertEqual(['to-be-deleted'], result)
@@ -349,6 +441,19 @@ class StorageTests:
         return d
 
 
+    def test_removeMultipleItems(self):
+        """
+        Only the removed items are reported, in the order requested.
+        """
+        def cb(result):
+            self.assertEqual(['to-be-deleted', 'current'], result)
+
+        d = self.node.removeItems(['to-be-deleted', 'non-existing',
+                                   'current'])
+        d.addCallback(cb)
+        return d
+
+
     def test_removeNonExistingItems(self):
         def cb(result):
             self.assertEqual([], result)
@@ -378,6 +483,101 @@ class StorageTests:
         return d
 
 
+    def test_getItemsOrder(self):
+        """
+        Items are returned most recently published first.
+        """
+        def cb(result):
+            self.assertEqual(['current', 'to-be-deleted'],
+                             [item['id'] for item in result])
+
+        d = self.node.getItems()
+        d.addCallback(cb)
+        return d
+
+
+    def test_getItemsAfter(self):
+        def cb(result):
+            self.assertEqual(['to-be-deleted'],
+                             [item['id'] for item in result])
+
+        d = self.node.getItems(10, after='current')
+        d.addCallback(cb)
+        return d
+
+
+    def test_getItemsAfterLast(self):
+        def cb(result):
+            self.assertEqual([], result)
+
+        d = self.node.getItems(10, after='to-be-deleted')
+        d.addCallback(cb)
+        return d
+
+
+    def test_getItemsBefore(self):
+        def cb(result):
+            self.assertEqual(['current'], [item['id'] for item in result])
+
+        d = self.node.getItems(10, before='to-be-deleted')
+        d.addCallback(cb)
+        return d
+
+
+    def test_getItemsBeforeEmpty(self):
+        """
+        An empty C{before} cursor yields the least recent items.
+        """
+        def cb(result):
+            self.assertEqual(['to-be-deleted'],
+                             [item['id'] for item in result])
+
+        d = self.node.getItems(1, before='')
+        d.addCallback(cb)
+        return d
+
+
+    def test_getItemsAfterNonExisting(self):
+        d = self.node.getItems(10, after='non-existing')
+        self.assertFailure(d, error.ItemNotFound)
+        return d
+
+
+    def test_getItemsBeforeNonExisting(self):
+        d = self.node.getItems(10, before='non-existing')
+        self.assertFailure(d, error.ItemNotFound)
+        return d
+
+
+    def test_iterItems(self):
+        batches = []
+
+        def collect(items):
+            batches.append([item['id'] for item in items])
+            return defer.succeed(None)
+
+        def cb(result):
+            self.assertIdentical(None, result)
+            self.assertEqual([['current'], ['to-be-deleted']], batches)
+
+        d = self.node.iterItems(collect, 1)
+        d.addCallback(cb)
+        return d
+
+
+    def test_iterItemsEmpty(self):
+        batches = []
+
+        def cb(node):
+            d = node.iterItems(batches.append)
+            d.addCallback(lambda _: self.assertEqual([], batches))
+            return d
+
+        d = self.s.getNode('to-be-reconfigured')
+        d.addCallback(cb)
+        return d
+
+
     def test_getItemsById(self):
         def cb(result):
             self.assertEqual(1, len(result))
@@ -476,16 +676,20 @@ class PgsqlStorageStorageTestCase(unittest.TestCase, StorageTests):
 
     dbpool = None
 
+    def makePool(self):
+        from idavoll.dbpool import ConnectionPool
+        return ConnectionPool('psycopg2',
+                              database='pubsub_test',
+                              cp_reconnect=True,
+                              client_encoding='utf-8',
+                              connection_factory=NamedTupleConnection,
+                              )
+
+
     def setUp(self):
         from idavoll.pgsql_storage import Storage
-        from twisted.enterprise import adbapi
         if self.dbpool is None:
-            self.__class__.dbpool = adbapi.ConnectionPool('psycopg2',
-                                            database='pubsub_test',
-                                            cp_reconnect=True,
-                                            client_encoding='utf-8',
-                                            connection_factory=NamedTupleConnection,
-                                            )
+            self.__class__.dbpool = self.makePool()
         self.s = Storage(self.dbpool)
         self.dbpool.start()
         d = self.dbpool.runInteraction(self.init)
@@ -499,89 +703,759 @@ class PgsqlStorageStorageTestCase(unittest.TestCase, StorageTests):
 
 
     def init(self, cursor):
-        self.cleandb(cursor)
-        cursor.execute("""INSERT INTO nodes
-                          (node, node_type, persist_items)
-                          VALUES ('pre-existing', 'leaf', TRUE)""")
-        cursor.execute("""INSERT INTO nodes (node) VALUES ('to-be-deleted')""")
-        cursor.execute("""INSERT INTO nodes (node) VALUES ('to-be-reconfigured')""")
-        cursor.execute("""INSERT INTO nodes (node) VALUES ('to-be-purged')""")
-        cursor.execute("""INSERT INTO entities (jid) VALUES (%s)""",
-                       (OWNER.userhost(),))
-        cursor.execute("""INSERT INTO affiliations
-                          (node_id, entity_id, affiliation)
-                          SELECT node_id, entity_id, 'owner'
-                          FROM nodes, entities
-                          WHERE node='pre-existing' AND jid=%s""",
-                       (OWNER.userhost(),))
-        cursor.execute("""INSERT INTO entities (jid) VALUES (%s)""",
-                       (SUBSCRIBER.userhost(),))
-        cursor.execute("""INSERT INTO subscriptions
-                          (node_id, entity_id, resource, state)
-                          SELECT node_id, entity_id, %s, 'subscribed'
-                          FROM nodes, entities
-                          WHERE node='pre-existing' AND jid=%s""",
-                       (SUBSCRIBER.resource,
-                        SUBSCRIBER.userhost()))
-        cursor.execute("""INSERT INTO entities (jid) VALUES (%s)""",
-                       (SUBSCRIBER_TO_BE_DELETED.userhost(),))
-        cursor.execute("""INSERT INTO subscriptions
-                          (node_id, entity_id, resource, state)
-                          SELECT node_id, entity_id, %s, 'subscribed'
-                          FROM nodes, entities
-                          WHERE node='pre-existing' AND jid=%s""",
-                       (SUBSCRIBER_TO_BE_DELETED.resource,
-                        SUBSCRIBER_TO_BE_DELETED.userhost()))
-        cursor.execute("""INSERT INTO entities (jid) VALUES (%s)""",
-                       (SUBSCRIBER_PENDING.userhost(),))
-        cursor.execute("""INSERT INTO subscriptions
-                          (node_id, entity_id, resource, state)
-                          SELECT node_id, entity_id, %s, 'pending'
-                          FROM nodes, entities
-                          WHERE node='pre-existing' AND jid=%s""",
-                       (SUBSCRIBER_PENDING.resource,
-                        SUBSCRIBER_PENDING.userhost()))
-        cursor.execute("""INSERT INTO entities (jid) VALUES (%s)""",
-                       (PUBLISHER.userhost(),))
-        cursor.execute("""INSERT INTO items
-                          (node_id, publisher, item, data, date)
-                          SELECT node_id, %s, 'to-be-deleted', %s,
-                                 now() - interval '1 day'
-                          FROM nodes
-                          WHERE node='pre-existing'""",
-                       (PUBLISHER.userhost(),
-                        ITEM_TO_BE_DELETED.toXml()))
-        cursor.execute("""INSERT INTO items (node_id, publisher, item, data)
-                          SELECT node_id, %s, 'to-be-deleted', %s
-                          FROM nodes
-                          WHERE node='to-be-purged'""",
-                       (PUBLISHER.userhost(),
-                        ITEM_TO_BE_DELETED.toXml()))
-        cursor.execute("""INSERT INTO items (node_id, publisher, item, data)
-                          SELECT node_id, %s, 'current', %s
-                          FROM nodes
-                          WHERE node='pre-existing'""",
-                       (PUBLISHER.userhost(),
-                        ITEM.toXml()))
+        yield self.cleandb(cursor)
+        yield cursor.execute("""INSERT INTO nodes
+                                (node, node_type, persist_items)
+                                VALUES ('pre-existing', 'leaf', TRUE)""")
+        yield cursor.execute("""INSERT INTO nodes (node) VALUES ('to-be-deleted')""")
+        yield cursor.execute("""INSERT INTO nodes (node) VALUES ('to-be-reconfigured')""")
+        yield cursor.execute("""INSERT INTO nodes (node) VALUES ('to-be-purged')""")
+        yield cursor.execute("""INSERT INTO entities (jid) VALUES (%s)""",
+                             (OWNER.userhost(),))
+        yield cursor.execute("""INSERT INTO affiliations
+                                (node_id, entity_id, affiliation)
+                                SELECT node_id, entity_id, 'owner'
+                                FROM nodes, entities
+                                WHERE node='pre-existing' AND jid=%s""",
+                             (OWNER.userhost(),))
+        yield cursor.execute("""INSERT INTO entities (jid) VALUES (%s)""",
+                             (SUBSCRIBER.userhost(),))
+        yield cursor.execute("""INSERT INTO subscriptions
+                                (node_id, entity_id, resource, state)
+                                SELECT node_id, entity_id, %s, 'subscribed'
+                                FROM nodes, entities
+                                WHERE node='pre-existing' AND jid=%s""",
+                             (SUBSCRIBER.resource,
+                              SUBSCRIBER.userhost()))
+        yield cursor.execute("""INSERT INTO entities (jid) VALUES (%s)""",
+                             (SUBSCRIBER_TO_BE_DELETED.userhost(),))
+        yield cursor.execute("""INSERT INTO subscriptions
+                                (node_id, entity_id, resource, state)
+                                SELECT node_id, entity_id, %s, 'subscribed'
+                                FROM nodes, entities
+                                WHERE node='pre-existing' AND jid=%s""",
+                             (SUBSCRIBER_TO_BE_DELETED.resource,
+                              SUBSCRIBER_TO_BE_DELETED.userhost()))
+        yield cursor.execute("""INSERT INTO entities (jid) VALUES (%s)""",
+                             (SUBSCRIBER_PENDING.userhost(),))
+        yield cursor.execute("""INSERT INTO subscriptions
+                                (node_id, entity_id, resource, state)
+                                SELECT node_id, entity_id, %s, 'pending'
+                                FROM nodes, entities
+                                WHERE node='pre-existing' AND jid=%s""",
+                             (SUBSCRIBER_PENDING.resource,
+                              SUBSCRIBER_PENDING.userhost()))
+        yield cursor.execute("""INSERT INTO entities (jid) VALUES (%s)""",
+                             (PUBLISHER.userhost(),))
+        yield cursor.execute("""INSERT INTO items
+                                (node_id, publisher, item, data, date)
+                                SELECT node_id, %s, 'to-be-deleted', %s,
+                                       now() - interval '1 day'
+                                FROM nodes
+                                WHERE node='pre-existing'""",
+                             (PUBLISHER.userhost(),
+                              ITEM_TO_BE_DELETED.toXml()))
+        yield cursor.execute("""INSERT INTO items (node_id, publisher, item, data)
+                                SELECT node_id, %s, 'to-be-deleted', %s
+                                FROM nodes
+                                WHERE node='to-be-purged'""",
+                             (PUBLISHER.userhost(),
+                              ITEM_TO_BE_DELETED.toXml()))
+        yield cursor.execute("""INSERT INTO items (node_id, publisher, item, data)
+                                SELECT node_id, %s, 'current', %s
+                                FROM nodes
+                                WHERE node='pre-existing'""",
+                             (PUBLISHER.userhost(),
+                              ITEM.toXml()))
+
+
+    def test_getNodeCached(self):
+        """
+        Nodes are retrieved from the node cache after the first lookup.
+        """
+        def cb(nodes):
+            self.assertIdentical(nodes[0], nodes[1])
+            self.assertEquals(1, self.s.nodeCache.hits)
+
+        d = self.s.getNode('to-be-reconfigured')
+        d.addCallback(lambda node: defer.gatherResults([
+                                        defer.succeed(node),
+                                        self.s.getNode('to-be-reconfigured')]))
+        d.addCallback(cb)
+        return d
+
+
+    def test_deleteNodeCached(self):
+        """
+        Deleting a node removes it from the node cache.
+        """
+        d = self.s.getNode('to-be-deleted')
+        d.addCallback(lambda _: self.s.deleteNode('to-be-deleted'))
+        d.addCallback(lambda _: self.s.getNode('to-be-deleted'))
+        self.assertFailure(d, error.NodeNotFound)
+        return d
+
+
+    def test_setConfigurationCached(self):
+        """
+        Reconfiguring a node removes it from the node cache.
+        """
+        def cb(node):
+            self.assertEqual(False,
+                             node.getConfiguration()['pubsub#persist_items'])
+
+        d = self.s.getNode('to-be-reconfigured')
+        d.addCallback(lambda node: node.setConfiguration(
+                                        {'pubsub#persist_items': False}))
+        d.addCallback(lambda _: self.assertNotIn('to-be-reconfigured',
+                                                 self.s.nodeCache))
+        d.addCallback(lambda _: self.s.getNode('to-be-reconfigured'))
+        d.addCallback(cb)
+        return d
+
+
+    def test_getNonExistingNodeCached(self):
+        """
+        Lookups of a node that was not found do not query the database.
+        """
+        def insert(cursor):
+            yield cursor.execute("""INSERT INTO nodes (node) VALUES ('new 1')""")
+
+        d = self.s.getNode('new 1')
+        self.assertFailure(d, error.NodeNotFound)
+        d.addCallback(lambda _: self.dbpool.runInteraction(insert))
+        d.addCallback(lambda _: self.s.getNode('new 1'))
+        self.assertFailure(d, error.NodeNotFound)
+        d.addCallback(lambda _: self.assertEquals(
+                                    1, self.s.missingNodeCache.hits))
+        return d
+
+
+    def test_createNodeMissingCached(self):
+        """
+        Creating a node removes it from the cache of non-existing nodes.
+        """
+        config = self.s.getDefaultConfiguration('leaf')
+        config['pubsub#node_type'] = 'leaf'
+
+        d = self.s.getNode('new 1')
+        self.assertFailure(d, error.NodeNotFound)
+        d.addCallback(lambda _: self.s.createNode('new 1', OWNER, config))
+        d.addCallback(lambda _: self.s.getNode('new 1'))
+        return d
+
+
+    def test_nodeDeletedElsewhere(self):
+        """
+        Operations on a node deleted by others fail and uncache the node.
+        """
+        def delete(cursor):
+            yield cursor.execute("""DELETE FROM nodes WHERE node='pre-existing'""")
+
+        def cb(node):
+            d = self.dbpool.runInteraction(delete)
+            d.addCallback(lambda _: defer.DeferredList([
+                self.assertFailure(node.getItems(), error.NodeNotFound),
+                self.assertFailure(node.getItemsById(['current']),
+                                   error.NodeNotFound),
+                self.assertFailure(node.storeItems([ITEM_NEW], PUBLISHER),
+                                   error.NodeNotFound),
+                self.assertFailure(node.removeItems(['current']),
+                                   error.NodeNotFound),
+                self.assertFailure(node.getSubscription(SUBSCRIBER),
+                                   error.NodeNotFound),
+                self.assertFailure(node.addSubscription(SUBSCRIBER_NEW,
+                                                        'subscribed', {}),
+                                   error.NodeNotFound),
+                self.assertFailure(node.removeSubscription(SUBSCRIBER),
+                                   error.NodeNotFound),
+                self.assertFailure(node.isSubscribed(SUBSCRIBER),
+                                   error.NodeNotFound),
+                self.assertFailure(node.getAffiliation(OWNER),
+                                   error.NodeNotFound),
+                self.assertFailure(node.getAffiliations(),
+                                   error.NodeNotFound),
+                ], fireOnOneErrback=True, consumeErrors=True))
+            d.addCallback(lambda _: self.assertNotIn('pre-existing',
+                                                     self.s.nodeCache))
+            return d
+
+        d = self.s.getNode('pre-existing')
+        d.addCallback(cb)
+        return d
+
+
+    def test_iterItemsNodeDeleted(self):
+        def delete(cursor):
+            yield cursor.execute("""DELETE FROM nodes WHERE node='pre-existing'""")
+
+        d = self.dbpool.runInteraction(delete)
+        d.addCallback(lambda _: self.node.iterItems(lambda items: None))
+        self.assertFailure(d, error.NodeNotFound)
+        return d
+
+
+    def getStoredData(self, itemIdentifier):
+        from idavoll.dbpool import returnValue
+
+        def select(cursor):
+            yield cursor.execute("""SELECT data, data_compressed FROM items
+                                    NATURAL JOIN nodes
+                                    WHERE node='pre-existing' AND item=%s""",
+                                 (itemIdentifier,))
+            returnValue(cursor.fetchone())
+
+        return self.dbpool.runInteraction(select)
+
+
+    def test_storeItemsCompressed(self):
+        """
+        Items as large as the compression threshold are stored compressed.
+        """
+        size = len(ITEM_NEW.toXml().encode('utf-8'))
+        self.s.itemCompressionThreshold = size
+
+        def checkStored(row):
+            self.assertIdentical(None, row.data)
+            self.assertNotIdentical(None, row.data_compressed)
+
+        def cb(result):
+            self.assertEqual(ITEM_NEW.toXml(), result[0].toXml())
+
+        d = self.node.storeItems([ITEM_NEW], PUBLISHER)
+        d.addCallback(lambda _: self.getStoredData('new'))
+        d.addCallback(checkStored)
+        d.addCallback(lambda _: self.node.getItems(1))
+        d.addCallback(cb)
+        d.addCallback(lambda _: self.node.getItemsById(['new']))
+        d.addCallback(cb)
+        return d
+
+
+    def test_storeItemsBelowCompressionThreshold(self):
+        """
+        Items smaller than the compression threshold are stored as is.
+        """
+        size = len(ITEM_NEW.toXml().encode('utf-8'))
+        self.s.itemCompressionThreshold = size + 1
+
+        def checkStored(row):
+            self.assertEqual(ITEM_NEW.toXml(), decode(row.data))
+            self.assertIdentical(None, row.data_compressed)
+
+        d = self.node.storeItems([ITEM_NEW], PUBLISHER)
+        d.addCallback(lambda _: self.getStoredData('new'))
+        d.addCallback(checkStored)
+        return d
+
+
+    def test_storeUpdatedItemsUncompressed(self):
+        """
+        Updating a compressed item without compression clears the old data.
+        """
+        def checkStored(row):
+            self.assertEqual(ITEM_UPDATED.toXml(), decode(row.data))
+            self.assertIdentical(None, row.data_compressed)
+
+        def uncompress(_):
+            self.s.itemCompressionThreshold = None
+            return self.node.storeItems([ITEM_UPDATED], PUBLISHER)
+
+        self.s.itemCompressionThreshold = 0
+        d = self.node.storeItems([ITEM], PUBLISHER)
+        d.addCallback(uncompress)
+        d.addCallback(lambda _: self.getStoredData('current'))
+        d.addCallback(checkStored)
+        return d
+
+
+    def setUpWriteBatcher(self, maxItems=100):
+        """
+        Store items through a write batcher, counting the interactions.
+        """
+        from idavoll.pgsql_storage import WriteBatcher
+
+        self.clock = task.Clock()
+        self.s.writeBatcher = WriteBatcher(self.dbpool, 0.002, maxItems,
+                                           self.clock)
+
+        self.interactions = []
+        runInteraction = self.dbpool.runInteraction
+        def countingRunInteraction(*args, **kwargs):
+            self.interactions.append(args[0])
+            return runInteraction(*args, **kwargs)
+        self.patch(self.dbpool, 'runInteraction', countingRunInteraction)
+
+
+    def test_storeItemsBatched(self):
+        """
+        Items stored within the batch delay are stored in one transaction.
+        """
+        def store(node):
+            self.setUpWriteBatcher()
+            d = defer.gatherResults([
+                self.node.storeItems([ITEM_NEW], PUBLISHER),
+                node.storeItems([ITEM_NEW], PUBLISHER),
+                ])
+            self.assertEqual([], self.interactions)
+            self.clock.advance(0.002)
+            self.assertEqual(1, len(self.interactions))
+            d.addCallback(lambda _: node.getItemsById(['new']))
+            return d
+
+        def cb(result):
+            self.assertEqual(ITEM_NEW.toXml(), result[0].toXml())
+
+        d = self.s.getNode('to-be-purged')
+        d.addCallback(store)
+        d.addCallback(cb)
+        d.addCallback(lambda _: self.node.getItemsById(['new']))
+        d.addCallback(cb)
+        return d
+
+
+    def test_storeItemsBatchedError(self):
+        """
+        A failing request does not affect the others in the same batch.
+        """
+        def delete(node):
+            def deleteNode(cursor):
+                yield cursor.execute("""DELETE FROM nodes
+                                        WHERE node='to-be-purged'""")
+
+            d = self.dbpool.runInteraction(deleteNode)
+            d.addCallback(lambda _: node)
+            return d
+
+        def store(node):
+            self.setUpWriteBatcher()
+            d1 = node.storeItems([ITEM_NEW], PUBLISHER)
+            self.assertFailure(d1, error.NodeNotFound)
+            d2 = self.node.storeItems([ITEM_NEW], PUBLISHER)
+            self.clock.advance(0.002)
+            self.assertEqual(1, len(self.interactions))
+            d = defer.gatherResults([d1, d2])
+            d.addCallback(lambda _: self.assertNotIn('to-be-purged',
+                                                     self.s.nodeCache))
+            return d
+
+        def cb(result):
+            self.assertEqual(ITEM_NEW.toXml(), result[0].toXml())
+
+        d = self.s.getNode('to-be-purged')
+        d.addCallback(delete)
+        d.addCallback(store)
+        d.addCallback(lambda _: self.node.getItemsById(['new']))
+        d.addCallback(cb)
+        return d
+
+
+    def test_storeItemsBatchedRepublish(self):
+        """
+        An item republished after a new item in the same batch is the
+        newest.
+        """
+        self.setUpWriteBatcher()
+        d = defer.gatherResults([
+            self.node.storeItems([ITEM_NEW], PUBLISHER),
+            self.node.storeItems([ITEM_UPDATED], PUBLISHER),
+            ])
+        self.clock.advance(0.002)
+        self.assertEqual(1, len(self.interactions))
+        d.addCallback(lambda _: self.node.getItems(1))
+        d.addCallback(lambda items: self.assertEqual(
+            [ITEM_UPDATED.toXml()], [item.toXml() for item in items]))
+        return d
+
+
+    def test_storeItemsBatchedStopService(self):
+        """
+        Pending items are stored when the write batcher is stopped, which
+        waits for them to be committed.
+        """
+        self.setUpWriteBatcher()
+        stored = []
+        d1 = self.node.storeItems([ITEM_NEW], PUBLISHER)
+        d1.addCallback(stored.append)
+        d = self.s.writeBatcher.stopService()
+        self.assertEqual(1, len(self.interactions))
+        self.assertEqual([], self.clock.getDelayedCalls())
+        d.addCallback(lambda _: self.assertEqual([None], stored))
+        d.addCallback(lambda _: self.node.getItemsById(['new']))
+        d.addCallback(lambda items: self.assertEqual(
+            [ITEM_NEW.toXml()], [item.toXml() for item in items]))
+        return d
+
+
+    def test_storeItemsBatchSize(self):
+        """
+        A batch is stored right away when enough items are pending.
+        """
+        self.setUpWriteBatcher(maxItems=2)
+        d = defer.gatherResults([
+            self.node.storeItems([ITEM_NEW], PUBLISHER),
+            self.node.storeItems([ITEM_UPDATED], PUBLISHER),
+            ])
+        self.assertEqual(1, len(self.interactions))
+        self.assertEqual([], self.clock.getDelayedCalls())
+        d.addCallback(lambda _: self.node.getItemsById(['new', 'current']))
+        d.addCallback(lambda items: self.assertEqual(
+            [ITEM_NEW.toXml(), ITEM_UPDATED.toXml()],
+            [item.toXml() for item in items]))
+        return d
+
+
+    def setUpReplica(self):
+        """
+        Route reads to a replica, recording the interactions run on it.
+
+        The replica is another pool connected to the same database.
+        """
+        from idavoll.dbpool import ReplicaRouter
+
+        replica = self.makePool()
+        replica.start()
+        self.addCleanup(replica.close)
+        self.s.router = ReplicaRouter(self.dbpool, [replica])
+
+        self.replicaInteractions = []
+        runInteraction = replica.runInteraction
+        def countingRunInteraction(*args, **kwargs):
+            self.replicaInteractions.append(args[0])
+            return runInteraction(*args, **kwargs)
+        self.patch(replica, 'runInteraction', countingRunInteraction)
+
+
+    def test_getItemsReplica(self):
+        """
+        Items are retrieved from a replica.
+        """
+        self.setUpReplica()
+        d = self.node.getItems(1)
+        d.addCallback(lambda items: self.assertEqual(
+            [ITEM.toXml()], [item.toXml() for item in items]))
+        d.addCallback(lambda _: self.assertEqual(
+            1, len(self.replicaInteractions)))
+        return d
+
+
+    def test_getItemsReplicaAfterPublish(self):
+        """
+        Items of a node that was just published to are retrieved from the
+        primary.
+        """
+        self.setUpReplica()
+        d = self.node.storeItems([ITEM_NEW], PUBLISHER)
+        d.addCallback(lambda _: self.node.getItemsById(['new']))
+        d.addCallback(lambda items: self.assertEqual(
+            [ITEM_NEW.toXml()], [item.toXml() for item in items]))
+        d.addCallback(lambda _: self.assertEqual(
+            [], self.replicaInteractions))
+        return d
+
+
+    def test_getSubscriptionsReplicaAfterSubscribe(self):
+        """
+        Subscriptions of an entity that just subscribed are retrieved from
+        the primary.
+        """
+        self.setUpReplica()
+        d = self.node.addSubscription(SUBSCRIBER_NEW, 'subscribed', {})
+        d.addCallback(lambda _: self.s.getSubscriptions(SUBSCRIBER_NEW))
+        d.addCallback(lambda subscriptions: self.assertEqual(
+            ['pre-existing'], [s.nodeIdentifier for s in subscriptions]))
+        d.addCallback(lambda _: self.assertEqual(
+            [], self.replicaInteractions))
+        return d
+
+
+    def test_getSubscriptionsReplicaAfterInvalidation(self):
+        """
+        Subscriptions of a node changed by another process are retrieved
+        from the primary.
+        """
+        self.setUpReplica()
+        self.s.invalidationReceived('{"origin": "other", '
+                                    '"kind": "subscriptions", '
+                                    '"node": "pre-existing"}')
+        d = self.node.getSubscriptions('subscribed')
+        d.addCallback(lambda _: self.assertEqual(
+            [], self.replicaInteractions))
+        return d
+
+
+    def test_getSubscriptionsReplicaAfterMissedInvalidations(self):
+        """
+        When invalidations might have been missed, reads go to the primary.
+        """
+        self.setUpReplica()
+        self.s.invalidationReceived(None)
+        d = self.node.getSubscriptions('subscribed')
+        d.addCallback(lambda _: self.s.getSubscriptions(SUBSCRIBER))
+        d.addCallback(lambda _: self.assertEqual(
+            [], self.replicaInteractions))
+        return d
+
+
+    def listen(self):
+        """
+        Listen for invalidation notifications on a connection of its own.
+        """
+        from idavoll.pgsql_storage import INVALIDATION_CHANNEL
+
+        connection = psycopg2.connect(database='pubsub_test')
+        connection.autocommit = True
+        self.addCleanup(connection.close)
+        connection.cursor().execute("""LISTEN %s""" % INVALIDATION_CHANNEL)
+        self.s.notifyInvalidations = True
+        return connection
+
+
+    def receive(self, connection, timeout=1):
+        """
+        Return the payloads of notifications received on C{connection}.
+        """
+        import json
+        import select
+
+        select.select([connection], [], [], timeout)
+        connection.poll()
+        return [json.loads(notify.payload) for notify in connection.notifies]
+
+
+    def test_notifyInvalidationConfiguration(self):
+        """
+        Reconfiguring a node notifies other processes.
+        """
+        def cb(_):
+            notifications = self.receive(connection)
+            self.assertEqual(1, len(notifications))
+            self.assertEqual('node', notifications[0]['kind'])
+            self.assertEqual('pre-existing', notifications[0]['node'])
+            self.assertEqual(self.s.origin, notifications[0]['origin'])
+
+        connection = self.listen()
+        d = self.node.setConfiguration({'pubsub#deliver_payloads': False})
+        d.addCallback(cb)
+        return d
+
+
+    def test_notifyInvalidationSubscription(self):
+        """
+        Subscribing to a node notifies other processes.
+        """
+        def cb(_):
+            notifications = self.receive(connection)
+            self.assertEqual(['subscriptions'],
+                             [n['kind'] for n in notifications])
+
+        connection = self.listen()
+        d = self.node.addSubscription(SUBSCRIBER_NEW, 'subscribed', {})
+        d.addCallback(cb)
+        return d
+
+
+    def test_notifyInvalidationFailed(self):
+        """
+        Failed changes do not notify other processes.
+        """
+        def cb(_):
+            self.assertEqual([], self.receive(connection, 0.1))
+
+        connection = self.listen()
+        d = self.node.removeSubscription(SUBSCRIBER_NEW)
+        self.assertFailure(d, error.NotSubscribed)
+        d.addCallback(cb)
+        return d
+
+
+    def setUpInvalidationObservers(self):
+        self.invalidated = []
+        self.s.affiliationObservers.append(
+            lambda nodeIdentifier: self.invalidated.append(
+                ('affiliations', nodeIdentifier)))
+        self.s.subscriptionObservers.append(
+            lambda nodeIdentifier: self.invalidated.append(
+                ('subscriptions', nodeIdentifier)))
+
+
+    def test_invalidationReceivedNode(self):
+        """
+        A notification of a changed node invalidates all its cached state.
+        """
+        self.setUpInvalidationObservers()
+        self.s.invalidationReceived(
+            '{"origin": "other", "kind": "node", "node": "pre-existing"}')
+        self.assertNotIn('pre-existing', self.s.nodeCache)
+        self.assertEqual([('affiliations', 'pre-existing'),
+                          ('subscriptions', 'pre-existing')],
+                         self.invalidated)
+
+
+    def test_invalidationReceivedSubscriptions(self):
+        """
+        A notification of changed subscriptions only invalidates those.
+        """
+        self.setUpInvalidationObservers()
+        self.s.invalidationReceived('{"origin": "other", '
+                                    '"kind": "subscriptions", '
+                                    '"node": "pre-existing"}')
+        self.assertIn('pre-existing', self.s.nodeCache)
+        self.assertEqual([('subscriptions', 'pre-existing')],
+                         self.invalidated)
+
+
+    def test_invalidationReceivedOwn(self):
+        """
+        Notifications sent by this storage itself are ignored.
+        """
+        self.setUpInvalidationObservers()
+        self.s.invalidationReceived('{"origin": "%s", "kind": "node", '
+                                    '"node": "pre-existing"}' % self.s.origin)
+        self.assertIn('pre-existing', self.s.nodeCache)
+        self.assertEqual([], self.invalidated)
+
+
+    def test_invalidationReceivedMissed(self):
+        """
+        When notifications might have been missed, everything is
+        invalidated.
+        """
+        self.setUpInvalidationObservers()
+        self.s.invalidationReceived(None)
+        self.assertEqual(0, len(self.s.nodeCache))
+        self.assertEqual([('affiliations', None), ('subscriptions', None)],
+                         self.invalidated)
+
+
+    def test_nodeRecreatedElsewhere(self):
+        """
+        A node object does not operate on a later node with the same name.
+        """
+        config = self.s.getDefaultConfiguration('leaf')
+        config['pubsub#node_type'] = 'leaf'
+
+        def recreate(node):
+            d = self.s.deleteNode('to-be-purged')
+            d.addCallback(lambda _: self.s.createNode('to-be-purged', OWNER,
+                                                      config))
+            d.addCallback(lambda _: node.purge())
+            self.assertFailure(d, error.NodeNotFound)
+            return d
+
+        d = self.s.getNode('to-be-purged')
+        d.addCallback(recreate)
+        d.addCallback(lambda _: self.s.getNode('to-be-purged'))
+        d.addCallback(lambda node: node.getItems())
+        d.addCallback(self.assertEqual, [])
+        return d
 
 
     def cleandb(self, cursor):
-        cursor.execute("""DELETE FROM nodes WHERE node in
-                          ('non-existing', 'pre-existing', 'to-be-deleted',
-                           'new 1', 'new 2', 'new 3', 'to-be-reconfigured',
-                           'to-be-purged')""")
-        cursor.execute("""DELETE FROM entities WHERE jid=%s""",
-                       (OWNER.userhost(),))
-        cursor.execute("""DELETE FROM entities WHERE jid=%s""",
-                       (SUBSCRIBER.userhost(),))
-        cursor.execute("""DELETE FROM entities WHERE jid=%s""",
-                       (SUBSCRIBER_NEW.userhost(),))
-        cursor.execute("""DELETE FROM entities WHERE jid=%s""",
-                       (SUBSCRIBER_TO_BE_DELETED.userhost(),))
-        cursor.execute("""DELETE FROM entities WHERE jid=%s""",
-                       (SUBSCRIBER_PENDING.userhost(),))
-        cursor.execute("""DELETE FROM entities WHERE jid=%s""",
-                       (PUBLISHER.userhost(),))
+        yield cursor.execute("""DELETE FROM nodes WHERE node in
+                                ('non-existing', 'pre-existing', 'to-be-deleted',
+                                 'new 1', 'new 2', 'new 3', 'to-be-reconfigured',
+                                 'to-be-purged')""")
+        yield cursor.execute("""DELETE FROM entities WHERE jid=%s""",
+                             (OWNER.userhost(),))
+        yield cursor.execute("""DELETE FROM entities WHERE jid=%s""",
+                             (SUBSCRIBER.userhost(),))
+        yield cursor.execute("""DELETE FROM entities WHERE jid=%s""",
+                             (SUBSCRIBER_NEW.userhost(),))
+        yield cursor.execute("""DELETE FROM entities WHERE jid=%s""",
+                             (SUBSCRIBER_TO_BE_DELETED.userhost(),))
+        yield cursor.execute("""DELETE FROM entities WHERE jid=%s""",
+                             (SUBSCRIBER_PENDING.userhost(),))
+        yield cursor.execute("""DELETE FROM entities WHERE jid=%s""",
+                             (PUBLISHER.userhost(),))
+
+
+class PgsqlAsyncStorageStorageTestCase(PgsqlStorageStorageTestCase):
+    """
+    Tests for the PostgreSQL storage using asynchronous connections.
+    """
+
+    dbpool = None
+
+    def makePool(self):
+        from idavoll.dbpool import AsyncConnectionPool
+        return AsyncConnectionPool(database='pubsub_test',
+                                   client_encoding='utf-8',
+                                   connection_factory=NamedTupleConnection)
+
+
+
+class PgsqlPartitionedStorageStorageTestCase(PgsqlStorageStorageTestCase):
+    """
+    Tests for the PostgreSQL storage with the items table partitioned.
+
+    The schema, with items partitioned by C{db/partition_items.sql}, is
+    created in a schema of its own in the test database.
+    """
+
+    dbpool = None
+    schema = 'idavoll_partitioned'
+    schemaCreated = False
+
+    def makePool(self):
+        from idavoll.dbpool import ConnectionPool
+        return ConnectionPool('psycopg2',
+                              database='pubsub_test',
+                              cp_reconnect=True,
+                              client_encoding='utf-8',
+                              connection_factory=NamedTupleConnection,
+                              options='-c search_path=%s' % self.schema,
+                              )
+
+
+    def setUp(self):
+        if not self.schemaCreated:
+            self.createSchema()
+            self.__class__.schemaCreated = True
+        return PgsqlStorageStorageTestCase.setUp(self)
+
+
+    def createSchema(self):
+        connection = psycopg2.connect(database='pubsub_test')
+        try:
+            cursor = connection.cursor()
+            cursor.execute("""DROP SCHEMA IF EXISTS %s CASCADE""" %
+                           self.schema)
+            cursor.execute("""CREATE SCHEMA %s""" % self.schema)
+            cursor.execute("""SET search_path TO %s""" % self.schema)
+            for name in ('pubsub.sql', 'partition_items.sql'):
+                with open(os.path.join(DB_DIR, name)) as f:
+                    cursor.execute(f.read())
+            connection.commit()
+        finally:
+            connection.close()
+
+
+    def test_partitionPruning(self):
+        """
+        Retrieving the items of a node only scans the partition holding
+        that node.
+        """
+        import re
+
+        def explain(cursor):
+            cursor.execute("""EXPLAIN SELECT data FROM items
+                              WHERE node_id=%s
+                              ORDER BY date DESC, item_id DESC
+                              LIMIT 10""",
+                           (self.node.nodeDbId,))
+            return [row[0] for row in cursor.fetchall()]
+
+        def cb(plan):
+            partitions = set()
+            for line in plan:
+                partitions.update(re.findall(r' on (items_\d+) ', line))
+            self.assertEqual(1, len(partitions))
+
+        d = self.dbpool.runInteraction(explain)
+        d.addCallback(cb)
+        return d
+
 
 
 try:
@@ -590,3 +1464,8 @@ try:
     from psycopg2.extras import NamedTupleConnection
 except ImportError:
     PgsqlStorageStorageTestCase.skip = "psycopg2 not available"
+    PgsqlAsyncStorageStorageTestCase.skip = "psycopg2 not available"
+    PgsqlPartitionedStorageStorageTestCase.skip = "psycopg2 not available"
+
+if not os.path.exists(os.path.join(DB_DIR, 'partition_items.sql')):
+    PgsqlPartitionedStorageStorageTestCase.skip = "Database schema not found"
@@ -54,6 +54,8 @@ setup(name='idavoll',
       data_files=[('share/idavoll', ['db/pubsub.sql',
                                      'db/gateway.sql',
                                      'db/to_idavoll_0.8.sql',
+                                     'db/to_idavoll_0.10.sql',
+                                     'db/partition_items.sql',
                                      'doc/examples/idavoll.tac',
                                      ])],
       zip_safe=False,